@@ -0,0 +1,571 @@
+" File:         ipython_cell.vim
+" Description:  Autoloaded part of ipython-cell. The Python module is only
+"               imported the first time it is needed.
+" Author:       Hans Chen <contact@hanschen.org>
+
+let s:python_root_dir = fnamemodify(resolve(expand('<sfile>:p')), ':h:h') . '/python'
+
+" Import the Python module if it has not been imported yet. Return 1 if the
+" module is available.
+function! ipython_cell#init()
+    if exists('s:python_command')
+        return 1
+    endif
+
+    if !ipython_cell#has_python()
+        if !exists('s:warned')
+            echo 'ipython-cell requires py >= 2.7 or py3'
+            let s:warned = 1
+        endif
+        return 0
+    endif
+
+    let s:using_python3 = has('python3')
+    let s:python_command = s:using_python3 ? 'py3 ' : 'py '
+    exec s:python_command 'import sys; sys.path.insert(0, '
+                \ . json_encode(s:python_root_dir) . ')'
+    exec s:python_command 'import ipython_cell'
+
+    call s:InitAutocommands()
+    return 1
+endfunction
+
+function! ipython_cell#has_python()
+    return has('python3') || has('python')
+endfunction
+
+" Return 1 if the Python module has been imported.
+function! ipython_cell#loaded()
+    return exists('s:python_command')
+endfunction
+
+" Run the Python statement a:code, importing the Python module first if
+" needed.
+function! ipython_cell#python(code)
+    if ipython_cell#init()
+        exec s:python_command a:code
+    endif
+endfunction
+
+function! s:InitAutocommands()
+    augroup ipython_cell_config
+        autocmd!
+        autocmd OptionSet * call ipython_cell#reload_config()
+        autocmd User IPythonCellReloadConfig call ipython_cell#reload_config()
+    augroup END
+
+    if exists('*dictwatcheradd')
+        call dictwatcheradd(g:, 'ipython_cell_*', function('s:OnOptionChanged'))
+    endif
+
+    augroup ipython_cell_index
+        autocmd!
+        autocmd BufWipeout * call s:ForgetBuffer(expand('<abuf>'))
+    augroup END
+
+    augroup ipython_cell_stale_signs
+        autocmd!
+        autocmd TextChanged,InsertLeave * call s:UpdateStaleSigns()
+    augroup END
+
+    augroup ipython_cell_outline
+        autocmd!
+        autocmd TextChanged,InsertLeave * call s:UpdateOutline()
+    augroup END
+endfunction
+
+" Return all g:ipython_cell_* options, and other values used by the Python
+" module, in a single dictionary.
+function! ipython_cell#options()
+    let options = {}
+    for [name, value] in items(g:)
+        if name =~# '^ipython_cell_'
+            let options[name[len('ipython_cell_'):]] = value
+        endif
+    endfor
+    let options.slime_python_ipython = get(g:, 'slime_python_ipython', 0)
+    let options.has_clipboard = has('clipboard')
+    let options.has_timers = has('timers')
+    let options.has_getmarklist = exists('*getmarklist')
+    return options
+endfunction
+
+function! ipython_cell#reload_config()
+    if ipython_cell#loaded()
+        exec s:python_command 'ipython_cell.reload_config()'
+    endif
+endfunction
+
+function! s:OnOptionChanged(dict, key, change)
+    call ipython_cell#reload_config()
+endfunction
+
+" Return the rows of the marks in a:valid_marks that are set in buffer
+" a:bufnr, using a single call from Python.
+function! ipython_cell#mark_rows(bufnr, valid_marks)
+    let marks = filter(getmarklist(a:bufnr) + getmarklist(),
+                \ {_, m -> m.pos[0] == a:bufnr && m.pos[1] > 0
+                \          && stridx(a:valid_marks, m.mark[1:]) >= 0})
+    return map(marks, {_, m -> m.pos[1]})
+endfunction
+
+function! ipython_cell#drain_queue(session, timer)
+    exec s:python_command 'ipython_cell.drain_queue('
+                \ . json_encode(a:session) . ')'
+endfunction
+
+" Return the vim-slime target of session a:session, or of the current buffer.
+function! ipython_cell#slime_config(session)
+    let session = get(g:ipython_cell_sessions, a:session, {})
+    return get(session, 'slime_config', get(b:, 'slime_config',
+                \ get(g:, 'slime_default_config', {})))
+endfunction
+
+" Run the vim-slime command a:command. If session a:session has a
+" slime_config in g:ipython_cell_sessions, send to that target instead of the
+" target of the current buffer.
+function! ipython_cell#slime_command(session, command)
+    let session = get(g:ipython_cell_sessions, a:session, {})
+    if !has_key(session, 'slime_config')
+        exec a:command
+        return 0
+    endif
+
+    let saved_config = get(b:, 'slime_config', 0)
+    let had_config = exists('b:slime_config')
+    let b:slime_config = session.slime_config
+    try
+        exec a:command
+    finally
+        if had_config
+            let b:slime_config = saved_config
+        else
+            unlet b:slime_config
+        endif
+    endtry
+    return 0
+endfunction
+
+" Return the number of pending send operations, e.g. for the statusline.
+function! ipython_cell#queue_depth()
+    if !ipython_cell#loaded()
+        return 0
+    endif
+    return s:using_python3 ? py3eval('ipython_cell.queue_depth()')
+                \ : pyeval('ipython_cell.queue_depth()')
+endfunction
+
+" Maximum number of line changes to keep track of between two updates of the
+" cell boundary index. If exceeded, the whole buffer is scanned again.
+let s:max_pending_changes = 1000
+
+function! s:RecordChanges(bufnr, start, end, added, changes)
+    let pending = getbufvar(a:bufnr, 'ipython_cell_changes', [])
+    if type(pending) != type([])
+        return
+    endif
+    if len(pending) + len(a:changes) > s:max_pending_changes
+        call setbufvar(a:bufnr, 'ipython_cell_changes', -1)
+        return
+    endif
+    for change in a:changes
+        call add(pending, [change.lnum, change.end, change.added])
+    endfor
+    call setbufvar(a:bufnr, 'ipython_cell_changes', pending)
+endfunction
+
+let s:nvim_attach = join([
+            \ 'vim.api.nvim_buf_attach(_A, false, {',
+            \ '  on_lines = function(_, buf, _, first, last, new_last)',
+            \ '    local pending = vim.b[buf].ipython_cell_changes',
+            \ '    if type(pending) ~= "table" then return end',
+            \ '    if #pending >= ' . s:max_pending_changes . ' then',
+            \ '      vim.b[buf].ipython_cell_changes = -1',
+            \ '      return',
+            \ '    end',
+            \ '    table.insert(pending, {first + 1, last + 1, new_last - last})',
+            \ '    vim.b[buf].ipython_cell_changes = pending',
+            \ '  end,',
+            \ '  on_reload = function(_, buf)',
+            \ '    vim.b[buf].ipython_cell_changes = -1',
+            \ '  end,',
+            \ '  on_detach = function(_, buf)',
+            \ '    vim.b[buf].ipython_cell_listener = nil',
+            \ '  end,',
+            \ '})'], "\n")
+
+" Start tracking line changes in the current buffer. Return 1 if successful.
+function! s:AttachListener()
+    if has('nvim-0.5')
+        let b:ipython_cell_listener = luaeval(s:nvim_attach, bufnr('%'))
+    elseif exists('*listener_add')
+        let b:ipython_cell_listener = listener_add(function('s:RecordChanges'))
+    else
+        return 0
+    endif
+    return b:ipython_cell_listener
+endfunction
+
+" Return [bufnr, changedtick, changes] for buffer bufnr, where changes is a
+" list of [start, end, added] line changes made since the last call, or -1 if
+" the changes are unknown. Changes are only tracked once the buffer has been
+" current.
+function! ipython_cell#buffer_changes(bufnr)
+    let changedtick = getbufvar(a:bufnr, 'changedtick')
+    if !getbufvar(a:bufnr, 'ipython_cell_listener', 0)
+        if a:bufnr == bufnr('%')
+            let b:ipython_cell_changes = s:AttachListener() ? [] : -1
+        endif
+        return [a:bufnr, changedtick, -1]
+    endif
+
+    if exists('*listener_flush')
+        call listener_flush(a:bufnr)
+    endif
+    let changes = getbufvar(a:bufnr, 'ipython_cell_changes', -1)
+    call setbufvar(a:bufnr, 'ipython_cell_changes', [])
+    return [a:bufnr, changedtick, changes]
+endfunction
+
+function! s:ForgetBuffer(bufnr)
+    exec s:python_command 'ipython_cell._forget_buffer(' . a:bufnr . ')'
+endfunction
+
+sign define IPythonCellFresh text== texthl=IPythonCellFresh
+sign define IPythonCellStale text=~ texthl=IPythonCellStale
+
+" Remove the fresh/stale signs with the ids in the list unplace, or all of them
+" if unplace is '*', and place the signs [id, row, name] in the list place in
+" buffer bufnr.
+function! ipython_cell#update_signs(bufnr, unplace, place)
+    let group = 'ipython_cell'
+    if exists('*sign_placelist')
+        if type(a:unplace) == type('')
+            call sign_unplace(group, {'buffer': a:bufnr})
+        else
+            silent! call sign_unplacelist(map(copy(a:unplace), "{'buffer': a:bufnr, 'group': group, 'id': v:val}"))
+        endif
+        call sign_placelist(map(copy(a:place), "{'buffer': a:bufnr, 'group': group, 'id': v:val[0], 'lnum': v:val[1], 'name': v:val[2]}"))
+    else
+        if type(a:unplace) == type('')
+            silent! exec 'sign unplace * group=' . group . ' buffer=' . a:bufnr
+        else
+            for id in a:unplace
+                silent! exec 'sign unplace ' . id . ' group=' . group
+                            \ . ' buffer=' . a:bufnr
+            endfor
+        endif
+        for [id, row, name] in a:place
+            exec 'sign place ' . id . ' line=' . row . ' name=' . name
+                        \ . ' group=' . group . ' buffer=' . a:bufnr
+        endfor
+    endif
+    call setbufvar(a:bufnr, 'ipython_cell_signs', 1)
+    return 0
+endfunction
+
+function! s:UpdateStaleSigns()
+    if get(b:, 'ipython_cell_signs', 0)
+        exec s:python_command 'ipython_cell.update_stale_signs()'
+    endif
+endfunction
+
+if has('nvim-0.5')
+    let s:highlight_namespace = nvim_create_namespace('ipython_cell')
+elseif has('textprop') && empty(prop_type_get('IPythonCell'))
+    call prop_type_add('IPythonCell', {'highlight': 'IPythonCell'})
+endif
+
+" Highlight the cell headers at a:rows in buffer a:bufnr, after removing the
+" highlighting in the [start, end) a:ranges of rows, or in the whole buffer if
+" a:ranges is -1.
+function! ipython_cell#highlight(bufnr, ranges, rows)
+    if type(a:ranges) != type([]) && empty(a:rows)
+                \ && !getbufvar(a:bufnr, 'ipython_cell_highlighted', 0)
+        return 0
+    endif
+
+    " linecount is only available since Vim 8.2.0019, the fallback copies the
+    " whole buffer
+    let info = getbufinfo(a:bufnr)[0]
+    let num_lines = has_key(info, 'linecount') ? info.linecount
+                \ : len(getbufline(a:bufnr, 1, '$'))
+    let ranges = type(a:ranges) == type([]) ? a:ranges : [[1, num_lines + 1]]
+    for [start, end] in ranges
+        let end = min([end, num_lines + 1])
+        if start >= end
+            continue
+        endif
+        if exists('s:highlight_namespace')
+            call nvim_buf_clear_namespace(a:bufnr, s:highlight_namespace,
+                        \ start - 1, end - 1)
+        else
+            call prop_remove({'type': 'IPythonCell', 'bufnr': a:bufnr,
+                        \ 'all': 1}, start, end - 1)
+        endif
+    endfor
+
+    for row in a:rows
+        let length = strlen(get(getbufline(a:bufnr, row), 0, ''))
+        if length == 0
+            continue
+        elseif exists('s:highlight_namespace')
+            call nvim_buf_set_extmark(a:bufnr, s:highlight_namespace, row - 1, 0,
+                        \ {'end_col': length, 'hl_group': 'IPythonCell'})
+        else
+            call prop_add(row, 1, {'type': 'IPythonCell', 'bufnr': a:bufnr,
+                        \ 'length': length})
+        endif
+    endfor
+
+    if !empty(a:rows)
+        call setbufvar(a:bufnr, 'ipython_cell_highlighted', 1)
+    elseif type(a:ranges) != type([])
+        call setbufvar(a:bufnr, 'ipython_cell_highlighted', 0)
+    endif
+    return 0
+endfunction
+
+" Expression for 'foldexpr'. Fold levels are looked up in a table of the cell
+" headers, which is only computed again after the buffer has changed.
+let ipython_cell#foldexpr = "b:changedtick == get(b:, 'ipython_cell_fold_tick', -1)"
+            \ . " ? get(b:ipython_cell_folds, v:lnum, '=')"
+            \ . " : ipython_cell#fold_level(v:lnum)"
+
+function! ipython_cell#fold_level(lnum)
+    if get(b:, 'ipython_cell_fold_tick', -1) != b:changedtick
+        let b:ipython_cell_folds = {}
+        call ipython_cell#python('ipython_cell.update_folds()')
+        let b:ipython_cell_fold_tick = b:changedtick
+    endif
+    return get(b:ipython_cell_folds, a:lnum, '=')
+endfunction
+
+" Set the location list of the current window to the cell headers a:items.
+" If a:refresh is 1, the items are only replaced if the location list still
+" contains the outline.
+function! ipython_cell#set_outline(items, refresh)
+    if a:refresh
+        if getloclist(0, {'id': 0}).id != get(w:, 'ipython_cell_outline', -1)
+            unlet! w:ipython_cell_outline
+            return 0
+        endif
+        call setloclist(0, [], 'r', {'items': a:items})
+    else
+        call setloclist(0, [], ' ', {'title': 'Cells', 'items': a:items})
+        let w:ipython_cell_outline = getloclist(0, {'id': 0}).id
+    endif
+    return 0
+endfunction
+
+function! s:UpdateOutline()
+    if exists('w:ipython_cell_outline')
+        exec s:python_command 'ipython_cell.outline(True)'
+    endif
+endfunction
+
+function! ipython_cell#poll_profile(timer)
+    exec s:python_command 'ipython_cell.poll_profile()'
+endfunction
+
+function! ipython_cell#complete_profile(arg_lead, cmd_line, cursor_pos)
+    return "prun\ntimeit\nlprun"
+endfunction
+
+" Show the profile a:lines of buffer a:bufnr in a scratch window, without
+" leaving the current window. a:rows maps line numbers of the scratch buffer
+" to rows of buffer a:bufnr.
+function! ipython_cell#show_profile(lines, bufnr, rows)
+    let current_winid = win_getid()
+    if exists('s:profile_bufnr') && bufwinnr(s:profile_bufnr) > 0
+        exec bufwinnr(s:profile_bufnr) . 'wincmd w'
+    elseif exists('s:profile_bufnr') && bufexists(s:profile_bufnr)
+        exec 'botright sbuffer ' . s:profile_bufnr
+    else
+        botright new
+        setlocal buftype=nofile bufhidden=hide noswapfile nobuflisted
+        silent file IPythonCellProfile
+        nnoremap <buffer> <silent> <CR> :call ipython_cell#profile_jump()<CR>
+        let s:profile_bufnr = bufnr('%')
+    endif
+
+    setlocal modifiable
+    silent %delete _
+    call setline(1, a:lines)
+    setlocal nomodifiable
+    exec 'resize ' . min([len(a:lines), 15])
+    let b:ipython_cell_profile_source = a:bufnr
+    let b:ipython_cell_profile_rows = a:rows
+
+    call win_gotoid(current_winid)
+    return 0
+endfunction
+
+" Jump to the row of the profile entry under the cursor.
+function! ipython_cell#profile_jump()
+    let row = get(b:ipython_cell_profile_rows, line('.'), 0)
+    if row == 0
+        return
+    endif
+
+    call ipython_cell#jump_to(b:ipython_cell_profile_source, row)
+endfunction
+
+" Jump to row a:row of a:target, a buffer number or a file name. The target
+" is shown in the previous window if it is not shown in a window.
+function! ipython_cell#jump_to(target, row)
+    let bufnr = type(a:target) == type(0) ? a:target : bufnr(a:target)
+    if bufnr > 0 && bufwinnr(bufnr) > 0
+        exec bufwinnr(bufnr) . 'wincmd w'
+    else
+        wincmd p
+        if bufnr > 0
+            exec 'buffer ' . bufnr
+        else
+            exec 'edit ' . fnameescape(a:target)
+        endif
+    endif
+    call cursor(a:row, 1)
+endfunction
+
+function! ipython_cell#poll_runtimes(timer)
+    exec s:python_command 'ipython_cell.poll_runtimes()'
+endfunction
+
+if has('nvim-0.5')
+    let s:runtime_namespace = nvim_create_namespace('ipython_cell_runtime')
+elseif has('textprop') && has('patch-9.0.0121')
+            \ && empty(prop_type_get('IPythonCellRuntime'))
+    call prop_type_add('IPythonCellRuntime', {'highlight': 'IPythonCellRuntime'})
+endif
+
+" Show the texts in a:items, a list of [row, text, regressed], after the rows
+" of buffer a:bufnr, replacing the texts shown before. Requires virtual text.
+function! ipython_cell#show_runtimes(bufnr, items)
+    if exists('s:runtime_namespace')
+        call nvim_buf_clear_namespace(a:bufnr, s:runtime_namespace, 0, -1)
+        for [row, text, regressed] in a:items
+            call nvim_buf_set_extmark(a:bufnr, s:runtime_namespace, row - 1, 0,
+                        \ {'virt_text': [['  ' . text, regressed
+                        \   ? 'IPythonCellRegression' : 'IPythonCellRuntime']]})
+        endfor
+    elseif exists('*prop_type_get')
+                \ && !empty(prop_type_get('IPythonCellRuntime'))
+        if empty(prop_type_get('IPythonCellRegression'))
+            call prop_type_add('IPythonCellRegression',
+                        \ {'highlight': 'IPythonCellRegression'})
+        endif
+        for type in ['IPythonCellRuntime', 'IPythonCellRegression']
+            call prop_remove({'type': type, 'bufnr': a:bufnr, 'all': 1})
+        endfor
+        for [row, text, regressed] in a:items
+            call prop_add(row, 0, {'bufnr': a:bufnr, 'text': text,
+                        \ 'text_align': 'after', 'text_padding_left': 2,
+                        \ 'type': regressed ? 'IPythonCellRegression'
+                        \                   : 'IPythonCellRuntime'})
+        endfor
+    else
+        for [row, text, regressed] in a:items
+            echo 'Row ' . row . ': ' . text
+        endfor
+    endif
+    return 0
+endfunction
+
+" Open the notebook a:path as a percent script in a new buffer that is named
+" after the notebook and written back to it with :write.
+function! ipython_cell#notebook_open(path)
+    let path = fnamemodify(a:path, ':p')
+    if bufexists(path)
+        exec 'buffer ' . bufnr(path)
+        return
+    endif
+
+    enew
+    silent exec 'file ' . fnameescape(path)
+    setlocal buftype=acwrite noswapfile
+    let b:ipython_cell_notebook = path
+    call ipython_cell#python('ipython_cell.notebook_read()')
+    setlocal filetype=python nomodified
+    augroup ipython_cell_notebook
+        autocmd! * <buffer>
+        autocmd BufWriteCmd <buffer> call ipython_cell#notebook_write(expand('<afile>'))
+    augroup END
+endfunction
+
+" Write the current buffer as a notebook to a:path, or to the notebook it was
+" opened from if a:path is empty.
+function! ipython_cell#notebook_write(path)
+    call ipython_cell#python('ipython_cell.notebook_write('
+                \ . json_encode(a:path) . ')')
+endfunction
+
+" Put the syntax errors a:items in the quickfix list and open it, or clear
+" the quickfix list if a:items is empty and it still has the errors put
+" there before.
+function! ipython_cell#set_errors(items)
+    let winid = win_getid()
+    if empty(a:items)
+        if getqflist({'id': 0}).id == get(s:, 'errors_qfid', -1)
+            call setqflist([], 'r', {'items': []})
+            cclose
+        endif
+    else
+        call setqflist([], ' ', {'title': 'IPythonCell syntax errors',
+                    \ 'items': a:items})
+        let s:errors_qfid = getqflist({'id': 0}).id
+        botright cwindow
+    endif
+    call win_gotoid(winid)
+    return 0
+endfunction
+
+function! ipython_cell#poll_output(timer)
+    if !bufexists(get(s:, 'output_bufnr', -1))
+        call timer_stop(a:timer)
+        return
+    endif
+    exec s:python_command 'ipython_cell.poll_output()'
+endfunction
+
+" Show the output buffer in a window at the bottom, creating it if needed,
+" and return its number.
+function! ipython_cell#open_output()
+    let current_winid = win_getid()
+    if exists('s:output_bufnr') && bufwinnr(s:output_bufnr) > 0
+        return s:output_bufnr
+    elseif exists('s:output_bufnr') && bufexists(s:output_bufnr)
+        exec 'botright sbuffer ' . s:output_bufnr
+        resize 12
+    else
+        botright 12new
+        setlocal buftype=nofile bufhidden=hide noswapfile nobuflisted
+        setlocal nomodifiable
+        silent file IPythonCellOutput
+        nnoremap <buffer> <silent> <CR> :call ipython_cell#python('ipython_cell.output_jump()')<CR>
+        let s:output_bufnr = bufnr('%')
+    endif
+    call win_gotoid(current_winid)
+    return s:output_bufnr
+endfunction
+
+" Append a:lines to buffer a:bufnr, delete its first lines so that it has at
+" most a:max_lines lines, and scroll the windows that show it to the end.
+function! ipython_cell#append_output(bufnr, lines, max_lines)
+    call setbufvar(a:bufnr, '&modifiable', 1)
+    if getbufline(a:bufnr, 1, 2) == ['']
+        call setbufline(a:bufnr, 1, a:lines)
+    else
+        call appendbufline(a:bufnr, '$', a:lines)
+    endif
+    let excess = getbufinfo(a:bufnr)[0].linecount - a:max_lines
+    if excess > 0
+        silent call deletebufline(a:bufnr, 1, excess)
+    endif
+    call setbufvar(a:bufnr, '&modifiable', 0)
+
+    for winid in win_findbuf(a:bufnr)
+        call win_execute(winid, 'normal! G')
+    endfor
+    return 0
+endfunction
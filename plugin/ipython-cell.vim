@@ -7,11 +7,6 @@ if exists('g:loaded_ipython_cell')
 endif
 let g:loaded_ipython_cell = 1
 
-if !has("python") && !has("python3")
-    echo 'ipython-cell requires py >= 2.7 or py3'
-    finish
-endif
-
 let g:ipython_cell_delimit_cells_by = get(g:, 'ipython_cell_delimit_cells_by', 'tags')
 let g:ipython_cell_tag = get(g:, 'ipython_cell_tag', ['# %%', '#%%', '# <codecell>', '##'])
 let g:ipython_cell_insert_tag = get(g:, 'ipython_cell_insert_tag', '# %% ')
@@ -27,94 +22,212 @@ let g:ipython_cell_send_ctrl_c = get(g:, 'ipython_cell_send_ctrl_c', 1)
 let g:ipython_cell_send_ctrl_u = get(g:, 'ipython_cell_send_ctrl_u', 0)
 let g:ipython_cell_update_file_variable = get(g:, 'ipython_cell_update_file_variable', 0)
 let g:ipython_cell_shell_prev_cmd = get(g:, 'ipython_cell_shell_prev_cmd', '!!')
+let g:ipython_cell_transport = get(g:, 'ipython_cell_transport', 'slime')
+let g:ipython_cell_kernel_connection_file = get(g:, 'ipython_cell_kernel_connection_file', '')
+let g:ipython_cell_send_async = get(g:, 'ipython_cell_send_async', 0)
+let g:ipython_cell_tmpfile_command = get(g:, 'ipython_cell_tmpfile_command', '%run -i "{filepath}"')
+let g:ipython_cell_stale_signs = get(g:, 'ipython_cell_stale_signs', 0)
+let g:ipython_cell_trace_file = get(g:, 'ipython_cell_trace_file', '')
+let g:ipython_cell_validate = get(g:, 'ipython_cell_validate', 0)
+let g:ipython_cell_checkpoint_dir = get(g:, 'ipython_cell_checkpoint_dir', '')
+let g:ipython_cell_output_lines = get(g:, 'ipython_cell_output_lines', 10000)
+let g:ipython_cell_tmux_target = get(g:, 'ipython_cell_tmux_target', '')
+let g:ipython_cell_tmux_socket = get(g:, 'ipython_cell_tmux_socket', '')
+let g:ipython_cell_sessions = get(g:, 'ipython_cell_sessions', {})
+let g:ipython_cell_runtime_history = get(g:, 'ipython_cell_runtime_history', 0)
+let g:ipython_cell_runtime_history_file = get(g:, 'ipython_cell_runtime_history_file', '')
+let g:ipython_cell_runtime_regression = get(g:, 'ipython_cell_runtime_regression', 2.0)
 
-function! s:UsingPython3()
-  if has('python3')
-    return 1
-  endif
-    return 0
+function! IPythonCellClear()
+    call ipython_cell#python("ipython_cell.clear()")
 endfunction
 
-let s:using_python3 = s:UsingPython3()
-let s:python_until_eof = s:using_python3 ? "python3 << EOF" : "python << EOF"
-let s:python_command = s:using_python3 ? "py3 " : "py "
-
-let s:plugin_root_dir = fnamemodify(resolve(expand('<sfile>:p')), ':h')
-
-exec s:python_until_eof
-import sys
-from os.path import normpath, join
-import vim
-plugin_root_dir = vim.eval('s:plugin_root_dir')
-python_root_dir = normpath(join(plugin_root_dir, '..', 'python'))
-sys.path.insert(0, python_root_dir)
-import ipython_cell
-EOF
-
-function! IPythonCellClear()
-    exec s:python_command "ipython_cell.clear()"
+function! IPythonCellClipboardInfo()
+    call ipython_cell#python("ipython_cell.clipboard_info()")
 endfunction
 
 function! IPythonCellClose()
-    exec s:python_command "ipython_cell.close_all()"
+    call ipython_cell#python("ipython_cell.close_all()")
 endfunction
 
 function! IPythonCellExecuteCell(...)
     let arg1 = get(a:, 1, 0)
     let arg2 = get(a:, 2, 0)
-    exec s:python_command "ipython_cell.execute_cell(" . arg1 . ")"
+    call ipython_cell#python("ipython_cell.execute_cell(" . arg1 . ")")
     if arg2
-        exec s:python_command "ipython_cell.jump_next_cell()"
+        call ipython_cell#python("ipython_cell.jump_next_cell()")
     endif
 endfunction
 
+function! IPythonCellExecuteCells(which, ...)
+    let use_cpaste = get(a:, 1, 0)
+    let first_row = get(a:, 2, 0)
+    let last_row = get(a:, 3, 0)
+    call ipython_cell#python("ipython_cell.execute_cells('" . a:which . "', "
+                \ . use_cpaste . ", " . first_row . ", " . last_row . ")")
+endfunction
+
+function! IPythonCellExecuteCellWithDependencies(...)
+    let use_cpaste = get(a:, 1, 0)
+    call ipython_cell#python("ipython_cell.execute_cell_with_dependencies(" . use_cpaste . ")")
+endfunction
+
+function! IPythonCellExecuteStaleCells(...)
+    let use_cpaste = get(a:, 1, 0)
+    call ipython_cell#python("ipython_cell.execute_stale_cells(" . use_cpaste . ")")
+endfunction
+
 function! IPythonCellNextCell()
-    exec s:python_command "ipython_cell.jump_next_cell()"
+    call ipython_cell#python("ipython_cell.jump_next_cell()")
 endfunction
 
 function! IPythonCellPrevCell()
-    exec s:python_command "ipython_cell.jump_prev_cell()"
+    call ipython_cell#python("ipython_cell.jump_prev_cell()")
 endfunction
 
 function! IPythonCellPrevCommand()
-    exec s:python_command "ipython_cell.previous_command()"
+    call ipython_cell#python("ipython_cell.previous_command()")
 endfunction
 
 function! IPythonCellRestart()
-    exec s:python_command "ipython_cell.restart_ipython('" . g:ipython_cell_shell_prev_cmd . "')"
+    call ipython_cell#python("ipython_cell.restart_ipython('" . g:ipython_cell_shell_prev_cmd . "')")
+endfunction
+
+function! IPythonCellRestartRestore(...)
+    call ipython_cell#python("ipython_cell.restart_ipython('" . g:ipython_cell_shell_prev_cmd . "', "
+                \ . json_encode(a:000) . ")")
+endfunction
+
+function! IPythonCellCheckpoint(...)
+    call ipython_cell#python("ipython_cell.checkpoint(" . json_encode(a:000) . ")")
+endfunction
+
+function! IPythonCellRestore(...)
+    call ipython_cell#python("ipython_cell.restore(" . json_encode(a:000) . ")")
 endfunction
 
 function! IPythonCellRun(...)
-    exec s:python_command "ipython_cell.run('" . join(a:000, ',') . "')"
+    call ipython_cell#python("ipython_cell.run('" . join(a:000, ',') . "')")
 endfunction
 
 function! IPythonCellInsertBelow(...)
-    exec s:python_command "ipython_cell.insert_cell_below()"
+    call ipython_cell#python("ipython_cell.insert_cell_below()")
 endfunction
 
 function! IPythonCellInsertAbove(...)
-    exec s:python_command "ipython_cell.insert_cell_above()"
+    call ipython_cell#python("ipython_cell.insert_cell_above()")
 endfunction
 
 function! IPythonCellToMarkdown(...)
-    exec s:python_command "ipython_cell.to_markdown()"
+    call ipython_cell#python("ipython_cell.to_markdown()")
+endfunction
+
+function! IPythonCellProfile(...)
+    let mode = get(a:, 1, 'prun')
+    call ipython_cell#python("ipython_cell.profile_cell('" . mode . "')")
+endfunction
+
+function! IPythonCellSplit()
+    call ipython_cell#python("ipython_cell.split_cell()")
+endfunction
+
+function! IPythonCellMergeBelow()
+    call ipython_cell#python("ipython_cell.merge_cell()")
+endfunction
+
+function! IPythonCellMove(direction)
+    call ipython_cell#python("ipython_cell.move_cell(" . a:direction . ")")
+endfunction
+
+function! IPythonCellDelete()
+    call ipython_cell#python("ipython_cell.delete_cell()")
+endfunction
+
+function! IPythonCellNotebookOpen(path)
+    call ipython_cell#notebook_open(a:path)
+endfunction
+
+function! IPythonCellNotebookWrite(...)
+    call ipython_cell#notebook_write(get(a:, 1, ''))
+endfunction
+
+function! IPythonCellFold()
+    setlocal foldmethod=expr
+    let &l:foldexpr = g:ipython_cell#foldexpr
+endfunction
+
+function! IPythonCellOutline()
+    call ipython_cell#python("ipython_cell.outline()")
+    if exists('w:ipython_cell_outline')
+        lopen
+    endif
+endfunction
+
+function! IPythonCellOutput()
+    call ipython_cell#python("ipython_cell.open_output()")
+endfunction
+
+function! IPythonCellRuntimes()
+    call ipython_cell#python("ipython_cell.show_runtimes()")
+endfunction
+
+function! IPythonCellStats()
+    call ipython_cell#python("ipython_cell.stats()")
+endfunction
+
+" Return the number of pending send operations, e.g. for the statusline.
+function! IPythonCellQueueDepth()
+    return ipython_cell#queue_depth()
+endfunction
+
+function! IPythonCellQueueStatus()
+    call ipython_cell#python("ipython_cell.queue_status()")
+endfunction
+
+function! IPythonCellReloadConfig()
+    call ipython_cell#reload_config()
 endfunction
 
 command! -nargs=0 IPythonCellClear call IPythonCellClear()
+command! -nargs=0 IPythonCellClipboardInfo call IPythonCellClipboardInfo()
 command! -nargs=0 IPythonCellClose call IPythonCellClose()
 command! -nargs=0 IPythonCellExecuteCell call IPythonCellExecuteCell()
 command! -nargs=0 IPythonCellExecuteCellJump call IPythonCellExecuteCell(0, 1)
 command! -nargs=0 IPythonCellExecuteCellVerbose call IPythonCellExecuteCell(1)
 command! -nargs=0 IPythonCellExecuteCellVerboseJump call IPythonCellExecuteCell(1, 1)
+command! -nargs=0 -bang IPythonCellExecuteCellsAbove call IPythonCellExecuteCells('above', <bang>0)
+command! -nargs=0 -bang IPythonCellExecuteCellsBelow call IPythonCellExecuteCells('below', <bang>0)
+command! -nargs=0 -bang IPythonCellExecuteAll call IPythonCellExecuteCells('all', <bang>0)
+command! -range -bang IPythonCellExecuteCells call IPythonCellExecuteCells('range', <bang>0, <line1>, <line2>)
+command! -nargs=0 -bang IPythonCellExecuteCellWithDeps call IPythonCellExecuteCellWithDependencies(<bang>0)
+command! -nargs=0 -bang IPythonCellExecuteStale call IPythonCellExecuteStaleCells(<bang>0)
 command! -nargs=0 IPythonCellNextCell call IPythonCellNextCell()
 command! -nargs=0 IPythonCellPrevCell call IPythonCellPrevCell()
 command! -nargs=0 IPythonCellPrevCommand call IPythonCellPrevCommand()
 command! -nargs=0 IPythonCellRestart call IPythonCellRestart()
+command! -nargs=* IPythonCellRestartRestore call IPythonCellRestartRestore(<f-args>)
+command! -nargs=* IPythonCellCheckpoint call IPythonCellCheckpoint(<f-args>)
+command! -nargs=* IPythonCellRestore call IPythonCellRestore(<f-args>)
 command! -nargs=0 IPythonCellRun call IPythonCellRun()
 command! -nargs=0 IPythonCellRunTime call IPythonCellRun('-t')
 command! -nargs=0 IPythonCellInsertBelow call IPythonCellInsertBelow()
 command! -nargs=0 IPythonCellInsertAbove call IPythonCellInsertAbove()
 command! -nargs=0 IPythonCellToMarkdown call IPythonCellToMarkdown()
+command! -nargs=? -complete=custom,ipython_cell#complete_profile IPythonCellProfile call IPythonCellProfile(<f-args>)
+command! -nargs=0 IPythonCellSplit call IPythonCellSplit()
+command! -nargs=0 IPythonCellMergeBelow call IPythonCellMergeBelow()
+command! -nargs=0 IPythonCellMoveUp call IPythonCellMove(-1)
+command! -nargs=0 IPythonCellMoveDown call IPythonCellMove(1)
+command! -nargs=0 IPythonCellDelete call IPythonCellDelete()
+command! -nargs=1 -complete=file IPythonCellNotebookOpen call IPythonCellNotebookOpen(<q-args>)
+command! -nargs=? -complete=file IPythonCellNotebookWrite call IPythonCellNotebookWrite(<q-args>)
+command! -nargs=0 IPythonCellFold call IPythonCellFold()
+command! -nargs=0 IPythonCellOutline call IPythonCellOutline()
+command! -nargs=0 IPythonCellOutput call IPythonCellOutput()
+command! -nargs=0 IPythonCellRuntimes call IPythonCellRuntimes()
+command! -nargs=0 IPythonCellStats call IPythonCellStats()
+command! -nargs=0 IPythonCellReloadConfig call IPythonCellReloadConfig()
+command! -nargs=0 IPythonCellQueueStatus call IPythonCellQueueStatus()
 
 let s:t_string = type('')
 
@@ -132,12 +245,26 @@ endfor
 let g:ipython_cell_match_pattern = join(s:ipython_cell_match_patterns, '\|')
 
 highlight default link IPythonCell Folded
+highlight default link IPythonCellFresh DiffAdd
+highlight default link IPythonCellStale DiffChange
+highlight default link IPythonCellRuntime Comment
+highlight default link IPythonCellRegression WarningMsg
+
+let s:use_text_properties = has('nvim-0.5') || has('textprop')
+
 function! UpdateCellHighlight()
-    if g:ipython_cell_highlight_cells == 0
+    let enabled = g:ipython_cell_highlight_cells
+                \ && index(g:ipython_cell_highlight_cells_ft, &filetype) >= 0
+
+    if s:use_text_properties
+                \ && (enabled || get(b:, 'ipython_cell_highlighted', 0))
+                \ && ipython_cell#has_python()
+        call ipython_cell#python("ipython_cell.update_cell_highlight(" . enabled . ")")
         return
     endif
 
-    if index(g:ipython_cell_highlight_cells_ft, &filetype) >= 0
+    " Without text properties or extmarks, highlight the tags with a match
+    if enabled
         if !exists('w:ipython_cell_match')
             let w:ipython_cell_match=matchadd('IPythonCell', g:ipython_cell_match_pattern)
         endif
@@ -152,4 +279,7 @@ endfunction
 augroup highlight_python_cells
     autocmd!
     autocmd BufEnter,BufWinEnter,WinEnter * call UpdateCellHighlight()
+    if s:use_text_properties
+        autocmd FileType,TextChanged,InsertLeave * call UpdateCellHighlight()
+    endif
 augroup END
@@ -1,8 +1,25 @@
 from __future__ import print_function
 
+import ast
+import atexit
+import bisect
+import collections
+import contextlib
+import hashlib
+import json
+import math
+import mmap
+import os
 import re
 from subprocess import Popen, PIPE
+import shutil
 import sys
+import tempfile
+import textwrap
+import threading
+import itertools
+import time
+import uuid
 
 try:
     import vim
@@ -17,6 +34,32 @@ CTRL_O = '\x0f'
 CTRL_P = '\x10'
 CTRL_U = '\x15'
 
+# Cell boundary index for each buffer, keyed by buffer number
+_cell_indexes = {}
+
+# Compiled cell header matchers, keyed by tags and regex option
+_tag_matchers = {}
+
+# Cached snapshot of the configuration, see _get_settings
+_settings = None
+
+# Transports used to send code, keyed by transport name and target
+_transports = {}
+
+# Hash of the code of executed cells for each buffer, keyed by buffer number
+# and cell key (see _get_cells)
+_executed_cells = {}
+
+# Ids of the signs placed by update_stale_signs
+_sign_ids = itertools.count(1)
+
+# Names defined and used by cells, keyed by the hash of the code of the cell
+_cell_names = {}
+
+# Syntax error of the code sent for cells, or None, keyed by the hash of the
+# code, see _validate_code
+_validated_code = {}
+
 
 def execute_cell(use_cpaste=False):
     """Execute code within cell.
@@ -27,13 +70,10 @@ def execute_cell(use_cpaste=False):
         Set to True to use %cpaste instead of %paste to send cell to ipython.
 
     """
+    _timings.start('execute_cell')
     current_row, _ = vim.current.window.cursor
-    cell_boundaries = _get_cell_boundaries(auto_include_first_line=False)
-
-    # Include first line of buffer if necessary
-    first_line_contains_cell_header = 1 in cell_boundaries
-    if not first_line_contains_cell_header:
-        cell_boundaries.insert(0, 1)
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
 
     start_row, end_row = _get_current_cell_boundaries(current_row,
                                                       cell_boundaries)
@@ -41,65 +81,294 @@ def execute_cell(use_cpaste=False):
     if end_row is None:
         end_row = len(vim.current.buffer)
 
-    _clear_prompt()
+    runtime_key = None
+    if _get_settings().runtime_history:
+        runtime_key = _get_runtime_key(vim.current.buffer, start_row, end_row,
+                                       first_line_contains_cell_header)
 
-    # Send tags?
-    if (vim.eval('g:ipython_cell_delimit_cells_by') == 'tags'
-            and vim.eval('g:ipython_cell_send_cell_headers') != '0'):
-        if start_row == 1 and not first_line_contains_cell_header:
-            cell_header = "# cell 0"
+    _execute_rows(start_row, end_row, cell_boundaries,
+                  first_line_contains_cell_header, use_cpaste, runtime_key)
+
+
+def execute_cells(which, use_cpaste=False, first_row=None, last_row=None):
+    """Execute several cells at once.
+
+    The cells are joined and sent as a single payload.
+
+    Parameters
+    ----------
+    which : str
+        Which cells to execute: ``'above'`` for all cells above the current
+        cell, ``'below'`` for the current cell and all cells below it,
+        ``'all'`` for all cells in the buffer, or ``'range'`` for all cells
+        that overlap the rows ``first_row`` to ``last_row``.
+    use_cpaste : bool
+        Set to True to use %cpaste instead of %paste to send cells to ipython.
+    first_row, last_row : int
+        First and last rows (1-indexed) if ``which`` is ``'range'``.
+
+    """
+    _timings.start('execute_cells_' + which)
+    current_row, _ = vim.current.window.cursor
+    num_rows = len(vim.current.buffer)
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    current_start_row, current_end_row = _get_current_cell_boundaries(
+        current_row, cell_boundaries)
+
+    if which == 'above':
+        if current_start_row == 1:
+            vim.command("echo 'There are no cells above the current cell'")
+            _timings.cancel()
+            return
+        start_row, end_row = 1, current_start_row - 1
+    elif which == 'below':
+        start_row, end_row = current_start_row, num_rows
+    elif which == 'all':
+        start_row, end_row = 1, num_rows
+    elif which == 'range':
+        start_row, _ = _get_current_cell_boundaries(int(first_row),
+                                                    cell_boundaries)
+        _, end_row = _get_current_cell_boundaries(int(last_row),
+                                                  cell_boundaries)
+        if end_row is None:
+            end_row = num_rows
+    else:
+        _error("Invalid cells to execute: {}".format(which))
+        _timings.cancel()
+        return
+
+    _execute_rows(start_row, end_row, cell_boundaries,
+                  first_line_contains_cell_header, use_cpaste)
+
+
+def execute_cell_with_dependencies(use_cpaste=False):
+    """Execute the current cell and the cells above it that it depends on.
+
+    A cell depends on the last cell above it that defines a name that it uses,
+    and on the dependencies of that cell. The cells are executed in buffer
+    order as a single block of code.
+
+    Parameters
+    ----------
+    use_cpaste : bool
+        Set to True to use %cpaste instead of %paste to send cells to ipython.
+
+    """
+    _timings.start('execute_cell_with_dependencies')
+    current_row, _ = vim.current.window.cursor
+    buffer = vim.current.buffer
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    current = bisect.bisect_right(cell_boundaries, current_row) - 1
+    cells = _get_cells(buffer, cell_boundaries,
+                       first_line_contains_cell_header)[:current+1]
+
+    with _timings.phase('dependencies'):
+        names = [_get_cell_names(buffer, cell) for cell in cells]
+        if names[current] is None:
+            _error("Could not parse the current cell, executing it without "
+                   "dependencies")
+            upstream = set()
         else:
-            cell_header = vim.current.buffer[start_row-1]
+            upstream = _get_upstream_cells(names, current)
 
-        _slimesend0(cell_header)
-        _slimesend0(CTRL_O)
-        _slimesend0(CTRL_N)
+    segments = []
+    for i in sorted(upstream) + [current]:
+        cell = cells[i]
+        if segments and segments[-1][1] == cell.start_row - 1:
+            segments[-1] = (segments[-1][0], cell.end_row)
+        else:
+            segments.append((cell.start_row, cell.end_row))
 
-    # Do not send the tag over
-    if vim.eval('g:ipython_cell_delimit_cells_by') == 'tags':
-        if first_line_contains_cell_header or start_row != 1:
-            start_row += 1
+    _execute_segments(segments, cell_boundaries,
+                      first_line_contains_cell_header, use_cpaste)
 
-    # start_row and end_row are 1-indexed, need to subtract 1
-    cell = "\n".join(vim.current.buffer[start_row-1:end_row])
-    cell_is_empty = not cell
 
-    if vim.eval('g:ipython_cell_update_file_variable') != '0':
-        f = vim.eval("expand('%:p')")
-        # Make sure the indentation is the same as the first line of the cell
-        first_row = vim.current.buffer[start_row-1]
-        indentation = re.match(r"[\t ]*", first_row).group()
-        cell = indentation + "__file__ = '{}'\n".format(f) + cell
+def execute_stale_cells(use_cpaste=False):
+    """Execute all cells that changed, or were added, since they were last
+    executed.
+
+    Parameters
+    ----------
+    use_cpaste : bool
+        Set to True to use %cpaste instead of %paste to send cells to ipython.
 
-    if not use_cpaste:
-        if cell_is_empty:
-            _slimesend("# empty cell")
+    """
+    _timings.start('execute_stale_cells')
+    buffer = vim.current.buffer
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    cells = _get_cells(buffer, cell_boundaries,
+                       first_line_contains_cell_header)
+    # Track executed cells from now on
+    executed = _executed_cells.setdefault(buffer.number, {})
+    hash_cell = _hash_cell
+    if _get_settings().delimit_cells_by == 'tags':
+        hash_cell = _cell_indexes[buffer.number].cell_hash
+
+    segments = []
+    for cell in cells:
+        if executed.get(cell.key) == hash_cell(buffer, cell):
+            continue
+        if segments and segments[-1][1] == cell.start_row - 1:
+            segments[-1] = (segments[-1][0], cell.end_row)
         else:
-            _copy_to_clipboard(cell)
-            paste_command = vim.eval('g:ipython_cell_cell_command')
-            _slimesend(paste_command)
+            segments.append((cell.start_row, cell.end_row))
+
+    if not segments:
+        vim.command("echo 'All cells are up to date'")
+        _timings.cancel()
+        return
+
+    _execute_segments(segments, cell_boundaries,
+                      first_line_contains_cell_header, use_cpaste)
+
+
+def update_stale_signs(rows=()):
+    """Show in the sign column which cells have changed since they were last
+    executed.
+
+    When cells are delimited by tags, only the cells around the rows that
+    changed since the last update and the cells that start at ``rows`` are
+    checked again, and only the signs whose state changed are placed again.
+
+    Parameters
+    ----------
+    rows : list
+        First rows of cells that were executed since the last update.
+
+    """
+    buffer = vim.current.buffer
+    settings = _get_settings()
+    executed = _executed_cells.get(buffer.number)
+    if executed is None or not settings.stale_signs:
+        return
+
+    if settings.delimit_cells_by != 'tags':
+        # Line changes are not tracked, replace all signs and forget the
+        # signs placed when cells were delimited by tags
+        _cell_indexes.pop(buffer.number, None)
+        cell_boundaries, first_line_contains_cell_header = \
+            _get_cell_boundaries_with_first_line()
+        signs = []
+        for cell in _get_cells(buffer, cell_boundaries,
+                               first_line_contains_cell_header):
+            name = _get_stale_sign(executed, cell, _hash_cell(buffer, cell))
+            signs.append([cell.start_row, cell.start_row, name])
+        vim.eval('ipython_cell#update_signs({}, "*", {})'
+                 .format(buffer.number, signs))
+        return
+
+    index = _get_cell_index(buffer, settings.tag, settings.regex)
+    ranges = index.take_touched_ranges()
+    if ranges is None:
+        positions = range(index.num_cells())
     else:
-        try:
-            slime_python_ipython = vim.eval('g:slime_python_ipython')
-        except vim.error:
-            slime_python_ipython = False
+        positions = set(index.position(row) for row in rows)
+        for start, end in ranges:
+            positions.update(index.positions_around(start, end))
+        positions = sorted(positions)
+
+    removed = index.take_removed_signs()
+    # The placed signs are not known, e.g., after cells were delimited by
+    # marks, remove them all
+    remove_all = ranges is None and not any(
+        'sign' in state for state in index.cell_states.values())
+    signs = []
+    for position in positions:
+        cell = index.get_cell(buffer, position)
+        name = _get_stale_sign(executed, cell, index.cell_hash(buffer, cell))
+        state = index.cell_states[cell.start_row]
+        if 'sign' in state:
+            if state['sign'][1] == name:
+                continue
+            removed.append(state['sign'][0])
+        state['sign'] = (next(_sign_ids), name)
+        signs.append([state['sign'][0], cell.start_row, name])
+
+    if remove_all:
+        removed = '"*"'
+    if removed or signs:
+        vim.eval('ipython_cell#update_signs({}, {}, {})'
+                 .format(buffer.number, removed, signs))
+
+
+def _get_stale_sign(executed, cell, digest):
+    """Return the name of the sign of ``cell``, whose code has the hash
+    ``digest``, given the hashes of the ``executed`` cells."""
+    if executed.get(cell.key) == digest:
+        return 'IPythonCellFresh'
+    return 'IPythonCellStale'
+
+
+def update_cell_highlight(enabled=True):
+    """Highlight the cell headers in the current buffer.
+
+    Only the rows that changed since the last update are highlighted again.
+    Nothing is highlighted if cells are delimited by marks.
 
-        if slime_python_ipython:
-            # Add a newline at the start of the cell to avoid problems if there
-            # is a global indentation level, see Issue #37 on GitHub
-            cell = "\n" + cell
+    Parameters
+    ----------
+    enabled : bool
+        Set to False to remove the highlighting.
+
+    """
+    buffer = vim.current.buffer
+    settings = _get_settings()
+    if not enabled or settings.delimit_cells_by != 'tags':
+        index = _cell_indexes.get(buffer.number)
+        if index is not None:
+            # Highlight all rows again if highlighting is enabled later
+            index.changed_ranges = None
+        ranges, rows = None, []
+    else:
+        index = _get_cell_index(buffer, settings.tag, settings.regex)
+        ranges = index.take_changed_ranges()
+        if ranges == []:
+            return
 
-            _slimesend(cell)
+        if ranges is None:
+            rows = index.rows
         else:
-            _slimesend("%cpaste -q")
-            # Send 25 lines at a time to avoid potential issues when sending
-            # a large number of lines
-            remaining_chunks = cell.splitlines()
-            while remaining_chunks:
-                chunk = remaining_chunks[:25]
-                remaining_chunks[:25] = []
-                _slimesend("\n".join(chunk))
-            _slimesend("--")
+            rows = []
+            for start, end in ranges:
+                first = bisect.bisect_left(index.rows, start)
+                last = bisect.bisect_left(index.rows, end)
+                rows.extend(index.rows[first:last])
+
+    vim.eval('ipython_cell#highlight({}, {}, {})'.format(
+        buffer.number,
+        -1 if ranges is None else [list(r) for r in ranges],
+        list(rows)))
+
+
+def update_folds():
+    """Store the fold levels of the cell headers in the current buffer in
+    ``b:ipython_cell_folds``, see ``ipython_cell#fold_level``."""
+    cell_boundaries = _get_cell_boundaries(auto_include_first_line=False)
+    vim.current.buffer.vars['ipython_cell_folds'] = dict(
+        (str(row), '>1') for row in cell_boundaries or [])
+
+
+def outline(refresh=False):
+    """Fill the location list of the current window with the cell headers.
+
+    Parameters
+    ----------
+    refresh : bool
+        Set to True to only update the location list if it still contains
+        the outline.
+
+    """
+    buffer = vim.current.buffer
+    cell_boundaries = _get_cell_boundaries(auto_include_first_line=False)
+    if cell_boundaries is None:
+        return
+
+    items = _get_outline(buffer, cell_boundaries)
+    vim.eval('ipython_cell#set_outline({}, {})'
+             .format(json.dumps(items), int(refresh)))
 
 
 def jump_next_cell():
@@ -127,457 +396,3762 @@ def jump_prev_cell():
 
 
 def insert_cell_below():
-    insert_tag = vim.eval('g:ipython_cell_insert_tag')
-
-    current_row, _ = vim.current.window.cursor
+    """Insert a cell header below the current cell."""
     cell_boundaries = _get_cell_boundaries()
-    _, end_row = _get_current_cell_boundaries(current_row, cell_boundaries)
+    _apply_edit(_edit_insert_cell_below(
+        vim.current.buffer, cell_boundaries, vim.current.window.cursor,
+        _get_settings().insert_tag))
 
-    # Required for Python 2
-    if end_row is None:
-        end_row = len(vim.current.buffer)
 
-    # Jump cursor to end_row
-    if end_row != current_row:
-        try:
-            vim.current.window.cursor = (end_row, 0)
-        except vim.error:
-            vim.command("echo 'Cell header is outside the buffer boundaries'")
+def insert_cell_above():
+    """Insert a cell header above the current cell."""
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    _apply_edit(_edit_insert_cell_above(
+        vim.current.buffer, cell_boundaries, first_line_contains_cell_header,
+        vim.current.window.cursor, _get_settings().insert_tag))
 
-    # Insert tag bellow
-    if vim.current.line != '':
-        vim.command("normal!o")
-    current_row, _ = vim.current.window.cursor
-    if current_row != 1:
-        vim.command("normal!o")
-        current_row += 1
-    if current_row != len(vim.current.buffer):
-        vim.command("normal!O")
-    vim.command("normal!i" + insert_tag)
 
+def to_markdown():
+    """Convert the current cell into a markdown cell."""
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    _apply_edit(_edit_to_markdown(
+        vim.current.buffer, cell_boundaries, first_line_contains_cell_header,
+        vim.current.window.cursor, _get_settings().insert_tag))
 
-def insert_cell_above():
-    insert_tag = vim.eval('g:ipython_cell_insert_tag')
 
-    current_row, _ = vim.current.window.cursor
-    cell_boundaries = _get_cell_boundaries(auto_include_first_line=False)
+def split_cell():
+    """Split the current cell at the cursor by inserting a cell header."""
+    cell_boundaries = _get_cell_boundaries()
+    edit = _edit_split_cell(vim.current.buffer, cell_boundaries,
+                            vim.current.window.cursor,
+                            _get_settings().insert_tag)
+    if edit is None:
+        vim.command("echo 'Cannot split a cell at its first line'")
+        return
+    _apply_edit(edit)
 
-    # Include first line of buffer if necessary
-    first_line_contains_cell_header = 1 in cell_boundaries
-    if not first_line_contains_cell_header:
-        cell_boundaries.insert(0, 1)
 
-    start_row, _ = _get_current_cell_boundaries(current_row, cell_boundaries)
+def merge_cell():
+    """Merge the current cell with the cell below it."""
+    if _get_settings().delimit_cells_by != 'tags':
+        _error("Cells can only be merged if they are delimited by tags")
+        return
 
-    # If the cursor not at the header of the current cell,
-    # we move the cursor to the header
-    if current_row != start_row:
-        try:
-            vim.current.window.cursor = (start_row, 0)
-        except vim.error:
-            vim.command("echo 'Cell header is outside the buffer boundaries'")
+    cell_boundaries = _get_cell_boundaries()
+    edit = _edit_merge_cell(cell_boundaries, vim.current.window.cursor)
+    if edit is None:
+        vim.command("echo 'There is no cell below the current cell'")
+        return
+    _apply_edit(edit)
 
-    # If the start_row is the first line and not contains header
-    # We instert a cell header for the current cell
-    if start_row == 1 and not first_line_contains_cell_header:
-        vim.command("normal!O")
-        vim.command("normal!i" + insert_tag)
-    else:
-        vim.command("normal!O")
-        vim.command("normal!O")
-        vim.command("normal!i" + insert_tag)
 
+def move_cell(direction):
+    """Swap the current cell with the cell above or below it.
 
-def to_markdown():
-    insert_tag = vim.eval('g:ipython_cell_insert_tag')
+    Parameters
+    ----------
+    direction : int
+        -1 to move the cell up, 1 to move it down.
 
-    current_row, _ = vim.current.window.cursor
-    cell_boundaries = _get_cell_boundaries(auto_include_first_line=False)
+    """
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    edit = _edit_move_cell(vim.current.buffer, cell_boundaries,
+                           first_line_contains_cell_header,
+                           vim.current.window.cursor, int(direction))
+    if edit is None:
+        vim.command("echo 'The cell cannot be moved {}'"
+                    .format("up" if int(direction) < 0 else "down"))
+        return
+    _apply_edit(edit)
 
-    # Include first line of buffer if necessary
-    first_line_contains_cell_header = 1 in cell_boundaries
-    if not first_line_contains_cell_header:
-        cell_boundaries.insert(0, 1)
 
-    start_row, end_row = _get_current_cell_boundaries(current_row,
-                                                      cell_boundaries)
+def delete_cell():
+    """Delete the current cell."""
+    cell_boundaries = _get_cell_boundaries()
+    _apply_edit(_edit_delete_cell(vim.current.buffer, cell_boundaries,
+                                  vim.current.window.cursor))
 
-    if end_row is None:
-        end_row = len(vim.current.buffer)
 
-    # Switch to end_row first as start_row will not change after insert """
-    # line
-    if current_row != end_row:
-        try:
-            vim.current.window.cursor = (end_row, 0)
-        except vim.error:
-            vim.command("echo 'Cell is outside the buffer boundaries'")
+def notebook_read():
+    """Replace the current buffer with the cells of the notebook
+    ``b:ipython_cell_notebook`` in the percent format.
 
-    if vim.current.line != '':
-        vim.command("normal!o")
+    The notebook is scanned without loading its outputs, see ``_Notebook``.
+    """
+    path = _get_buffer_notebook()
+    try:
+        with _Notebook(path) as notebook:
+            lines = _notebook_to_percent(notebook.cells,
+                                         _get_settings().insert_tag)
+    except (IOError, OSError, ValueError) as e:
+        _error("Cannot read notebook {}: {}".format(path, e))
+        return
+    vim.current.buffer[:] = lines
 
-    current_row, _ = vim.current.window.cursor
-    if current_row != len(vim.current.buffer):
-        vim.command('normal!O')
-    vim.command('normal!i"""')
 
-    # We move the cursor to the header
-    try:
-        vim.current.window.cursor = (start_row, 0)
-    except vim.error:
-        vim.command("echo 'Cell is outside the buffer boundaries'")
+def notebook_write(path=''):
+    """Write the current buffer as a notebook.
 
-    # If the start_row is the first line and not contains header
-    # We instert a cell header for the current cell
-    if start_row == 1 and not first_line_contains_cell_header:
-        vim.command("normal!O")
-        vim.command("normal!i" + insert_tag)
+    Cells that are unchanged since the notebook ``b:ipython_cell_notebook``
+    was read are copied from it with their outputs and metadata.
 
-    # Now we at the header row
-    vim.command('normal!A [markdown]')
-    vim.command('normal!o')
-    vim.command('normal!i"""')
-    vim.command('normal!j')
+    Parameters
+    ----------
+    path : str
+        Path of the notebook to write. If empty, write to
+        ``b:ipython_cell_notebook``.
 
+    """
+    original = _get_buffer_notebook()
+    if not (path or original):
+        _error("No notebook to write to")
+        return
+    path = os.path.abspath(os.path.expanduser(path or original))
+
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    cells = _percent_to_cells(vim.current.buffer, cell_boundaries,
+                              first_line_contains_cell_header)
+    if not os.path.isfile(original):
+        original = None
+    try:
+        num_copied = _write_notebook(path, cells, original)
+    except (IOError, OSError, ValueError) as e:
+        _error("Cannot write notebook {}: {}".format(path, e))
+        return
 
-def previous_command():
-    """Run previous command."""
-    _clear_prompt()
-    _slimesend(CTRL_P)
+    if original and path == os.path.abspath(original):
+        vim.command('setlocal nomodified')
+    vim.command("echo " + _sanitize('"{}" {} cells, {} unchanged'.format(
+        path, len(cells), num_copied)))
 
 
-def restart_ipython(shell_prev_cmd):
-    """Quit ipython and start it again."""
-    ctrl_p = re.compile('<c-p>|<ctrl-p>', re.IGNORECASE)
-    shell_prev_cmd = ctrl_p.sub(CTRL_P, shell_prev_cmd)
+def profile_cell(mode='prun'):
+    """Execute the current cell under a profiler in IPython.
 
-    _clear_prompt()
-    _slimesend("exit")
-    _slimesend(shell_prev_cmd)
+    The results are shown in a scratch buffer when IPython is done, sorted
+    with the most expensive entries first. Entries for rows of the cell can
+    be jumped to with <CR>.
 
+    Parameters
+    ----------
+    mode : str
+        ``'prun'`` for ``%prun``, ``'timeit'`` for ``%timeit`` or ``'lprun'``
+        for line_profiler.
 
-def run(*args):
-    """Run script."""
-    options = " ".join(args)
-    run_command = vim.eval('g:ipython_cell_run_command')
-    run_command = run_command.format(options=options,
-                                     filepath=vim.current.buffer.name)
-    _clear_prompt()
-    _slimesend(run_command)
+    """
+    if mode not in _PROFILE_MODES:
+        _error("Invalid profile mode: {}, expected one of {}"
+               .format(mode, ", ".join(_PROFILE_MODES)))
+        return
 
+    settings = _get_settings()
+    buffer = vim.current.buffer
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    start_row, end_row = _get_current_cell_boundaries(
+        vim.current.window.cursor[0], cell_boundaries)
+    if end_row is None:
+        end_row = len(buffer)
 
-def clear():
-    """Clear screen."""
-    _clear_prompt()
-    _slimesend("%clear")
+    session = None
+    code_start_row = start_row
+    if settings.delimit_cells_by == 'tags' and (
+            start_row != 1 or first_line_contains_cell_header):
+        session = _get_header_session(buffer[start_row-1])
+        code_start_row += 1
 
+    transport = _get_transport(session)
+    if transport is None:
+        return
 
-def close_all():
-    """Close all figure windows."""
-    _clear_prompt()
-    _slimesend("plt.close('all')")
+    code = "\n".join(buffer[code_start_row-1:end_row])
+    filename = buffer.name or "<cell>"
+    driver = _profiler.start(mode, code, code_start_row, filename,
+                             buffer.number, (start_row, end_row))
+    _clear_prompt(session)
+    transport.send_command(_run_helper_command(driver))
 
+    if settings.has_timers:
+        _profiler.schedule()
+    else:
+        print("Profile results will be written to {}"
+              .format(_profiler.job['result']))
 
-def _clear_prompt():
-    if vim.eval('g:ipython_cell_send_ctrl_u') != '0':
-        _slimesend0(CTRL_U)
 
-    if vim.eval('g:ipython_cell_send_ctrl_c') != '0':
-        _slimesend0("i")  # enter insert mode
-        _slimesend0(CTRL_C)
+def poll_profile():
+    """Show the results of the running profile if they are ready. Called
+    from a Vim timer."""
+    result = _profiler.poll()
+    if result is None:
+        return
 
+    _profiler.unschedule()
+    job = _profiler.job
+    try:
+        buffer = vim.buffers[job['bufnr']]
+    except KeyError:
+        buffer = []
+    lines, rows = _format_profile(result, buffer, job['filename'],
+                                  job['rows'])
+    vim.eval('ipython_cell#show_profile({}, {}, {})'.format(
+        json.dumps(lines), int(job['bufnr']), json.dumps(rows)))
+    _profiler.finish()
+
+
+def poll_runtimes():
+    """Store the runtimes reported by IPython in the runtime history. Called
+    from a Vim timer."""
+    settings = _get_settings()
+    runs = _runtime_history.read_results()
+    if not runs:
+        return
+    if not _runtime_history.pending:
+        _runtime_history.unschedule()
 
-def _copy_to_clipboard(string, prefer_program=None):
-    """Copy ``string`` to primary clipboard.
+    bufnrs = set()
+    for key, result in runs:
+        if result.get('error'):
+            continue
+        bufnr, path, cell_hash, row = key
+        try:
+            _runtime_history.add(settings.runtime_history_file, path,
+                                 cell_hash, result['started'],
+                                 result['seconds'], result.get('max_rss'))
+        except Exception as e:
+            _error("Could not store the runtime of the cell: {}".format(e))
+            continue
+        bufnrs.add(bufnr)
 
-    If the +clipboard feature flag in Vim is present, the function will use Vim
-    to copy the string, otherwise it will attempt to use an external program.
+        summary = _runtime_summary(
+            _runtime_history.get_runs(settings.runtime_history_file, path,
+                                      cell_hash),
+            settings.runtime_regression)
+        if summary['regressed']:
+            _error("Cell at row {} of {} took {}, {:.1f}x its median runtime"
+                   .format(row, os.path.basename(path),
+                           _format_time(summary['last']), summary['ratio']))
 
-    Parameters
-    ----------
-    string : str
-        String to copy to clipboard.
-    prefer_program : None or str
-        Which external program to use to copy to clipboard if +clipboard is
-        absent.
+    if vim.current.buffer.number in bufnrs:
+        show_runtimes()
 
-    """
-    if vim.eval('g:ipython_cell_prefer_external_copy') != '0':
-        _copy_to_clipboard_external(string, prefer_program)
-    else:
-        copy_successful = _copy_to_clipboard_internal(string)
-        if not copy_successful:
-            _copy_to_clipboard_external(string, prefer_program)
 
+def show_runtimes():
+    """Show the last and median runtimes of the cells of the current buffer
+    after their headers."""
+    settings = _get_settings()
+    buffer = vim.current.buffer
+    cell_boundaries, first_line_contains_cell_header = \
+        _get_cell_boundaries_with_first_line()
+    path = os.path.abspath(buffer.name) if buffer.name else ''
 
-def _copy_to_clipboard_external(string, prefer_program=None):
-    """Copy ``string`` to primary clipboard using pbcopy, xclip or xsel.
+    items = []
+    try:
+        for cell in _get_cells(buffer, cell_boundaries,
+                               first_line_contains_cell_header):
+            runs = _runtime_history.get_runs(settings.runtime_history_file,
+                                             path, _hash_cell(buffer, cell))
+            if not runs:
+                continue
+            summary = _runtime_summary(runs, settings.runtime_regression)
+            text = "last {}, median {} ({} runs)".format(
+                _format_time(summary['last']),
+                _format_time(summary['median']), summary['runs'])
+            if summary['regressed']:
+                text += ", {:.1f}x slower".format(summary['ratio'])
+            items.append([cell.start_row, text, int(summary['regressed'])])
+    except Exception as e:
+        _error("Could not read the runtime history: {}".format(e))
+        return
 
-    Parameters
-    ----------
-    string : str
-        String to copy to clipboard.
-    prefer_program : None or str
-        Which external program to use to copy to clipboard.
+    vim.eval('ipython_cell#show_runtimes({}, {})'.format(
+        int(buffer.number), json.dumps(items)))
 
-    """
-    PROGRAMS = [
-        ["pbcopy"],
-        ["xclip", "-i", "-selection", "clipboard"],
-        ["xsel", "-i", "--clipboard"],
-    ]
 
-    # Python 2 compatibility
-    try:
-        FileNotFoundError
-    except NameError:
-        FileNotFoundError = OSError
+def open_output():
+    """Show the output of IPython in a scratch buffer that is updated as
+    new output arrives, see ``_OutputPane``."""
+    _output.open()
 
-    for program in PROGRAMS:
-        if prefer_program is not None and program[0] != prefer_program:
-            continue
 
-        try:
-            p = Popen(program, stdin=PIPE)
-        except FileNotFoundError:
-            program_found = False
-        else:
-            program_found = True
-            break
+def poll_output():
+    """Append the new output of IPython to the output buffer. Called by a
+    Vim timer."""
+    _output.poll()
 
-    if not program_found:
-        _error("Could not find xclip or xsel executable")
+
+def output_jump():
+    """Jump from the traceback line under the cursor in the output buffer to
+    the line of code it refers to."""
+    row, _ = vim.current.window.cursor
+    location = _parse_traceback_location(vim.current.buffer[:], row)
+    if location is None:
+        vim.command("echo 'No traceback line under the cursor'")
         return
 
-    byte = string.encode()
-    p.communicate(input=byte)
+    target = _output.locate(*location)
+    if target is None:
+        vim.command("echo 'Cannot find the code of this traceback line'")
+        return
+    vim.command('call ipython_cell#jump_to({}, {})'.format(
+        json.dumps(target[0]), int(target[1])))
 
 
-def _copy_to_clipboard_internal(string):
-    """Copy ``string`` to primary clipboard using Vim.
+def drain_queue(session=''):
+    """Run pending send operations of ``session``. Called from a Vim
+    timer."""
+    queue = _send_queues.get(session)
+    if queue is not None:
+        queue.drain()
 
-    Return True if the copy is successful, otherwise return False.
-    """
-    if vim.eval("has('clipboard')") == '1':
-        vim.command('let @+=' + _sanitize(string))
-        return True
-    else:
-        return False
 
+def queue_depth():
+    """Return the number of pending send operations of all sessions."""
+    return sum(len(queue) for queue in _send_queues.values())
 
-def _error(*args, **kwargs):
-    """Print error message to stderr. Same parameters as print."""
-    print(*args, file=sys.stderr, **kwargs)
 
+def queue_status():
+    """Print the number of pending send operations of each session."""
+    depths = [(session, len(queue))
+              for session, queue in sorted(_send_queues.items())
+              if len(queue) > 0]
+    if not depths:
+        print("Send queue is empty")
+    for session, depth in depths:
+        print("Send queue{}: {} pending operation{}".format(
+            " ({})".format(session) if session else "", depth,
+            "" if depth == 1 else "s"))
 
-def _get_cell_boundaries(auto_include_first_line=True):
-    """Return a list of rows (1-indexed) for all cell boundaries.
+
+def reload_config():
+    """Reload the ``g:ipython_cell_*`` options on next use."""
+    global _settings
+    _settings = None
+
+
+def previous_command():
+    """Run previous command."""
+    transport = _get_transport()
+    if transport is not None:
+        _clear_prompt()
+        transport.previous_command()
+
+
+def restart_ipython(shell_prev_cmd, names=None):
+    """Quit ipython and start it again.
 
     Parameters
     ----------
-    auto_include_first_line : bool
-        If True (default), include first line of the buffer automatically in
-        the returned list even if it does not contain a cell header.
+    shell_prev_cmd : str
+        The shell command that runs the previous command, i.e., IPython.
+    names : list or None
+        If not None, save these global variables with ``checkpoint`` before
+        quitting and ``restore`` them after starting IPython again. If
+        empty, save all variables that can be pickled.
 
     """
-    buffer = vim.current.buffer
-    delimiter = vim.eval('g:ipython_cell_delimit_cells_by').strip()
-
-    if delimiter == 'marks':
-        valid_marks = vim.eval('g:ipython_cell_valid_marks').strip()
-        cell_boundaries = _get_rows_with_marks(buffer, valid_marks)
-    elif delimiter == 'tags':
-        tag = vim.eval('g:ipython_cell_tag')
-        regex_option = vim.eval('g:ipython_cell_regex').strip().lower()
-        use_regex = regex_option in ['1', 'y', 'yes', 't', 'true']
-        cell_boundaries = _get_rows_with_tag(buffer, tag, use_regex)
-    else:
-        _error("Invalid option value for g:ipython_cell_valid_marks: {}"
-               .format(delimiter))
+    ctrl_p = re.compile('<c-p>|<ctrl-p>', re.IGNORECASE)
+    shell_prev_cmd = ctrl_p.sub(CTRL_P, shell_prev_cmd)
+
+    transport = _get_transport()
+    if transport is None:
         return
 
-    if auto_include_first_line:
-        # Include beginning of buffer as a cell boundary
-        cell_boundaries.append(1)
+    if names is not None:
+        save = _checkpoint_command('save', names)
+        load = _checkpoint_command('load', names)
+        if save is None or load is None:
+            return
 
-    return sorted(set(cell_boundaries))
+    _clear_prompt()
+    if names is not None:
+        transport.send_command(save)
+    transport.restart(shell_prev_cmd)
+    if names is not None:
+        transport.send_command(load)
+
+
+def checkpoint(names=()):
+    """Save global variables of IPython to the checkpoint directory.
+
+    Parameters
+    ----------
+    names : list
+        The names of the variables to save. If empty, save all variables
+        that can be pickled, except modules, functions and classes.
+
+    """
+    command = _checkpoint_command('save', names)
+    if command is not None:
+        _clear_prompt()
+        _send_command(command)
+
+
+def restore(names=()):
+    """Load global variables saved by ``checkpoint`` into IPython.
+
+    Parameters
+    ----------
+    names : list
+        The names of the variables to load. If empty, load all saved
+        variables.
+
+    """
+    command = _checkpoint_command('load', names)
+    if command is not None:
+        _clear_prompt()
+        _send_command(command)
+
+
+def run(*args):
+    """Run script."""
+    options = " ".join(args)
+    run_command = _get_settings().run_command
+    run_command = run_command.format(options=options,
+                                     filepath=vim.current.buffer.name)
+    _clear_prompt()
+    _send_command(run_command)
+
+
+def clear():
+    """Clear screen."""
+    _clear_prompt()
+    _send_command("%clear")
+
+
+def clipboard_info():
+    """Print the clipboard program in use and the measured copy latency."""
+    settings = _get_settings()
+    if settings.has_clipboard and not settings.prefer_external_copy:
+        method = "Vim (+clipboard)"
+    else:
+        program = _clipboard.find_program()
+        method = program[0] if program is not None else "none found"
+
+    latencies = _clipboard.latencies
+    if latencies:
+        print("Clipboard: {}, last copy {:.1f} ms, mean {:.1f} ms over {} "
+              "copies".format(method, 1000 * latencies[-1],
+                              1000 * sum(latencies) / len(latencies),
+                              len(latencies)))
+    else:
+        print("Clipboard: {}, no copies made".format(method))
+
+
+def stats():
+    """Print the time spent in each phase of recent cell executions."""
+    records = list(_timings.records)
+    if not records:
+        print("No cells executed yet")
+        return
+
+    phases = []
+    for record in records:
+        for name in record['phases']:
+            if name not in phases:
+                phases.append(name)
+
+    print("Last {} executions, median size {} lines, {} bytes".format(
+        len(records), _percentile([r['lines'] for r in records], 50),
+        _percentile([r['bytes'] for r in records], 50)))
+    print("{:<16}{:>9}{:>9}{:>9}{:>9}".format(
+        "phase", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name in phases + ['other', 'total']:
+        if name == 'total':
+            values = [r['total'] for r in records]
+        elif name == 'other':
+            values = [r['total'] - sum(r['phases'].values())
+                      for r in records]
+        else:
+            values = [r['phases'].get(name, 0.0) for r in records]
+        print("{:<16}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}".format(
+            name, *[1000 * _percentile(values, percent)
+                    for percent in [50, 90, 99, 100]]))
+
+
+def close_all():
+    """Close all figure windows."""
+    _clear_prompt()
+    _send_command("plt.close('all')")
+
+
+# Script run with _run_helper_command to save or load the global variables of
+# IPython. NumPy arrays are saved as .npy files, other values with pickle,
+# using protocol 5 with out-of-band buffers if available, so that large
+# buffers are written as they are. Loaded arrays and buffers are memory
+# mapped copy on write, so they are only read from disk when they are used.
+_CHECKPOINT_HELPER = """\
+def _ipython_cell_checkpoint(action, directory, names):
+    import json, mmap, os, pickle, shutil, sys, types
+    ip = get_ipython()
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if action == 'save':
+        if not names:
+            excluded = (types.ModuleType, types.FunctionType,
+                        types.BuiltinFunctionType, type)
+            names = [name for name, value in ip.user_ns.items()
+                     if not name.startswith('_')
+                     and name not in ip.user_ns_hidden
+                     and not isinstance(value, excluded)]
+
+        new_directory = directory + '.new'
+        shutil.rmtree(new_directory, ignore_errors=True)
+        os.makedirs(new_directory)
+        manifest = {}
+        skipped = []
+        for i, name in enumerate(sorted(names)):
+            if name not in ip.user_ns:
+                skipped.append(name)
+                continue
+            value = ip.user_ns[name]
+            path = os.path.join(new_directory, str(i))
+            numpy = sys.modules.get('numpy')
+            try:
+                if (numpy is not None and type(value) is numpy.ndarray
+                        and not value.dtype.hasobject):
+                    numpy.save(path + '.npy', value, allow_pickle=False)
+                    manifest[name] = {'file': str(i), 'format': 'npy'}
+                    continue
+
+                buffers = []
+                if pickle.HIGHEST_PROTOCOL >= 5:
+                    data = pickle.dumps(value, protocol=5,
+                                        buffer_callback=buffers.append)
+                else:
+                    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                with open(path + '.pkl', 'wb') as f:
+                    f.write(data)
+                for j, buffer in enumerate(buffers):
+                    with open('{}.{}.buf'.format(path, j), 'wb') as f:
+                        f.write(buffer.raw())
+                manifest[name] = {'file': str(i), 'format': 'pickle',
+                                  'buffers': len(buffers)}
+            except Exception:
+                skipped.append('{} ({})'.format(name, type(value).__name__))
+
+        with open(os.path.join(new_directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(new_directory, directory)
+        print('Saved {} variables to {}'.format(len(manifest), directory))
+    else:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        loaded = 0
+        skipped = []
+        for name, entry in sorted(manifest.items()):
+            if names and name not in names:
+                continue
+            path = os.path.join(directory, entry['file'])
+            try:
+                if entry['format'] == 'npy':
+                    import numpy
+                    value = numpy.asarray(numpy.load(path + '.npy',
+                                                     mmap_mode='c'))
+                else:
+                    buffers = []
+                    for j in range(entry['buffers']):
+                        with open('{}.{}.buf'.format(path, j), 'rb') as f:
+                            if os.fstat(f.fileno()).st_size == 0:
+                                buffers.append(bytearray())
+                            else:
+                                buffers.append(mmap.mmap(
+                                    f.fileno(), 0, access=mmap.ACCESS_COPY))
+                    with open(path + '.pkl', 'rb') as f:
+                        if buffers:
+                            value = pickle.loads(f.read(), buffers=buffers)
+                        else:
+                            value = pickle.loads(f.read())
+            except Exception as e:
+                skipped.append('{} ({})'.format(name, e))
+                continue
+            ip.user_ns[name] = value
+            loaded += 1
+        print('Loaded {} variables from {}'.format(loaded, directory))
+    if skipped:
+        print('Skipped: ' + ', '.join(skipped))
+
+
+try:
+    _ipython_cell_checkpoint(__import__('sys').argv[1],
+                             __import__('sys').argv[2],
+                             __import__('sys').argv[3:])
+finally:
+    del _ipython_cell_checkpoint
+"""
+
+
+def _checkpoint_command(action, names):
+    """Return the command that makes IPython save (``action`` 'save') or
+    load (``action`` 'load') the global variables ``names`` in the
+    checkpoint directory of the session of the current buffer, or None if
+    a name is invalid."""
+    names = [str(name) for name in names]
+    invalid = [name for name in names
+               if not re.match(r'^[A-Za-z_]\w*$', name)]
+    if invalid:
+        _error("Invalid variable names: " + ", ".join(invalid))
+        return None
+
+    base = _get_settings().checkpoint_dir
+    if not base:
+        cache_dir = (os.environ.get('XDG_CACHE_HOME')
+                     or os.path.join(os.path.expanduser('~'), '.cache'))
+        base = os.path.join(cache_dir, 'ipython-cell', 'checkpoints')
+    base = os.path.abspath(os.path.expanduser(base))
+    if not os.path.isdir(base):
+        os.makedirs(base)
+
+    session = _get_buffer_session() or 'default'
+    directory = os.path.join(base, re.sub(r'[^\w.-]', '_', session))
+    helper_path = os.path.join(base, 'checkpoint.py')
+    with open(helper_path, 'wb') as f:
+        f.write(_CHECKPOINT_HELPER.encode('utf-8'))
+    return _run_helper_command(helper_path,
+                               [action, '"{}"'.format(directory)] + names)
+
+
+def _clear_prompt(session=None):
+    with _timings.phase('clear_prompt'):
+        transport = _get_transport(session)
+        if transport is not None:
+            transport.clear_prompt()
+
+
+class _ClipboardError(Exception):
+    pass
+
+
+class _Clipboard(object):
+    """Copy strings to the system clipboard using an external program.
+
+    The program to use is looked up once and then reused for all copies. The
+    time taken by each copy is recorded in ``latencies``.
+    """
+    PROGRAMS = [
+        ["pbcopy"],
+        ["xclip", "-i", "-selection", "clipboard"],
+        ["xsel", "-i", "--clipboard"],
+    ]
+
+    def __init__(self):
+        self._programs = {}
+        self.latencies = collections.deque(maxlen=100)
+
+    def find_program(self, prefer_program=None):
+        """Return the command line of the program to use, or None."""
+        try:
+            return self._programs[prefer_program]
+        except KeyError:
+            pass
+
+        program = None
+        for candidate in self.PROGRAMS:
+            if prefer_program is not None and candidate[0] != prefer_program:
+                continue
+
+            path = _which(candidate[0])
+            if path is not None:
+                program = [path] + candidate[1:]
+                break
+
+        self._programs[prefer_program] = program
+        return program
+
+    def copy(self, string, prefer_program=None):
+        """Copy ``string`` to the clipboard.
+
+        Raise ``_ClipboardError`` if no program is found or it fails.
+        """
+        program = self.find_program(prefer_program)
+        if program is None:
+            raise _ClipboardError("Could not find xclip or xsel executable")
+
+        start = time.time()
+        try:
+            p = Popen(program, stdin=PIPE)
+            p.communicate(input=string.encode())
+        except OSError as e:
+            # The program may have been removed, look it up again next time
+            self._programs.pop(prefer_program, None)
+            raise _ClipboardError("Could not run {}: {}"
+                                  .format(program[0], e))
+        self.latencies.append(time.time() - start)
+
+    def copy_async(self, string, prefer_program=None):
+        """Copy ``string`` to the clipboard in a background thread.
+
+        Returns
+        -------
+        _CopyJob:
+            The started job.
+
+        """
+        job = _CopyJob(self, string, prefer_program)
+        job.start()
+        return job
+
+
+class _CopyJob(threading.Thread):
+    """Thread that copies a string to the clipboard.
+
+    Errors are stored in ``error`` rather than printed, since Vim must only be
+    accessed from the main thread.
+    """
+    def __init__(self, clipboard, string, prefer_program=None):
+        super(_CopyJob, self).__init__()
+        self.daemon = True
+        self.clipboard = clipboard
+        self.string = string
+        self.prefer_program = prefer_program
+        self.error = None
+
+    def run(self):
+        try:
+            self.clipboard.copy(self.string, self.prefer_program)
+        except _ClipboardError as e:
+            self.error = e
+
+
+_clipboard = _Clipboard()
+
+
+def _copy_to_clipboard(string, prefer_program=None):
+    """Copy ``string`` to primary clipboard.
+
+    If the +clipboard feature flag in Vim is present, the function will use Vim
+    to copy the string, otherwise it will attempt to use an external program.
+
+    Parameters
+    ----------
+    string : str
+        String to copy to clipboard.
+    prefer_program : None or str
+        Which external program to use to copy to clipboard if +clipboard is
+        absent.
+
+    """
+    with _timings.phase('clipboard'):
+        if _get_settings().prefer_external_copy:
+            _copy_to_clipboard_external(string, prefer_program)
+        else:
+            copy_successful = _copy_to_clipboard_internal(string)
+            if not copy_successful:
+                _copy_to_clipboard_external(string, prefer_program)
+
+
+def _copy_to_clipboard_external(string, prefer_program=None):
+    """Copy ``string`` to primary clipboard using pbcopy, xclip or xsel.
+
+    Parameters
+    ----------
+    string : str
+        String to copy to clipboard.
+    prefer_program : None or str
+        Which external program to use to copy to clipboard.
+
+    """
+    try:
+        _clipboard.copy(string, prefer_program)
+    except _ClipboardError as e:
+        _error(e)
+
+
+def _copy_to_clipboard_internal(string):
+    """Copy ``string`` to primary clipboard using Vim.
+
+    Return True if the copy is successful, otherwise return False.
+    """
+    if _get_settings().has_clipboard:
+        start = time.time()
+        vim.command('let @+=' + _sanitize(string))
+        _clipboard.latencies.append(time.time() - start)
+        return True
+    else:
+        return False
+
+
+# Replace rows start_row to end_row (1-indexed, inclusive) with lines, then
+# move the cursor to the (row, col) cursor. Lines are inserted before
+# start_row if end_row is start_row - 1.
+_Edit = collections.namedtuple(
+    '_Edit', ['start_row', 'end_row', 'lines', 'cursor'])
+
+
+def _edit_insert_cell_below(buffer, cell_boundaries, cursor, insert_tag):
+    """Return the ``_Edit`` that inserts a cell header below the current cell.
+
+    The header is separated from the cells above and below by empty lines.
+    """
+    _, end_row = _get_current_cell_boundaries(cursor[0], cell_boundaries)
+    if end_row is None:
+        end_row = len(buffer)
+
+    lines = [insert_tag]
+    if buffer[end_row-1] != '':
+        lines.insert(0, '')
+    if end_row < len(buffer):
+        lines.append('')
+    tag_row = end_row + len(lines) - (1 if end_row < len(buffer) else 0)
+    return _Edit(end_row + 1, end_row, lines,
+                 (tag_row, max(len(insert_tag) - 1, 0)))
+
+
+def _edit_insert_cell_above(buffer, cell_boundaries,
+                            first_line_contains_cell_header, cursor,
+                            insert_tag):
+    """Return the ``_Edit`` that inserts a cell header above the current
+    cell, or at the first row if the first cell has no header."""
+    start_row, _ = _get_current_cell_boundaries(cursor[0], cell_boundaries)
+    if start_row == 1 and not first_line_contains_cell_header:
+        lines = [insert_tag]
+    else:
+        lines = [insert_tag, '']
+    return _Edit(start_row, start_row - 1, lines,
+                 (start_row, max(len(insert_tag) - 1, 0)))
+
+
+def _edit_to_markdown(buffer, cell_boundaries,
+                      first_line_contains_cell_header, cursor, insert_tag):
+    """Return the ``_Edit`` that turns the current cell into a markdown
+    cell, i.e., adds `` [markdown]`` to the header and puts the code in a
+    string."""
+    start_row, end_row = _get_current_cell_boundaries(cursor[0],
+                                                      cell_boundaries)
+    if end_row is None:
+        end_row = len(buffer)
+
+    if start_row == 1 and not first_line_contains_cell_header:
+        header = insert_tag
+        body = list(buffer[0:end_row])
+    else:
+        header = buffer[start_row-1]
+        body = list(buffer[start_row:end_row])
+
+    if body and body[-1] == '':
+        body.pop()
+    body.append('"""')
+    if end_row < len(buffer):
+        body.append('')
+
+    lines = [header + ' [markdown]', '"""'] + body
+    return _Edit(start_row, end_row, lines, (start_row + 2, 0))
+
+
+def _edit_split_cell(buffer, cell_boundaries, cursor, insert_tag):
+    """Return the ``_Edit`` that inserts a cell header above the cursor, or
+    None if the cursor is on the first row of a cell."""
+    row = cursor[0]
+    start_row, _ = _get_current_cell_boundaries(row, cell_boundaries)
+    if row == start_row:
+        return None
+
+    lines = [insert_tag]
+    if buffer[row-2] != '':
+        lines.insert(0, '')
+    return _Edit(row, row - 1, lines,
+                 (row + len(lines) - 1, max(len(insert_tag) - 1, 0)))
+
+
+def _edit_merge_cell(cell_boundaries, cursor):
+    """Return the ``_Edit`` that removes the header of the next cell, or None
+    if there is no next cell."""
+    i = bisect.bisect_right(cell_boundaries, cursor[0])
+    if i == len(cell_boundaries):
+        return None
+
+    header_row = cell_boundaries[i]
+    return _Edit(header_row, header_row, [], cursor)
+
+
+def _edit_move_cell(buffer, cell_boundaries,
+                    first_line_contains_cell_header, cursor, direction):
+    """Return the ``_Edit`` that swaps the current cell with the previous
+    (``direction`` -1) or next (``direction`` 1) cell, or None if there is no
+    such cell. A first cell without header is never moved."""
+    row, col = cursor
+    current = bisect.bisect_right(cell_boundaries, row) - 1
+    other = current + direction
+    if other < 0 or other >= len(cell_boundaries):
+        return None
+    if not first_line_contains_cell_header and 0 in (current, other):
+        return None
+
+    rows = cell_boundaries + [len(buffer) + 1]
+    first, second = sorted((current, other))
+    first_lines = buffer[rows[first]-1:rows[first+1]-1]
+    second_lines = buffer[rows[second]-1:rows[second+1]-1]
+
+    start_row = rows[first]
+    offset = row - rows[current]
+    if direction < 0:
+        new_row = start_row + offset
+    else:
+        new_row = start_row + len(second_lines) + offset
+    return _Edit(start_row, rows[second+1] - 1,
+                 list(second_lines) + list(first_lines), (new_row, col))
+
+
+def _edit_delete_cell(buffer, cell_boundaries, cursor):
+    """Return the ``_Edit`` that deletes the current cell."""
+    start_row, end_row = _get_current_cell_boundaries(cursor[0],
+                                                      cell_boundaries)
+    if end_row is None:
+        end_row = len(buffer)
+    return _Edit(start_row, end_row, [], (start_row, 0))
+
+
+def _error(*args, **kwargs):
+    """Print error message to stderr. Same parameters as print."""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def _apply_edit(edit):
+    """Apply ``edit`` to the current buffer and move the cursor.
+
+    The rows are replaced with a single slice assignment, so the edit is
+    made as one change and undone in one step.
+    """
+    buffer = vim.current.buffer
+    buffer[edit.start_row-1:edit.end_row] = edit.lines
+    row, col = edit.cursor
+    vim.current.window.cursor = (max(min(row, len(buffer)), 1), col)
+
+
+def _apply_line_changes(rows, changes, dirty=(), keep_deleted=False):
+    """Shift cached ``rows`` according to a sequence of line changes.
+
+    Parameters
+    ----------
+    rows : list
+        Sorted list of row numbers (1-indexed) that were valid before the
+        changes.
+    changes : list
+        List of ``(start, end, added)`` tuples in the order they were made,
+        using the same convention as Vim's ``listener_add()``: ``start`` is
+        the first changed row, ``end`` is the first row below the change
+        (before the change was made), and ``added`` is the number of rows
+        added (negative if rows were deleted).
+    dirty : list
+        Sorted list of ``(start, end)`` ranges that had already changed
+        before ``changes``. They are shifted and merged into the returned
+        ranges.
+    keep_deleted : bool
+        Set to True to also return empty ranges ``(start, start)`` where
+        rows were only deleted.
+
+    Returns
+    -------
+    list:
+        Sorted list of rows that are still valid after the changes, shifted
+        to their new positions. Rows inside changed ranges are dropped.
+    list:
+        Sorted list of ``(start, end)`` ranges (1-indexed, end exclusive) of
+        rows that have changed and must be scanned again.
+
+    """
+    rows = list(rows)
+    dirty = list(dirty)
+    for start, end, added in changes:
+        lo = bisect.bisect_left(rows, start)
+        hi = bisect.bisect_left(rows, end)
+        rows[lo:] = [row + added for row in rows[hi:]]
+
+        new_dirty = []
+        for dirty_start, dirty_end in dirty:
+            if dirty_end <= start:
+                new_dirty.append((dirty_start, dirty_end))
+            elif dirty_start >= end:
+                new_dirty.append((dirty_start + added, dirty_end + added))
+            else:
+                # Overlapping ranges are merged into the current change
+                start = min(start, dirty_start)
+                end = max(end, dirty_end)
+        if end + added > start or keep_deleted:
+            new_dirty.append((start, max(end + added, start)))
+        dirty = sorted(new_dirty)
+
+    return rows, dirty
+
+
+class _CellIndex(object):
+    """Sorted list of cell header rows for a buffer.
+
+    The index is cached by ``b:changedtick`` and, when the line changes made
+    since the last update are known, updated incrementally by rescanning only
+    the changed rows.
+
+    The ranges of rows that changed are also accumulated until they are
+    taken with ``take_changed_ranges``, so that the cell header highlighting
+    can be updated for these rows only.
+
+    The keys of the cells (see ``_get_cells``) are cached until a cell header
+    is added, removed or edited. The hash of the code and the stale sign of
+    each cell are cached in ``cell_states``, keyed by the first row of the
+    cell, and dropped when the cell changes. The ranges of rows around the
+    changes are accumulated until they are taken with
+    ``take_touched_ranges``, so that only the cells in these ranges need to
+    be hashed again.
+    """
+    def __init__(self):
+        self.key = None
+        self.changedtick = None
+        self.num_lines = 0
+        self.rows = []
+        self.changed_ranges = None
+        self.keys = None
+        self.cell_states = {}
+        self.touched_ranges = None
+        self.removed_signs = []
+
+    def update(self, buffer, changedtick, changes, key, scan):
+        """Bring the index up to date with ``buffer``.
+
+        Parameters
+        ----------
+        buffer : sequence
+            The lines of the buffer.
+        changedtick : int
+            Current value of ``b:changedtick``.
+        changes : list or None
+            Line changes made since the last update, see
+            ``_apply_line_changes``. Set to None if the changes are unknown,
+            which forces a full scan.
+        key : hashable
+            The options used to detect cell headers. The index is rebuilt if
+            the key changes.
+        scan : callable
+            Function that takes a list of lines and returns the (1-indexed)
+            rows among them that contain a cell header.
+
+        Returns
+        -------
+        list or None:
+            Ranges ``(start, end)`` of rows that were scanned again, or None
+            if the whole buffer was scanned.
+
+        """
+        if key == self.key and changedtick == self.changedtick:
+            return []
+
+        if key != self.key or self.changedtick is None or changes is None:
+            return self._rebuild(buffer, changedtick, key, scan)
+
+        rows, dirty = _apply_line_changes(self.rows, changes)
+        num_lines = self.num_lines + sum(added for _, _, added in changes)
+        if num_lines != len(buffer):
+            # Some change was not reported, start over
+            return self._rebuild(buffer, changedtick, key, scan)
+
+        num_rows = len(rows)
+        for start, end in dirty:
+            rows.extend(row + start - 1 for row in scan(buffer[start-1:end-1]))
+        rows.sort()
+
+        if len(rows) != len(self.rows) or len(rows) != num_rows:
+            # A cell header was added, removed or edited, which may change
+            # the keys of all cells
+            self.keys = None
+            self.touched_ranges = None
+
+        if self.changed_ranges is not None:
+            _, self.changed_ranges = _apply_line_changes(
+                [], changes, self.changed_ranges)
+
+        _, touched = _apply_line_changes([], changes, keep_deleted=True)
+        if self.touched_ranges is not None:
+            _, self.touched_ranges = _apply_line_changes(
+                [], changes, self.touched_ranges, keep_deleted=True)
+
+        self.rows = rows
+        self.changedtick = changedtick
+        self.num_lines = num_lines
+        self._shift_cell_states(changes, touched)
+        return dirty
+
+    def take_changed_ranges(self):
+        """Return the ranges ``(start, end)`` of rows (1-indexed, end
+        exclusive) that changed since the last call, or None if all rows may
+        have changed."""
+        ranges = self.changed_ranges
+        self.changed_ranges = []
+        return ranges
+
+    def take_touched_ranges(self):
+        """Return the ranges ``(start, end)`` of rows (1-indexed, end
+        exclusive, possibly empty where rows were deleted) that changed since
+        the last call, or None if all cells must be checked again."""
+        ranges = self.touched_ranges
+        self.touched_ranges = []
+        return ranges
+
+    def take_removed_signs(self):
+        """Return the ids of the signs of the cells whose state was dropped
+        since the last call."""
+        ids = self.removed_signs
+        self.removed_signs = []
+        return ids
+
+    def num_cells(self):
+        """Return the number of cells, including the cell without header at
+        the top of the buffer."""
+        return len(self.rows) + self._offset()
+
+    def position(self, row):
+        """Return the position (0-indexed) of the cell that contains
+        ``row``."""
+        return bisect.bisect_right(self.rows, row) - 1 + self._offset()
+
+    def positions_around(self, start, end):
+        """Return the positions of the cells whose code may have changed
+        when rows ``start`` to ``end`` (exclusive) changed, i.e., the cells
+        that contain these rows or the rows right above and below."""
+        return range(self.position(max(start - 1, 1)),
+                     self.position(max(end, start + 1) - 1) + 1)
+
+    def cell_hash(self, buffer, cell):
+        """Return the hash of the code of ``cell``, see ``_hash_cell``, cached
+        until the cell changes."""
+        state = self.cell_states.setdefault(cell.start_row, {})
+        if 'hash' not in state:
+            state['hash'] = _hash_cell(buffer, cell)
+        return state['hash']
+
+    def cell_keys(self, buffer):
+        """Return the keys of the cells that start at ``rows``, see
+        ``_get_cells``."""
+        if self.keys is None:
+            keys = []
+            occurrences = collections.defaultdict(int)
+            for row in self.rows:
+                header = buffer[row-1].strip()
+                keys.append((header, occurrences[header]))
+                occurrences[header] += 1
+            self.keys = keys
+        return self.keys
+
+    def get_cell(self, buffer, position):
+        """Return the ``_Cell`` at ``position`` (0-indexed) among all cells of
+        ``buffer``, including the cell without header at the top of the
+        buffer if the first row does not contain a cell header."""
+        offset = self._offset()
+        if position + 1 - offset < len(self.rows):
+            end_row = self.rows[position+1-offset] - 1
+        else:
+            end_row = len(buffer)
+
+        if position < offset:
+            return _Cell(1, end_row, 1, ("", 0))
+        start_row = self.rows[position-offset]
+        return _Cell(start_row, end_row, start_row + 1,
+                     self.cell_keys(buffer)[position-offset])
+
+    def _offset(self):
+        # Number of cells above the first cell header
+        return 0 if self.rows and self.rows[0] == 1 else 1
+
+    def _shift_cell_states(self, changes, touched):
+        states = self.cell_states
+        if not states:
+            return
+        if any(start == 1 for start, _, _ in changes):
+            # The top cell always starts at row 1, even if rows were
+            # inserted above it
+            self._drop_cell_state(states.pop(1, None))
+
+        for start, end, added in changes:
+            shifted = {}
+            for row, state in states.items():
+                if row < start:
+                    shifted[row] = state
+                elif row >= end:
+                    shifted[row + added] = state
+                else:
+                    self._drop_cell_state(state)
+            states = shifted
+
+        self.cell_states = states
+        offset = self._offset()
+        for start, end in touched:
+            # The first row of these cells did not change, only their code
+            for position in self.positions_around(start, end):
+                row = self.rows[position-offset] if position >= offset else 1
+                states.get(row, {}).pop('hash', None)
+
+    def _drop_cell_state(self, state):
+        if state is not None and 'sign' in state:
+            self.removed_signs.append(state['sign'][0])
+
+    def _rebuild(self, buffer, changedtick, key, scan):
+        self.changed_ranges = None
+        self.keys = None
+        for state in self.cell_states.values():
+            self._drop_cell_state(state)
+        self.cell_states = {}
+        self.touched_ranges = None
+        self.rows = scan(buffer[:])
+        self.key = key
+        self.changedtick = changedtick
+        self.num_lines = len(buffer)
+
+
+def _execute_rows(start_row, end_row, cell_boundaries,
+                  first_line_contains_cell_header, use_cpaste=False,
+                  runtime_key=None):
+    """Execute rows ``start_row`` to ``end_row`` (1-indexed, inclusive).
+
+    ``start_row`` must be the first row of a cell. If the rows span several
+    cells, cell headers other than the first one are sent as empty lines,
+    or as they are if ``g:ipython_cell_send_cell_headers`` is enabled, so
+    that the line numbers of the code are preserved.
+
+    Parameters
+    ----------
+    start_row, end_row : int
+        First and last rows to execute.
+    cell_boundaries : list
+        A sorted list of row numbers for the cell boundaries, including 1.
+    first_line_contains_cell_header : bool
+        True if the first row of the buffer is a cell header.
+    use_cpaste : bool
+        Set to True to use %cpaste instead of %paste to send the rows to
+        ipython.
+    runtime_key : tuple or None
+        If not None, the key returned by ``_get_runtime_key`` to record the
+        runtime of the rows in the runtime history with.
+
+    """
+    _execute_segments([(start_row, end_row)], cell_boundaries,
+                      first_line_contains_cell_header, use_cpaste,
+                      runtime_key)
+
+
+def _execute_segments(segments, cell_boundaries,
+                      first_line_contains_cell_header, use_cpaste=False,
+                      runtime_key=None):
+    """Execute several ranges of rows as a single block of code.
+
+    If cells delimited by tags have ``[session=<name>]`` annotations in
+    their headers, the rows are split into one block per session and each
+    block is sent to its session. Other cells are sent to the session of the
+    buffer.
+
+    Parameters
+    ----------
+    segments : list
+        Sorted list of ``(start_row, end_row)`` ranges (1-indexed, inclusive)
+        to execute. Each range must start at the first row of a cell.
+
+    See ``_execute_rows`` for the other parameters.
+
+    """
+    settings = _get_settings()
+    buffer = vim.current.buffer
+    default_session = _get_buffer_session()
+    if settings.delimit_cells_by == 'tags':
+        groups = _group_segments_by_session(buffer, segments,
+                                            cell_boundaries,
+                                            first_line_contains_cell_header,
+                                            default_session)
+    else:
+        groups = [(default_session, segments)]
+
+    blocks = []
+    for session, session_segments in groups:
+        lines, rows = _get_cell_lines(buffer, session_segments,
+                                      cell_boundaries,
+                                      first_line_contains_cell_header)
+        code, rows = _get_cell_code(lines, rows, buffer.name)
+        blocks.append((session, session_segments, lines, code, rows))
+
+    if settings.validate and not _validate_blocks(buffer, blocks):
+        _timings.cancel()
+        return
+
+    sent_segments = []
+    num_lines = num_bytes = 0
+    for session, session_segments, lines, code, rows in blocks:
+        sent = _send_segments(session, session_segments, lines, code,
+                              first_line_contains_cell_header, use_cpaste,
+                              runtime_key)
+        if sent is not None:
+            _output.record(buffer.number, rows)
+            sent_segments.extend(session_segments)
+            num_lines += sent[0]
+            num_bytes += sent[1]
+
+    if not sent_segments:
+        # No transport
+        _timings.cancel()
+        return
+
+    _record_executed_cells(sent_segments, cell_boundaries,
+                           first_line_contains_cell_header)
+
+    _timings.finish(num_lines, num_bytes, settings.trace_file)
+
+
+def _find_line_in_cell(buffer, row, text):
+    """Return the first row of the cell of ``buffer`` that contains ``row``
+    whose line is ``text``, ignoring surrounding whitespace, or None."""
+    settings = _get_settings()
+    cell_boundaries = [1]
+    if settings.delimit_cells_by == 'tags':
+        index = _get_cell_index(buffer, settings.tag, settings.regex)
+        cell_boundaries = sorted(set([1] + index.rows))
+    start_row, end_row = _get_current_cell_boundaries(row, cell_boundaries)
+    if end_row is None:
+        end_row = len(buffer)
+
+    text = text.strip()
+    for i, line in enumerate(buffer[start_row-1:end_row]):
+        if line.strip() == text:
+            return start_row + i
+    return None
+
+
+def _forget_buffer(bufnr):
+    """Drop cached data for buffer number ``bufnr``."""
+    _cell_indexes.pop(int(bufnr), None)
+    _executed_cells.pop(int(bufnr), None)
+
+
+class _Settings(object):
+    """Snapshot of the ``g:ipython_cell_*`` options.
+
+    Parameters
+    ----------
+    options : dict
+        The options as returned by ``ipython_cell#options()``, i.e., with the
+        ``ipython_cell_`` prefix removed from the keys.
+
+    """
+    def __init__(self, options):
+        self.delimit_cells_by = str(options['delimit_cells_by']).strip()
+        tag = options['tag']
+        self.tag = tag if isinstance(tag, list) else [tag]
+        regex_option = str(options['regex']).strip().lower()
+        self.regex = regex_option in ['1', 'y', 'yes', 't', 'true']
+        self.valid_marks = str(options['valid_marks']).strip()
+        self.insert_tag = options['insert_tag']
+        self.cell_command = options['cell_command']
+        self.run_command = options['run_command']
+        self.prefer_external_copy = _is_enabled(
+            options['prefer_external_copy'])
+        self.send_cell_headers = _is_enabled(options['send_cell_headers'])
+        self.send_ctrl_c = _is_enabled(options['send_ctrl_c'])
+        self.send_ctrl_u = _is_enabled(options['send_ctrl_u'])
+        self.update_file_variable = _is_enabled(
+            options['update_file_variable'])
+        self.slime_python_ipython = _is_enabled(
+            options.get('slime_python_ipython', 0))
+        self.transport = str(options['transport']).strip()
+        self.kernel_connection_file = options['kernel_connection_file']
+        self.tmpfile_command = options['tmpfile_command']
+        self.stale_signs = _is_enabled(options['stale_signs'])
+        self.trace_file = options['trace_file']
+        self.checkpoint_dir = options['checkpoint_dir']
+        self.output_lines = max(int(options['output_lines']), 1)
+        self.validate = _is_enabled(options['validate'])
+        self.tmux_target = str(options['tmux_target']).strip()
+        self.tmux_socket = str(options['tmux_socket']).strip()
+        self.runtime_history = _is_enabled(options['runtime_history'])
+        self.runtime_history_file = options['runtime_history_file']
+        self.runtime_regression = float(options['runtime_regression'])
+        sessions = options.get('sessions', {})
+        self.sessions = sessions if isinstance(sessions, dict) else {}
+        self.send_async = (_is_enabled(options['send_async'])
+                           and _is_enabled(options.get('has_timers', 0)))
+        self.has_clipboard = _is_enabled(options.get('has_clipboard', 0))
+        self.has_getmarklist = _is_enabled(options.get('has_getmarklist', 0))
+
+
+def _format_profile(result, buffer, filename, rows, limit=200):
+    """Format the profile ``result`` written by ``_PROFILE_DRIVER``.
+
+    Parameters
+    ----------
+    result : dict
+        The results.
+    buffer : sequence
+        The lines of the profiled buffer.
+    filename : str
+        The file name the cell was compiled with.
+    rows : tuple
+        The first and last rows of the cell.
+    limit : int
+        Maximum number of entries to show.
+
+    Returns
+    -------
+    tuple:
+        The lines to show, and a dict of line numbers (1-indexed, as
+        strings) of the lines that refer to rows of ``buffer`` to the rows.
+
+    """
+    mode = result.get('mode', 'prun')
+    lines = ["%{} of rows {}-{} of {}".format(mode, rows[0], rows[1],
+                                             os.path.basename(filename)),
+             ""]
+    jumps = {}
+
+    if 'error' in result:
+        lines.append("Error: {}".format(result['error']))
+    elif mode == 'timeit':
+        timeit = result['timeit']
+        lines.append("{} per loop (mean +- std. dev. of {} runs, {} loops "
+                     "each)".format(_format_time(timeit['average']),
+                                    timeit['repeat'], timeit['loops']))
+        lines.append("best {}, std. dev. {}".format(
+            _format_time(timeit['best']), _format_time(timeit['stdev'])))
+    elif mode == 'lprun':
+        timings = collections.defaultdict(lambda: [0, 0.0])
+        for row, hits, seconds in result['timings']:
+            timings[row][0] += hits
+            timings[row][1] += seconds
+        total = sum(seconds for _, seconds in timings.values()) or 1.0
+
+        lines.append("{:>7}{:>10}{:>12}{:>8}  {}".format(
+            "row", "hits", "time", "%time", "line"))
+        for row, (hits, seconds) in sorted(
+                timings.items(), key=lambda item: -item[1][1])[:limit]:
+            text = buffer[row-1].strip() if 0 < row <= len(buffer) else ""
+            jumps[str(len(lines) + 1)] = row
+            lines.append("{:>7}{:>10}{:>12}{:>8.1f}  {}".format(
+                row, hits, _format_time(seconds), 100 * seconds / total,
+                text))
+    else:
+        lines.append("{:>9}{:>12}{:>12}  {}".format(
+            "ncalls", "tottime", "cumtime", "function"))
+        for path, row, function, ncalls, tottime, cumtime in sorted(
+                result['stats'], key=lambda entry: (-entry[5], -entry[4])
+        )[:limit]:
+            # %prun strips the directories of the file names
+            if os.path.basename(path) == os.path.basename(filename):
+                # The code of the cell itself is reported at row 1
+                jumps[str(len(lines) + 1)] = (rows[0] if function == '<module>'
+                                              else row)
+            if path == '~':
+                location = function
+            else:
+                location = "{}:{}({})".format(os.path.basename(path), row,
+                                              function)
+            lines.append("{:>9}{:>12}{:>12}  {}".format(
+                ncalls, _format_time(tottime), _format_time(cumtime),
+                location))
+
+    return lines, jumps
+
+
+def _format_time(seconds):
+    """Format ``seconds`` with 3 significant digits and a suitable unit."""
+    for unit, scale in [("s", 1.0), ("ms", 1e-3), ("us", 1e-6)]:
+        if abs(seconds) >= scale:
+            return "{:.3g} {}".format(seconds / scale, unit)
+    return "{:.3g} ns".format(seconds / 1e-9)
+
+
+def _get_runtime_dir():
+    """Return a directory for temporary files, preferably in memory."""
+    for directory in [os.environ.get('XDG_RUNTIME_DIR'), '/dev/shm']:
+        if (directory and os.path.isdir(directory)
+                and os.access(directory, os.W_OK)):
+            return directory
+    return tempfile.gettempdir()
+
+
+def _get_settings():
+    """Return the cached ``_Settings``, loading them from Vim if needed."""
+    global _settings
+    if _settings is None:
+        with _timings.phase('config'):
+            _settings = _Settings(vim.eval('ipython_cell#options()'))
+    return _settings
+
+
+def _get_transport(session=None):
+    """Return the transport of ``session``.
+
+    The empty session uses ``g:ipython_cell_transport``. Other sessions are
+    configured in ``g:ipython_cell_sessions`` and fall back to the global
+    options. If ``session`` is None, the session of the current buffer is
+    used.
+
+    Return None and print an error message if the session or transport is
+    unknown, or the transport cannot be created.
+    """
+    settings = _get_settings()
+    if session is None:
+        session = _get_buffer_session()
+
+    if session:
+        options = settings.sessions.get(session)
+        if options is None:
+            _error("Unknown session, add it to g:ipython_cell_sessions: {}"
+                   .format(session))
+            return None
+    else:
+        options = {}
+    name = str(options.get('transport', settings.transport)).strip()
+    if name == 'jupyter':
+        address = options.get('kernel_connection_file',
+                              settings.kernel_connection_file)
+    elif name == 'tmux':
+        address = (options.get('tmux_socket', settings.tmux_socket),
+                   options.get('tmux_target', settings.tmux_target))
+    else:
+        address = None
+
+    key = (session, name, address)
+    try:
+        transport = _transports[key]
+    except KeyError:
+        transport = _create_transport(name, address, session)
+        if transport is None:
+            return None
+        _transports[key] = transport
+
+    if settings.send_async:
+        return _QueuedTransport(transport, _get_send_queue(session))
+    else:
+        return transport
+
+
+def _create_transport(name, address=None, session=''):
+    """Create the transport ``name`` for ``session``, or return None.
+
+    ``address`` is the kernel connection file for the ``jupyter`` transport
+    and ``(socket, target)`` for the ``tmux`` transport.
+    """
+    if name == 'slime':
+        transport = _SlimeTransport(session)
+    elif name == 'tmpfile':
+        transport = _TmpfileTransport(session=session)
+    elif name == 'jupyter':
+        try:
+            transport = _JupyterTransport.from_connection_file(address)
+        except Exception as e:
+            _error("Could not connect to Jupyter kernel: {}".format(e))
+            return None
+    elif name == 'tmux':
+        socket, target = address
+        if not target:
+            # Use the target of vim-slime
+            config = vim.eval('ipython_cell#slime_config({})'
+                              .format(_sanitize(session)))
+            socket = socket or config.get('socket_name', '')
+            target = config.get('target_pane', '')
+        if not target:
+            _error("No tmux target, set g:ipython_cell_tmux_target")
+            return None
+        transport = _TmuxTransport(target, socket)
+    else:
+        _error("Invalid option value for g:ipython_cell_transport: {}"
+               .format(name))
+        return None
+
+    return transport
+
+
+def _group_segments_by_session(buffer, segments, cell_boundaries,
+                               first_line_contains_cell_header,
+                               default_session=''):
+    """Split ``segments`` into groups of consecutive cells of the same
+    session.
+
+    The session of a cell is given by a ``[session=<name>]`` annotation in
+    its header, or ``default_session`` if there is none.
+
+    Returns
+    -------
+    list:
+        ``[(session, segments), ...]`` in the order of ``segments``.
+
+    """
+    groups = []
+    for start_row, end_row in segments:
+        first = bisect.bisect_left(cell_boundaries, start_row)
+        last = bisect.bisect_right(cell_boundaries, end_row)
+        starts = cell_boundaries[first:last] or [start_row]
+        for i, row in enumerate(starts):
+            session = default_session
+            if row != 1 or first_line_contains_cell_header:
+                session = _get_header_session(buffer[row-1]) or session
+            end = starts[i+1] - 1 if i + 1 < len(starts) else end_row
+
+            if groups and groups[-1][0] == session:
+                session_segments = groups[-1][1]
+                if session_segments[-1][1] == row - 1:
+                    session_segments[-1] = (session_segments[-1][0], end)
+                else:
+                    session_segments.append((row, end))
+            else:
+                groups.append((session, [(row, end)]))
+    return groups
+
+
+def _hash_cell(buffer, cell):
+    """Return a hash of the code in ``cell``."""
+    code = "\n".join(buffer[cell.code_start_row-1:cell.end_row])
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+
+def _is_enabled(value):
+    """Return False if the option ``value`` is 0, otherwise True."""
+    return str(value) != '0'
+
+
+def _get_buffer_changes(bufnr):
+    """Return buffer number, changedtick and pending line changes of buffer
+    number ``bufnr``.
+
+    The changes are None if they could not be tracked, e.g. because change
+    listeners are not supported or the buffer was reloaded.
+    """
+    bufnr, changedtick, changes = vim.eval(
+        'ipython_cell#buffer_changes({})'.format(int(bufnr)))
+    if isinstance(changes, list):
+        changes = [tuple(int(value) for value in change)
+                   for change in changes]
+    else:
+        changes = None
+    return int(bufnr), int(changedtick), changes
+
+
+def _get_buffer_session():
+    """Return the session of the current buffer, set by
+    ``b:ipython_cell_session``, or '' for the default session."""
+    session = vim.current.buffer.vars.get('ipython_cell_session', '')
+    if isinstance(session, bytes):
+        session = session.decode('utf-8')
+    return session
+
+
+def _get_buffer_notebook():
+    """Return the path of the notebook of the current buffer, set by
+    ``b:ipython_cell_notebook``, or ''."""
+    path = vim.current.buffer.vars.get('ipython_cell_notebook', '')
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+    return path
+
+
+def _get_cell_boundaries(auto_include_first_line=True):
+    """Return a list of rows (1-indexed) for all cell boundaries.
+
+    Parameters
+    ----------
+    auto_include_first_line : bool
+        If True (default), include first line of the buffer automatically in
+        the returned list even if it does not contain a cell header.
+
+    """
+    buffer = vim.current.buffer
+    settings = _get_settings()
+    delimiter = settings.delimit_cells_by
+
+    with _timings.phase('boundaries'):
+        if delimiter == 'marks':
+            if settings.has_getmarklist:
+                rows = _get_rows_with_marklist(buffer.number,
+                                               settings.valid_marks)
+            else:
+                rows = _get_rows_with_marks(buffer, settings.valid_marks)
+            cell_boundaries = sorted(set(rows))
+        elif delimiter == 'tags':
+            index = _get_cell_index(buffer, settings.tag, settings.regex)
+            cell_boundaries = list(index.rows)
+        else:
+            _error("Invalid option value for g:ipython_cell_valid_marks: {}"
+                   .format(delimiter))
+            return
+
+    if auto_include_first_line and (not cell_boundaries
+                                    or cell_boundaries[0] != 1):
+        # Include beginning of buffer as a cell boundary
+        cell_boundaries.insert(0, 1)
+
+    return cell_boundaries
+
+
+def _get_cell_boundaries_with_first_line():
+    """Return the cell boundaries, always including the first row.
+
+    Returns
+    -------
+    list:
+        A sorted list of row numbers (1-indexed) for all cell boundaries.
+    bool:
+        True if the first row contains a cell header.
+
+    """
+    cell_boundaries = _get_cell_boundaries(auto_include_first_line=False)
+
+    # Include first line of buffer if necessary
+    first_line_contains_cell_header = 1 in cell_boundaries
+    if not first_line_contains_cell_header:
+        cell_boundaries.insert(0, 1)
+
+    return cell_boundaries, first_line_contains_cell_header
+
+
+def _get_cell_index(buffer, tags, use_regex=False):
+    """Return the up-to-date ``_CellIndex`` of tag rows for ``buffer``."""
+    bufnr, changedtick, changes = _get_buffer_changes(buffer.number)
+    if not isinstance(tags, list):
+        tags = [tags]
+
+    index = _cell_indexes.setdefault(bufnr, _CellIndex())
+    index.update(buffer, changedtick, changes, key=(tuple(tags), use_regex),
+                 scan=lambda lines: _get_rows_with_tag(lines, tags, use_regex))
+    return index
+
+
+_Cell = collections.namedtuple(
+    '_Cell', ['start_row', 'end_row', 'code_start_row', 'key'])
+
+
+def _get_cells(buffer, cell_boundaries, first_line_contains_cell_header,
+               delimit_by_tags=None):
+    """Return a list of ``_Cell`` for all cells in ``buffer``.
+
+    Each cell is identified by a key that consists of its header line (empty
+    if the cell has no header) and the number of cells above it with the same
+    header, so that a cell keeps its key when other cells are edited.
+
+    Parameters
+    ----------
+    buffer : sequence
+        The lines of the buffer.
+    cell_boundaries : list
+        A sorted list of row numbers for the cell boundaries, including 1.
+    first_line_contains_cell_header : bool
+        True if the first row of the buffer is a cell header.
+    delimit_by_tags : bool or None
+        True if cells are delimited by tags. If None, use
+        ``g:ipython_cell_delimit_cells_by``.
+
+    """
+    if delimit_by_tags is None:
+        delimit_by_tags = _get_settings().delimit_cells_by == 'tags'
+
+    cells = []
+    occurrences = collections.defaultdict(int)
+    for i, start_row in enumerate(cell_boundaries):
+        if i + 1 < len(cell_boundaries):
+            end_row = cell_boundaries[i+1] - 1
+        else:
+            end_row = len(buffer)
+
+        if delimit_by_tags and (start_row != 1
+                                or first_line_contains_cell_header):
+            header = buffer[start_row-1].strip()
+            code_start_row = start_row + 1
+        else:
+            header = ""
+            code_start_row = start_row
+
+        key = (header, occurrences[header])
+        occurrences[header] += 1
+        cells.append(_Cell(start_row, end_row, code_start_row, key))
+
+    return cells
+
+
+def _get_cells_in_segments(buffer, segments, cell_boundaries,
+                           first_line_contains_cell_header):
+    """Return a list of ``_Cell`` for the cells that start in ``segments``,
+    see ``_get_cells``.
+
+    Unlike ``_get_cells``, the headers of the other cells are not read: when
+    cells are delimited by tags, the keys are taken from the ``_CellIndex``
+    of the buffer.
+
+    Parameters
+    ----------
+    buffer : sequence
+        The lines of the buffer.
+    segments : list
+        List of ``(start_row, end_row)`` tuples (1-indexed, inclusive).
+    cell_boundaries : list
+        A sorted list of row numbers for the cell boundaries, including 1.
+    first_line_contains_cell_header : bool
+        True if the first row of the buffer is a cell header.
+
+    """
+    index = None
+    if _get_settings().delimit_cells_by == 'tags':
+        index = _cell_indexes[buffer.number]
+
+    cells = []
+    for start_row, end_row in segments:
+        first = bisect.bisect_left(cell_boundaries, start_row)
+        last = bisect.bisect_right(cell_boundaries, end_row)
+        for i in range(first, last):
+            if index is not None:
+                cells.append(index.get_cell(buffer, i))
+                continue
+            if i + 1 < len(cell_boundaries):
+                cell_end_row = cell_boundaries[i+1] - 1
+            else:
+                cell_end_row = len(buffer)
+            cells.append(_Cell(cell_boundaries[i], cell_end_row,
+                               cell_boundaries[i], ("", i)))
+    return cells
+
+
+def _get_outline(buffer, cell_boundaries):
+    """Return location list items for the cell headers at
+    ``cell_boundaries``."""
+    return [{'bufnr': buffer.number, 'lnum': row,
+             'text': buffer[row-1].strip()}
+            for row in cell_boundaries]
+
+
+def _get_cell_names(buffer, cell):
+    """Return the names defined and used by ``cell``, see ``_get_names``.
+
+    Results are cached by the hash of the code of the cell.
+    """
+    digest = _hash_cell(buffer, cell)
+    try:
+        return _cell_names[digest]
+    except KeyError:
+        pass
+
+    if len(_cell_names) > 10000:
+        _cell_names.clear()
+    code = "\n".join(buffer[cell.code_start_row-1:cell.end_row])
+    names = _cell_names[digest] = _get_names(code)
+    return names
 
 
 def _get_current_cell_boundaries(current_row, cell_boundaries):
     """Return the start and end row numbers (1-indexed) for the current cell.
 
-    Parameters
-    ----------
-    current_row : int
-        Current row number.
-    cell_boundaries : list
-        A list of row numbers for the cell boundaries.
+    Parameters
+    ----------
+    current_row : int
+        Current row number.
+    cell_boundaries : list
+        A sorted list of row numbers for the cell boundaries.
+
+    Returns
+    -------
+    int:
+        Start row number for the current cell.
+    int:
+        End row number for the current cell.
+
+    """
+    i = bisect.bisect_right(cell_boundaries, current_row)
+    start_row = cell_boundaries[i-1] if i > 0 else None
+
+    if i == len(cell_boundaries):
+        end_row = None  # end of file
+    else:
+        end_row = cell_boundaries[i] - 1
+
+    return start_row, end_row
+
+
+def _get_next_cell(current_row, cell_boundaries):
+    """Return start row number of the next cell.
+
+    If there is no next cell, the current row number is returned.
+
+    Parameters
+    ----------
+    current_row : int
+        Current row number.
+    cell_boundaries : list
+        A sorted list of row numbers for the cell boundaries.
+
+    Returns
+    -------
+    int:
+        Start row number for the next cell.
+
+    """
+    i = bisect.bisect_right(cell_boundaries, current_row)
+    if i == len(cell_boundaries):
+        return current_row
+    else:
+        return cell_boundaries[i]
+
+
+def _get_prev_cell(current_row, cell_boundaries):
+    """Return start row number of the current or previous cell.
+
+    If ``current_row`` is a cell header, the previous cell header is returned,
+    otherwise the current cell header is returned.
+
+    If there is no previous cell, the current row number is returned.
+
+    Parameters
+    ----------
+    current_row : int
+        Current row number.
+    cell_boundaries : list
+        A sorted list of row numbers for the cell boundaries.
+
+    Returns
+    -------
+    int:
+        Start row number for the current or previous cell.
+
+    """
+    i = bisect.bisect_left(cell_boundaries, current_row)
+    if i == 0:
+        return current_row
+    else:
+        return cell_boundaries[i-1]
+
+
+def _get_header_session(header):
+    """Return the name in a ``[session=<name>]`` annotation of the cell
+    header ``header``, or None."""
+    match = _session_pattern.search(header)
+    return match.group(1) if match is not None else None
+
+
+def _get_names(code):
+    """Return the module-level names defined and used by ``code``.
+
+    Parameters
+    ----------
+    code : str
+        Python code. IPython magics and shell commands are ignored.
+
+    Returns
+    -------
+    tuple or None:
+        A set of names that are defined, and a set of names that are used
+        before they are defined, or None if ``code`` cannot be parsed. Names
+        used inside functions are included in the used names, unless they
+        are local to the function.
+
+    """
+    try:
+        module = ast.parse(_mask_ipython_syntax(textwrap.dedent(code)))
+    except (SyntaxError, ValueError):
+        return None
+
+    defined = set()
+    used = set()
+    for statement in module.body:
+        collector = _NameCollector()
+        collector.visit(statement)
+        used.update(collector.used - defined)
+        defined.update(collector.defined)
+
+    return defined, used
+
+
+def _get_upstream_cells(names, index):
+    """Return the indices of the cells that cell ``index`` depends on.
+
+    Parameters
+    ----------
+    names : list
+        The defined and used names of each cell, as returned by
+        ``_get_names``. None for cells that could not be parsed.
+    index : int
+        Index of the cell to find the dependencies of.
+
+    Returns
+    -------
+    set:
+        Indices of all cells above cell ``index`` that it depends on,
+        directly or indirectly.
+
+    """
+    upstream = set()
+    pending = [index]
+    while pending:
+        i = pending.pop()
+        if names[i] is None:
+            continue
+        for name in names[i][1]:
+            # The last cell above that defines the name
+            for j in range(i - 1, -1, -1):
+                if names[j] is not None and name in names[j][0]:
+                    if j not in upstream:
+                        upstream.add(j)
+                        pending.append(j)
+                    break
+
+    return upstream
+
+
+def _get_runtime_key(buffer, start_row, end_row,
+                     first_line_contains_cell_header):
+    """Return the key to record the runtime of the cell at ``start_row`` to
+    ``end_row`` in the runtime history with.
+
+    Returns
+    -------
+    tuple:
+        ``(bufnr, path, cell_hash, start_row)``.
+
+    """
+    code_start_row = start_row
+    if _get_settings().delimit_cells_by == 'tags' and (
+            start_row != 1 or first_line_contains_cell_header):
+        code_start_row += 1
+    cell = _Cell(start_row, end_row, code_start_row, None)
+    path = os.path.abspath(buffer.name) if buffer.name else ''
+    return (buffer.number, path, _hash_cell(buffer, cell), start_row)
+
+
+def _get_rows_with_tag(buffer, tags, use_regex=False):
+    """Return a list of row numbers for lines containing tag in ``tags``.
+
+    Parameters
+    ----------
+    buffer : iterable
+        An iterable object that contains the lines of a buffer.
+    tags : list or str
+        Tag(s) to search for.
+    use_regex : bool
+        If True, interpret ``tags`` as regular expressions.
+
+    Returns
+    -------
+    list:
+        List of row numbers.
+
+    """
+    if not isinstance(tags, list):
+        tags = [tags]
+
+    search = _get_tag_matcher(tuple(tags), use_regex)
+    # rows are counted from 1
+    return [i for i, line in enumerate(buffer, 1) if search(line)]
+
+
+def _get_tag_matcher(tags, use_regex=False):
+    """Return a function that searches a line for any tag in ``tags``.
+
+    Tags are compiled into a single regular expression, so that each line is
+    searched only once regardless of the number of tags. Regular expressions
+    with groups (and therefore back references) or global inline flags are
+    compiled separately, since combining them would renumber their groups or
+    apply their flags to the other tags. Matchers are cached by the tags and
+    ``use_regex``.
+
+    Parameters
+    ----------
+    tags : tuple
+        Tags to search for.
+    use_regex : bool
+        If True, interpret ``tags`` as regular expressions.
+
+    Returns
+    -------
+    callable:
+        Function that takes a line and returns a truthy value if the line
+        contains a tag.
+
+    """
+    key = (tags, use_regex)
+    try:
+        return _tag_matchers[key]
+    except KeyError:
+        pass
+
+    patterns = []
+    searches = []
+    if not use_regex:
+        patterns = [re.escape(tag) for tag in tags]
+    else:
+        default_flags = re.compile('').flags
+        for tag in tags:
+            compiled = re.compile(tag)
+            if compiled.groups or compiled.flags != default_flags:
+                searches.append(compiled.search)
+            else:
+                patterns.append("(?:{})".format(tag))
+
+    if patterns:
+        searches.insert(0, re.compile("|".join(patterns)).search)
+
+    if not searches:
+        def search(line):
+            return False
+    elif len(searches) == 1:
+        search = searches[0]
+    else:
+        def search(line):
+            return any(s(line) for s in searches)
+
+    _tag_matchers[key] = search
+    return search
+
+
+def _get_rows_with_marks(buffer, valid_marks):
+    """Return a list of row numbers for lines containing a mark.
+
+    Parameters
+    ----------
+    buffer : buffer object
+        An object with a ``mark`` method.
+    valid_marks : list
+        A list of marks to search for.
+
+    Returns
+    -------
+    list:
+        List of row numbers.
+
+    """
+    rows_containing_marks = []
+    for mark in valid_marks:
+        mark_loc = buffer.mark(mark)
+        if mark_loc is not None and mark_loc[0] != 0:
+            rows_containing_marks.append(mark_loc[0])
+
+    return rows_containing_marks
+
+
+def _get_rows_with_marklist(bufnr, valid_marks):
+    """Same as ``_get_rows_with_marks``, but get all marks of buffer
+    ``bufnr`` at once using ``getmarklist()``."""
+    rows = vim.eval('ipython_cell#mark_rows({}, {})'
+                    .format(int(bufnr), _sanitize(valid_marks)))
+    return [int(row) for row in rows]
+
+
+class _JupyterTransport(object):
+    """Send code directly to a running Jupyter kernel.
+
+    Code is submitted as ``execute_request`` messages, without going through
+    the clipboard or a terminal. The replies are not waited for.
+
+    Parameters
+    ----------
+    client : jupyter_client.KernelClient
+        A client with started channels.
+
+    """
+    def __init__(self, client):
+        self.client = client
+        self.last_code = None
+
+    @classmethod
+    def from_connection_file(cls, connection_file=''):
+        """Connect to the kernel described by ``connection_file``.
 
-    Returns
-    -------
-    int:
-        Start row number for the current cell.
-    int:
-        End row number for the current cell.
+        If ``connection_file`` is empty, connect to the most recently started
+        kernel.
+        """
+        from jupyter_client import BlockingKernelClient, find_connection_file
+
+        if not connection_file:
+            connection_file = find_connection_file()
+        client = BlockingKernelClient(connection_file=connection_file)
+        client.load_connection_file()
+        client.start_channels()
+        return cls(client)
+
+    def execute(self, code):
+        self.last_code = code
+        return self.client.execute(code, allow_stdin=False)
+
+    def send_keys(self, string):
+        # There is no prompt to edit
+        pass
+
+    def clear_prompt(self):
+        pass
+
+    def send_command(self, string):
+        if string:
+            self.execute(string)
 
+    def send_cell(self, cell):
+        self.execute(cell)
+
+    def send_cell_verbose(self, cell):
+        self.execute(cell)
+
+    def previous_command(self):
+        if self.last_code is not None:
+            self.execute(self.last_code)
+
+    def restart(self, shell_prev_cmd):
+        # ipython-cell only connects to kernels, it does not start them. A
+        # shutdown request with restart=True makes the kernel exit, and it is
+        # only started again if the process that started it manages it with
+        # a KernelManager that restarts it, e.g. a Jupyter server.
+        self.client.shutdown(restart=True)
+
+
+def _call(func, *args):
+    """Send queue operation that calls ``func(*args)`` once."""
+    func(*args)
+    return
+    yield  # make this function a generator
+
+
+def _is_control_sequence(string):
+    """Return True if ``string`` contains only control characters."""
+    return all(ord(char) < 32 for char in string)
+
+
+def _mask_ipython_syntax(code):
+    """Replace lines with IPython magics, shell commands, help requests (e.g.
+    ``?obj`` or ``obj??``) and autocalls (e.g. ``/f a``) by ``pass``, keeping
+    the indentation and line numbers.
+
+    Only lines that start a logical line are masked, not e.g. a line that
+    starts with ``%`` within brackets, a string or after a backslash.
     """
-    next_cell_row = None
-    for boundary in cell_boundaries:
-        if boundary <= current_row:
-            start_row = boundary
-        else:
-            next_cell_row = boundary
+    lines = code.split("\n")
+    depth = 0
+    string = None
+    continued = False
+    for i, line in enumerate(lines):
+        if depth == 0 and string is None and not continued:
+            match = _ipython_syntax_pattern.match(line)
+            if match is not None:
+                lines[i] = match.group(1) + "pass"
+                continue
+        depth, string, continued = _scan_line(line, depth, string)
+    return "\n".join(lines)
+
+
+def _scan_line(line, depth, string):
+    """Return the bracket depth and the open string after the line ``line``
+    of Python code, and True if it ends with a backslash continuation.
+
+    ``depth`` and ``string`` are the bracket depth and the quotes of the
+    string that is open (or None) before the line.
+    """
+    continued = False
+    pos = 0
+    while True:
+        match = _line_token_pattern.search(line, pos)
+        if match is None:
             break
+        token = match.group()
+        pos = match.end()
+        if token == '\\':
+            if pos == len(line):
+                continued = True
+            elif string is not None:
+                pos += 1  # escaped character
+        elif string is not None:
+            if token[0] == string[0] and len(token) >= len(string):
+                # e.g. "a""" is "a" followed by an empty string
+                string = None
+        elif token == '#':
+            break
+        elif token[0] in '"\'':
+            string = token
+        elif token in '([{':
+            depth += 1
+        else:
+            depth = max(depth - 1, 0)
+
+    if string is not None and len(string) == 1 and not continued:
+        # Unterminated string, a syntax error
+        string = None
+    return depth, string, continued
+
+
+_ipython_syntax_pattern = re.compile(
+    r"^([\t ]*)(?:(?:[A-Za-z_][\w, ]*=[\t ]*)?[%!].*|\?.*"
+    r"|[,;/][A-Za-z_][\w.]*(?:[\t ].*)?|[^#\s][^#\n]*\?)$")
+
+_line_token_pattern = re.compile(r'"""|\'\'\'|["\'#\\()\[\]{}]')
+
+
+_session_pattern = re.compile(r'\[session=([^\]\s]+)\]')
+
+
+# Script run with _run_helper_command to copy the output of IPython to a log
+# file. The log is installed once and pointed to a new file when run again. In
+# a kernel, tracebacks and results are sent to the frontend instead of stdout,
+# so they are written to the log separately.
+_OUTPUT_HELPER = """\
+def _ipython_cell_output(path, max_bytes):
+    import io, os, sys
+
+    class Log(object):
+        def __init__(self, shell):
+            self.shell = shell
+            self.file = None
+            self.marker = None
+            self.written = 0
+
+        def open(self, path, max_bytes):
+            if self.file is not None:
+                self.file.close()
+            self.file = io.open(path, 'a', encoding='utf-8',
+                                errors='replace', buffering=1)
+            self.max_bytes = max_bytes
+
+        def write(self, data):
+            if self.marker is not None:
+                marker, self.marker = self.marker, None
+                self.write(marker)
+            self.written += len(data)
+            if self.written > self.max_bytes // 16:
+                self.written = 0
+                if os.fstat(self.file.fileno()).st_size > self.max_bytes:
+                    self.file.truncate(0)
+            self.file.write(data)
+
+        def pre_run_cell(self, *args):
+            self.marker = 'In [{}]:\\n'.format(self.shell.execution_count)
+
+        def post_run_cell(self, result):
+            if result.result is not None:
+                data, _ = self.shell.display_formatter.format(result.result)
+                self.write('Out[{}]: {}\\n'.format(
+                    result.execution_count, data.get('text/plain', '')))
+
+    class Tee(object):
+        def __init__(self, stream, log):
+            self.stream = stream
+            self.log = log
+
+        def write(self, data):
+            try:
+                self.log.write(data)
+            except Exception:
+                pass
+            return self.stream.write(data)
+
+        def writelines(self, lines):
+            for line in lines:
+                self.write(line)
+
+        def __getattr__(self, name):
+            return getattr(self.stream, name)
+
+    log = globals().get('_ipython_cell_output_log')
+    if log is None:
+        ip = get_ipython()
+        log = Log(ip)
+        sys.stdout = Tee(sys.stdout, log)
+        sys.stderr = Tee(sys.stderr, log)
+        ip.events.register('pre_run_cell', log.pre_run_cell)
+        if hasattr(ip, 'kernel'):
+            ip.events.register('post_run_cell', log.post_run_cell)
+            showtraceback = ip._showtraceback
+
+            def _showtraceback(etype, evalue, stb):
+                log.write(ip.InteractiveTB.stb2text(stb) + '\\n')
+                return showtraceback(etype, evalue, stb)
+            ip._showtraceback = _showtraceback
+    log.open(path, max_bytes)
+    return log
+
+
+_ipython_cell_output_log = _ipython_cell_output(
+    __import__('sys').argv[1], int(__import__('sys').argv[2]))
+del _ipython_cell_output
+"""
+
+# Size of the log file at which IPython truncates it
+_OUTPUT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class _OutputPane(object):
+    """Output of IPython, tailed into a scratch buffer.
+
+    ``open`` makes IPython copy everything it writes to stdout and stderr to
+    a log file in a private directory. A Vim timer then appends the lines
+    written since the last poll to the buffer, keeping at most
+    ``g:ipython_cell_output_lines`` lines, so the buffer and the work per
+    poll do not grow with the output. The rows of the code sent for recent
+    executions are kept to find the code that a traceback line refers to.
+    """
+    def __init__(self):
+        self.directory = None
+        self.path = None
+        self.offset = 0
+        self.bufnr = None
+        self.timer = None
+        self.blocks = collections.deque(maxlen=50)
+
+    def open(self):
+        session = _get_buffer_session()
+        if _get_transport(session) is None:
+            return
+
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='ipython-cell-output-',
+                                              dir=_get_runtime_dir())
+            atexit.register(self.cleanup)
+            with open(self.helper_path, 'wb') as f:
+                f.write(_OUTPUT_HELPER.encode('utf-8'))
+
+        path = os.path.join(self.directory, 'output-{}.log'.format(
+            re.sub(r'[^\w.-]', '_', session or 'default')))
+        if path != self.path:
+            self.path = path
+            self.offset = (os.path.getsize(path) if os.path.exists(path)
+                           else 0)
+
+        _clear_prompt(session)
+        _send_command(_run_helper_command(self.helper_path, [
+            '"{}"'.format(path), _OUTPUT_MAX_BYTES]), session)
+        self.bufnr = int(vim.eval('ipython_cell#open_output()'))
+        self.unschedule()
+        self.schedule()
+
+    @property
+    def helper_path(self):
+        return os.path.join(self.directory, 'output.py')
+
+    def poll(self):
+        if self.bufnr is None:
+            return
+        settings = _get_settings()
+        lines = self.read(settings.output_lines * 256)
+        if lines:
+            vim.eval('ipython_cell#append_output({}, {}, {})'.format(
+                self.bufnr, json.dumps(lines), settings.output_lines))
+
+    def read(self, max_bytes):
+        """Return the complete lines written to the log file since the last
+        call, without terminal escape sequences.
+
+        If more than ``max_bytes`` were written, only the last lines are
+        returned, after a line with the number of bytes skipped.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except (OSError, TypeError):
+            return []
+        if size < self.offset:
+            # Truncated by IPython
+            self.offset = 0
+        if size == self.offset:
+            return []
+
+        start = max(self.offset, size - max_bytes)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(size - start)
+
+        # Leave an incomplete line for next time, unless it is too long
+        end = data.rfind(b'\n') + 1
+        if end == 0 and len(data) < max_bytes:
+            return []
+        data = data[:end or len(data)]
+
+        lines = data.decode('utf-8', 'replace').split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        skipped = start - self.offset
+        if skipped:
+            # The first line may be incomplete
+            skipped += len(lines[0].encode('utf-8')) + 1
+            lines[0] = '[{} bytes skipped]'.format(skipped)
+        self.offset = start + len(data)
+
+        # Show the last text of lines rewritten with \r, e.g. progress bars
+        return [_ansi_escape_pattern.sub('', line.rstrip('\r').split('\r')[-1])
+                for line in lines]
+
+    def record(self, bufnr, rows):
+        """Remember that code was sent from ``rows`` of buffer ``bufnr``,
+        one row for each line of the code."""
+        if self.path is not None:
+            self.blocks.append((bufnr, rows))
+
+    def locate(self, path, lineno, text):
+        """Return the ``(buffer number or file path, row)`` of the line of a
+        traceback frame, or None.
+
+        Frames in files are located in the file, other than the files of
+        the tmpfile transport. Frames in code sent from Vim are located
+        with the rows of the recent executions, most recent first. If the
+        line at a row has changed since, the line is looked for in the cell
+        that contains the code.
+
+        See ``_parse_traceback_location`` for the parameters.
+        """
+        if path and not _tmpfile_name_pattern.match(os.path.basename(path)):
+            path = os.path.expanduser(path)
+            if os.path.isfile(path):
+                return path, lineno
+
+        blocks = []
+        for bufnr, rows in reversed(self.blocks):
+            try:
+                buffer = vim.buffers[bufnr]
+            except (KeyError, ValueError):
+                continue
+            if lineno <= len(rows):
+                blocks.append((buffer, rows))
+
+        for buffer, rows in blocks:
+            row = rows[lineno-1]
+            if (text is None or row <= len(buffer)
+                    and buffer[row-1].strip() == text.strip()):
+                return buffer.number, row
+
+        for buffer, rows in blocks:
+            row = _find_line_in_cell(buffer, rows[lineno-1], text)
+            if row is not None:
+                return buffer.number, row
+
+        return None
+
+    def schedule(self):
+        """Start a Vim timer that polls for output, if not started."""
+        if self.timer is None:
+            self.timer = vim.eval("timer_start(200, "
+                                  "'ipython_cell#poll_output', "
+                                  "{'repeat': -1})")
+
+    def unschedule(self):
+        if self.timer is not None:
+            vim.eval('timer_stop({})'.format(int(self.timer)))
+            self.timer = None
+
+    def cleanup(self):
+        """Remove the files of this Vim session."""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.path = None
+
+
+_output = _OutputPane()
+
+_ansi_escape_pattern = re.compile(r'\x1b\[[0-9;?]*[ -/]*[@-~]')
+_tmpfile_name_pattern = re.compile(r'^cell-[0-9a-f]{16}\.py$')
+
+
+class _NameCollector(ast.NodeVisitor):
+    """Collect the module-level names defined and the names used by a
+    statement.
+
+    Names bound in functions, lambdas, classes and comprehensions (e.g.
+    parameters, local variables and loop targets) are local to them, only
+    the free names of these scopes are used.
 
-    if next_cell_row is None:
-        end_row = None  # end of file
-    else:
-        end_row = next_cell_row - 1
+    """
+    def __init__(self):
+        self.defined = set()
+        self.used = set()
+        # Names bound, loaded and declared global in each enclosing scope
+        self.scopes = []
+
+    def define(self, name):
+        if self.scopes and name not in self.scopes[-1][2]:
+            self.scopes[-1][0].add(name)
+        else:
+            self.defined.add(name)
 
-    return start_row, end_row
+    def use(self, name):
+        if self.scopes and name not in self.scopes[-1][2]:
+            self.scopes[-1][1].add(name)
+        else:
+            self.used.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.use(node.id)
+        else:
+            self.define(node.id)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.use(node.target.id)
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        self._visit_item(node)
+
+    def visit_Subscript(self, node):
+        self._visit_item(node)
+
+    def _visit_item(self, node):
+        # Treat e.g. df['a'] = 1 as a new definition of df
+        if not isinstance(node.ctx, ast.Load):
+            value = node.value
+            while isinstance(value, (ast.Attribute, ast.Subscript)):
+                value = value.value
+            if isinstance(value, ast.Name):
+                self.use(value.id)
+                self.define(value.id)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.define(alias.asname or alias.name.split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name != '*':
+                self.define(alias.asname or alias.name)
+
+    def visit_Global(self, node):
+        if self.scopes:
+            self.scopes[-1][2].update(node.names)
+        self.defined.update(node.names)
+
+    def visit_ExceptHandler(self, node):
+        if isinstance(getattr(node, 'name', None), str):
+            self.define(node.name)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        # Decorators, defaults and annotations are evaluated in the
+        # enclosing scope
+        self._visit_all(node.decorator_list)
+        names = self._visit_arguments(node.args)
+        if getattr(node, 'returns', None) is not None:
+            self.visit(node.returns)
+        self.define(node.name)
+        self._open_scope(names)
+        self._visit_all(node.body)
+        self._close_scope()
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self._visit_all(node.decorator_list)
+        self._visit_all(node.bases)
+        self._visit_all(getattr(node, 'keywords', []))
+        self.define(node.name)
+        self._open_scope()
+        self._visit_all(node.body)
+        self._close_scope()
+
+    def visit_Lambda(self, node):
+        names = self._visit_arguments(node.args)
+        self._open_scope(names)
+        self.visit(node.body)
+        self._close_scope()
+
+    def visit_ListComp(self, node):
+        self._visit_comprehension(node, [node.elt])
+
+    visit_SetComp = visit_ListComp
+    visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        self._visit_comprehension(node, [node.key, node.value])
+
+    def _visit_comprehension(self, node, elements):
+        # The first iterable is evaluated in the enclosing scope
+        generators = node.generators
+        self.visit(generators[0].iter)
+        self._open_scope()
+        for i, generator in enumerate(generators):
+            self.visit(generator.target)
+            if i > 0:
+                self.visit(generator.iter)
+            self._visit_all(generator.ifs)
+        self._visit_all(elements)
+        self._close_scope()
+
+    def _visit_arguments(self, args):
+        """Visit the defaults and annotations of ``args`` and return the
+        names of the arguments."""
+        arguments = (getattr(args, 'posonlyargs', []) + args.args +
+                     getattr(args, 'kwonlyargs', []))
+        arguments += [arg for arg in (args.vararg, args.kwarg)
+                      if arg is not None]
+        self._visit_all(args.defaults)
+        self._visit_all(getattr(args, 'kw_defaults', []))
+        names = []
+        for arg in arguments:
+            if isinstance(arg, ast.Name):  # Python 2
+                names.append(arg.id)
+            else:
+                names.append(getattr(arg, 'arg', arg))
+                self._visit_all([getattr(arg, 'annotation', None)])
+        return names
 
+    def _visit_all(self, nodes):
+        for node in nodes:
+            if node is not None:
+                self.visit(node)
 
-def _get_next_cell(current_row, cell_boundaries):
-    """Return start row number of the next cell.
+    def _open_scope(self, names=()):
+        self.scopes.append((set(names), set(), set()))
 
-    If there is no next cell, the current row number is returned.
+    def _close_scope(self):
+        bound, loaded, _ = self.scopes.pop()
+        for name in loaded - bound:
+            self.use(name)
 
-    Parameters
+
+class _Notebook(object):
+    """A Jupyter notebook scanned without loading its outputs.
+
+    The file is memory mapped and only the type and source of each cell are
+    decoded. All other values, in particular outputs with embedded images,
+    are skipped with regular expressions, so the memory used does not depend
+    on the size of the outputs.
+
+    Attributes
     ----------
-    current_row : int
-        Current row number.
-    cell_boundaries : list
-        A list of row numbers for the cell boundaries.
+    cells : list
+        A dict with the keys ``cell_type``, ``source`` and ``span`` for each
+        cell, where ``span`` are the byte offsets of the JSON object of the
+        cell in the file.
+    cells_span : tuple
+        The byte offsets of the ``cells`` array in the file.
+    nbformat_minor : int
+        The minor version of the notebook format.
+
+    """
+    def __init__(self, path):
+        self.cells = []
+        self.cells_span = None
+        self.nbformat_minor = 0
+        self.file = open(path, 'rb')
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                raise ValueError("empty file")
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def copy(self, start, end, f, chunk_size=1 << 20):
+        """Write the bytes from ``start`` to ``end`` to file ``f``."""
+        for pos in range(start, end, chunk_size):
+            f.write(self.data[pos:min(pos + chunk_size, end)])
+
+    def _parse(self):
+        def member(key, pos):
+            if key == 'cells':
+                end = self._array(pos, self._cell)
+                self.cells_span = (pos, end)
+                return end
+            end = self._skip(pos)
+            if key == 'nbformat_minor':
+                self.nbformat_minor = self._decode(pos, end)
+            return end
+
+        self._object(self._whitespace(0), member)
+        if self.cells_span is None:
+            raise ValueError("no cells found")
+
+    def _cell(self, pos):
+        cell = {}
+
+        def member(key, pos):
+            end = self._skip(pos)
+            if key in ('cell_type', 'source'):
+                cell[key] = self._decode(pos, end)
+            return end
+
+        end = self._object(pos, member)
+        cell['span'] = (pos, end)
+        self.cells.append(cell)
+        return end
+
+    def _object(self, pos, member):
+        """Scan the object at ``pos``, calling ``member(key, pos)`` with the
+        position of each value, which returns the end of the value. Return
+        the end of the object."""
+        self._expect(pos, b'{')
+        pos = self._whitespace(pos + 1)
+        if self.data[pos:pos+1] == b'}':
+            return pos + 1
+        while True:
+            end = self._string(pos)
+            key = self._decode(pos, end)
+            pos = self._whitespace(end)
+            self._expect(pos, b':')
+            pos = self._whitespace(member(key, self._whitespace(pos + 1)))
+            if self.data[pos:pos+1] == b'}':
+                return pos + 1
+            self._expect(pos, b',')
+            pos = self._whitespace(pos + 1)
+
+    def _array(self, pos, item):
+        """Scan the array at ``pos``, calling ``item(pos)`` for each item,
+        which returns the end of the item. Return the end of the array."""
+        self._expect(pos, b'[')
+        pos = self._whitespace(pos + 1)
+        if self.data[pos:pos+1] == b']':
+            return pos + 1
+        while True:
+            pos = self._whitespace(item(pos))
+            if self.data[pos:pos+1] == b']':
+                return pos + 1
+            self._expect(pos, b',')
+            pos = self._whitespace(pos + 1)
+
+    def _skip(self, pos):
+        """Return the end of the value at ``pos`` without decoding it."""
+        char = self.data[pos:pos+1]
+        if char == b'"':
+            return self._string(pos)
+        elif char in (b'{', b'['):
+            depth = 0
+            for match in _json_token_pattern.finditer(self.data, pos):
+                # Strings are not a group, so that they are not copied
+                token = match.group(1)
+                if token in (b'{', b'['):
+                    depth += 1
+                elif token in (b'}', b']'):
+                    depth -= 1
+                    if depth == 0:
+                        return match.end()
+            raise ValueError("unexpected end of file")
+        match = _json_scalar_pattern.match(self.data, pos)
+        if match is None:
+            raise ValueError("invalid value at byte {}".format(pos))
+        return match.end()
+
+    def _string(self, pos):
+        match = _json_string_pattern.match(self.data, pos)
+        if match is None:
+            raise ValueError("expected a string at byte {}".format(pos))
+        return match.end()
+
+    def _whitespace(self, pos):
+        return _json_whitespace_pattern.match(self.data, pos).end()
+
+    def _expect(self, pos, char):
+        if self.data[pos:pos+1] != char:
+            raise ValueError("expected '{}' at byte {}".format(
+                char.decode('ascii'), pos))
+
+    def _decode(self, start, end):
+        return json.loads(self.data[start:end].decode('utf-8'))
+
+
+_json_string_pattern = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_json_token_pattern = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"|([{}\[\]])',
+                                 re.DOTALL)
+_json_scalar_pattern = re.compile(br'[^\s,:{}\[\]"]+')
+_json_whitespace_pattern = re.compile(br'\s*')
+
+
+def _notebook_to_percent(cells, insert_tag):
+    """Return the lines of the percent script for notebook ``cells``.
+
+    Markdown cells get a `` [markdown]`` header and their text is put in a
+    string, like ``to_markdown`` does. Cells are separated by an empty line.
+    """
+    tag = insert_tag.rstrip()
+    lines = []
+    for cell in cells:
+        cell_type = cell.get('cell_type', 'code')
+        source = _notebook_source(cell)
+        body = source.split('\n') if source else []
+        if lines:
+            lines.append('')
+        if cell_type == 'code':
+            lines.append(tag)
+        else:
+            lines.append('{} [{}]'.format(tag, cell_type))
+            if cell_type == 'markdown':
+                quote = "'''" if '"""' in source else '"""'
+                body = [quote] + body + [quote]
+        lines.extend(body)
+    return lines or ['']
+
+
+def _notebook_source(cell):
+    """Return the source of notebook ``cell`` as a string without trailing
+    newlines."""
+    source = cell.get('source', '')
+    if isinstance(source, list):
+        source = ''.join(source)
+    return source.rstrip('\n')
+
+
+def _percent_to_cells(buffer, cell_boundaries,
+                      first_line_contains_cell_header):
+    """Return a list of ``(cell_type, source)`` for the cells in ``buffer``,
+    the reverse of ``_notebook_to_percent``."""
+    cells = []
+    for cell in _get_cells(buffer, cell_boundaries,
+                           first_line_contains_cell_header):
+        body = list(buffer[cell.code_start_row-1:cell.end_row])
+        while body and not body[-1].strip():
+            body.pop()
+        header = cell.key[0]
+        if not header and not body:
+            continue
+
+        match = _notebook_cell_type_pattern.search(header)
+        cell_type = match.group(1) if match else 'code'
+        if cell_type == 'md':
+            cell_type = 'markdown'
+        if (cell_type == 'markdown' and len(body) >= 2
+                and body[0].strip() in ('"""', "'''")
+                and body[-1].strip() == body[0].strip()):
+            body = body[1:-1]
+        cells.append((cell_type, '\n'.join(body)))
+    return cells
+
+
+_notebook_cell_type_pattern = re.compile(r'\[(markdown|md|raw)\]')
+
+
+def _parse_traceback_location(lines, row):
+    """Return the location of the traceback frame at ``row`` of ``lines``.
+
+    The line number is taken from the numbered line of code at ``row`` if
+    any, else from the line marked with an arrow below it, else from the
+    header of the frame above it.
 
     Returns
     -------
-    int:
-        Start row number for the next cell.
+    tuple or None:
+        ``(path, lineno, text)``, where ``path`` is the file in the header
+        of the frame (None for code entered in IPython) and ``text`` is the
+        line of code (None if unknown).
 
     """
-    next_cell_row = None
-    for boundary in cell_boundaries:
-        if boundary > current_row:
-            next_cell_row = boundary
+    i = row - 1
+    lineno = text = None
+    match = _traceback_line_pattern.match(lines[i])
+    if match is not None:
+        lineno, text = int(match.group(1)), match.group(2)
+    else:
+        for line in lines[i+1:]:
+            if not line.strip():
+                break
+            match = _traceback_line_pattern.match(line)
+            if match is not None and line.lstrip().startswith('-'):
+                lineno, text = int(match.group(1)), match.group(2)
+                break
+
+    path = None
+    for j in range(i, -1, -1):
+        if j < i and not lines[j].strip():
+            break
+        match = _traceback_header_pattern.match(lines[j])
+        if match is not None:
+            path = match.group('path') or match.group('quoted')
+            if lineno is None:
+                header_lineno = (match.group('lineno')
+                                 or match.group('quoted_lineno')
+                                 or match.group('cell_lineno'))
+                lineno = int(header_lineno) if header_lineno else None
             break
 
-    if next_cell_row is None:
-        return current_row
-    else:
-        return next_cell_row
+    if lineno is None:
+        return None
+    return path, lineno, text
 
 
-def _get_prev_cell(current_row, cell_boundaries):
-    """Return start row number of the current or previous cell.
+# Headers of traceback frames: IPython 8 frames in files and cells, and
+# Python frames
+_traceback_header_pattern = re.compile(
+    r'\s*(?:File (?P<path>[^"\s][^,]*?):(?P<lineno>\d+)'
+    r'|File "(?P<quoted>[^"]+)", line (?P<quoted_lineno>\d+)'
+    r'|Cell In ?\[\d*\], line (?P<cell_lineno>\d+))')
 
-    If ``current_row`` is a cell header, the previous cell header is returned,
-    otherwise the current cell header is returned.
+# Numbered lines of code in IPython tracebacks, "----> 5 code" for the line
+# of the frame and "      4 code" around it
+_traceback_line_pattern = re.compile(r'^(?:-*>|\s)\s*(\d+)(?: (.*))?$')
 
-    If there is no previous cell, the current row number is returned.
 
-    Parameters
-    ----------
-    current_row : int
-        Current row number.
-    cell_boundaries : list
-        A list of row numbers for the cell boundaries.
+def _percentile(values, percent):
+    """Return the ``percent``-th percentile of ``values`` (nearest rank)."""
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
 
-    Returns
-    -------
-    int:
-        Start row number for the current or previous cell.
 
+# Driver script executed with _run_helper_command to profile a cell. The cell
+# is compiled with the name of the buffer and its line numbers shifted to the
+# rows of the buffer, and the results are written to a JSON file.
+_PROFILE_DRIVER = """\
+def _ipython_cell_profile(mode, source_path, first_row, filename,
+                          result_path):
+    import ast, io, json, os, types
+    ip = get_ipython()
+    result = {{'mode': mode}}
+    try:
+        with io.open(source_path, encoding='utf-8') as f:
+            tree = ast.parse(ip.transform_cell(f.read()))
+        code = compile(ast.increment_lineno(tree, first_row - 1), filename,
+                       'exec')
+        ip.user_ns['_ipython_cell_code'] = code
+        if mode == 'prun':
+            stats = ip.run_line_magic('prun', '-q -r exec(_ipython_cell_code)')
+            result['stats'] = [
+                [path, row, function, ncalls, tottime, cumtime]
+                for (path, row, function), (_, ncalls, tottime, cumtime, _)
+                in stats.stats.items()]
+        elif mode == 'timeit':
+            # As a cell magic, %timeit does not copy the local variables of
+            # this function to the namespace of the user
+            timeit = ip.run_cell_magic('timeit', '-o -q',
+                                       'exec(_ipython_cell_code)')
+            result['timeit'] = dict(
+                best=timeit.best, average=timeit.average,
+                stdev=timeit.stdev, loops=timeit.loops,
+                repeat=timeit.repeat)
+        else:
+            from line_profiler import LineProfiler
+            function = types.FunctionType(code, ip.user_ns)
+            profiler = LineProfiler(function)
+            profiler.enable_by_count()
+            try:
+                exec(function.__code__, ip.user_ns)
+            finally:
+                profiler.disable_by_count()
+            stats = profiler.get_stats()
+            result['timings'] = [
+                [row, hits, time * stats.unit]
+                for timings in stats.timings.values()
+                for row, hits, time in timings]
+    except Exception as e:
+        ip.showtraceback()
+        result['error'] = '{{}}: {{}}'.format(type(e).__name__, e)
+    finally:
+        ip.user_ns.pop('_ipython_cell_code', None)
+        with open(result_path + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.rename(result_path + '.tmp', result_path)
+
+
+_ipython_cell_profile({mode!r}, {source!r}, {first_row!r}, {filename!r},
+                      {result!r})
+del _ipython_cell_profile
+"""
+
+_PROFILE_MODES = ['prun', 'timeit', 'lprun']
+
+
+class _Profiler(object):
+    """Profile cells in IPython and collect the results.
+
+    The code of the cell and a driver script are written to a private
+    directory, like for ``_TmpfileTransport``, and the driver is executed
+    with ``_run_helper_command``. The driver writes the results to a JSON
+    file when it is done, which is polled for with a Vim timer.
     """
-    prev_cell_row = None
-    for boundary in cell_boundaries:
-        if boundary < current_row:
-            prev_cell_row = boundary
+    def __init__(self):
+        self.directory = None
+        self.count = 0
+        self.job = None
+        self.timer = None
+
+    def start(self, mode, code, first_row, filename, bufnr, rows):
+        """Write the files to profile ``code`` and return the path of the
+        driver script. A previous profile that has not finished is
+        forgotten."""
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='ipython-cell-profile-',
+                                              dir=_get_runtime_dir())
+            atexit.register(self.cleanup)
+
+        self.finish()
+        self.count += 1
+        prefix = os.path.join(self.directory, 'profile-{}'.format(self.count))
+        paths = {
+            'source': prefix + '.py',
+            'driver': prefix + '-driver.py',
+            'result': prefix + '.json',
+        }
+        with open(paths['source'], 'wb') as f:
+            f.write(code.encode('utf-8'))
+        with open(paths['driver'], 'wb') as f:
+            f.write(_PROFILE_DRIVER.format(
+                mode=mode, source=paths['source'], first_row=first_row,
+                filename=filename, result=paths['result']).encode('utf-8'))
+
+        self.job = dict(paths, mode=mode, filename=filename, bufnr=bufnr,
+                        rows=rows)
+        return paths['driver']
+
+    def poll(self):
+        """Return the results of the current profile, or None if there are
+        none yet."""
+        if self.job is None or not os.path.exists(self.job['result']):
+            return None
+        try:
+            with open(self.job['result']) as f:
+                return json.load(f)
+        except ValueError as e:
+            return {'mode': self.job['mode'], 'error': str(e)}
+
+    def finish(self):
+        """Remove the files of the current profile."""
+        if self.job is None:
+            return
+        for name in ['source', 'driver', 'result']:
+            try:
+                os.remove(self.job[name])
+            except OSError:
+                pass
+        self.job = None
+
+    def schedule(self):
+        """Start a Vim timer that polls for the results."""
+        self.unschedule()
+        self.timer = vim.eval("timer_start(200, 'ipython_cell#poll_profile', "
+                              "{'repeat': -1})")
+
+    def unschedule(self):
+        if self.timer is not None:
+            vim.eval('timer_stop({})'.format(int(self.timer)))
+            self.timer = None
+
+    def cleanup(self):
+        """Remove all files written by the profiler."""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.job = None
+
+
+_profiler = _Profiler()
+
+
+class _QueuedTransport(object):
+    """Wrap a transport so that all sends go through a ``_SendQueue``."""
+    def __init__(self, transport, queue):
+        self.transport = transport
+        self.queue = queue
+
+    def send_keys(self, string):
+        key = ('keys', string) if _is_control_sequence(string) else None
+        self.queue.push(_call(self.transport.send_keys, string), key=key)
+
+    def clear_prompt(self):
+        self.queue.push(_call(self.transport.clear_prompt),
+                        key=('clear_prompt',))
+
+    def send_command(self, string):
+        self.queue.push(_call(self.transport.send_command, string))
+
+    def send_cell(self, cell):
+        steps = getattr(self.transport, 'send_cell_steps', None)
+        if steps is not None:
+            self.queue.push(steps(cell))
         else:
-            break
+            self.queue.push(_call(self.transport.send_cell, cell))
 
-    if prev_cell_row is None:
-        return current_row
-    else:
-        return prev_cell_row
+    def send_cell_verbose(self, cell):
+        self.queue.push(_call(self.transport.send_cell_verbose, cell))
 
+    def previous_command(self):
+        self.queue.push(_call(self.transport.previous_command))
 
-def _get_rows_with_tag(buffer, tags, use_regex=False):
-    """Return a list of row numbers for lines containing tag in ``tags``.
+    def restart(self, shell_prev_cmd):
+        self.queue.push(_call(self.transport.restart, shell_prev_cmd))
+
+
+def _record_executed_cells(segments, cell_boundaries,
+                           first_line_contains_cell_header):
+    """Remember the code of the cells in ``segments`` as executed.
+
+    Nothing is recorded until executed cells are tracked for the buffer,
+    i.e., until ``g:ipython_cell_stale_signs`` is enabled or stale cells are
+    executed.
+    """
+    buffer = vim.current.buffer
+    executed = _executed_cells.get(buffer.number)
+    if executed is None:
+        if not _get_settings().stale_signs:
+            return
+        executed = _executed_cells[buffer.number] = {}
+
+    hash_cell = _hash_cell
+    if _get_settings().delimit_cells_by == 'tags':
+        hash_cell = _cell_indexes[buffer.number].cell_hash
+
+    cells = _get_cells_in_segments(buffer, segments, cell_boundaries,
+                                   first_line_contains_cell_header)
+    for cell in cells:
+        executed[cell.key] = hash_cell(buffer, cell)
+
+    update_stale_signs([cell.start_row for cell in cells])
+
+
+def _run_helper_command(path, args=()):
+    """Return the command that runs the helper script ``path`` with the
+    arguments ``args`` in the namespace of IPython, like ``%run -i``, see
+    ``_run_magic_command``."""
+    return _run_magic_command(" ".join(['-i', '"{}"'.format(path)]
+                                       + [str(arg) for arg in args]))
 
-    Parameters
-    ----------
-    buffer : iterable
-        An iterable object that contains the lines of a buffer.
-    tags : list or str
-        Tag(s) to search for.
+
+def _run_magic_command(magic_args):
+    """Return the command that runs ``%run magic_args`` in IPython.
+
+    ``%run -i`` sets ``__file__`` in the namespace of IPython to the path of
+    the script, so the command restores the previous value (or its absence)
+    afterwards.
+    """
+    return ("with __import__('IPython.utils.contexts', fromlist=['_'])"
+            ".preserve_keys(get_ipython().user_ns, '__file__'): "
+            "get_ipython().run_line_magic('run', {!r})".format(magic_args))
+
+
+# Script executed with %run -i before a cell to record its runtime. The first
+# time, it registers IPython event callbacks that time the next cell and
+# append the result to a file as a line of JSON.
+_RUNTIME_HELPER = """\
+def _ipython_cell_runtime():
+    import json, sys, time
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    class Recorder(object):
+        def __init__(self, shell):
+            self.pending = None
+            self.started = None
+            shell.events.register('pre_run_cell', self.pre_run_cell)
+            shell.events.register('post_run_cell', self.post_run_cell)
+
+        def arm(self, path, token):
+            self.pending = (path, token)
+            self.started = None
+
+        def pre_run_cell(self, *args):
+            if self.pending is not None and self.started is None:
+                self.started = time.time()
+
+        def post_run_cell(self, *args):
+            if self.pending is None or self.started is None:
+                return
+            (path, token), started = self.pending, self.started
+            self.pending = self.started = None
+
+            max_rss = None
+            if resource is not None:
+                max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                if sys.platform != 'darwin':
+                    max_rss *= 1024
+            error = bool(args and not getattr(args[0], 'success', True))
+            with open(path, 'a') as f:
+                f.write(json.dumps({
+                    'token': token, 'started': started,
+                    'seconds': time.time() - started, 'max_rss': max_rss,
+                    'error': error}) + '\\n')
+
+    recorder = globals().get('_ipython_cell_runtime_recorder')
+    if recorder is None:
+        recorder = Recorder(get_ipython())
+    recorder.arm(sys.argv[1], int(sys.argv[2]))
+    return recorder
+
+
+_ipython_cell_runtime_recorder = _ipython_cell_runtime()
+del _ipython_cell_runtime
+"""
+
+
+class _RuntimeHistory(object):
+    """Runtimes of executed cells, stored in a SQLite database.
+
+    Before a cell is sent, ``arm`` returns a command that makes IPython time
+    the next cell and append the result to a file in a private directory,
+    which is polled for with a Vim timer. The runtimes are stored by file
+    path and cell hash, so that the history of a cell is kept as long as its
+    code is unchanged.
+    """
+    def __init__(self):
+        self.directory = None
+        self.offset = 0
+        self.count = 0
+        self.pending = {}
+        self.timer = None
+        self.connection = None
+        self.database = None
+
+    def arm(self, key):
+        """Return the command that records the runtime of the next cell with
+        ``key`` (see ``_get_runtime_key``)."""
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='ipython-cell-runtime-',
+                                              dir=_get_runtime_dir())
+            atexit.register(self.cleanup)
+            with open(self.helper_path, 'wb') as f:
+                f.write(_RUNTIME_HELPER.encode('utf-8'))
+
+        self.count += 1
+        self.pending[self.count] = key
+        return _run_helper_command(self.helper_path, [
+            '"{}"'.format(self.results_path), self.count])
+
+    @property
+    def helper_path(self):
+        return os.path.join(self.directory, 'runtime.py')
+
+    @property
+    def results_path(self):
+        return os.path.join(self.directory, 'results.jsonl')
+
+    def read_results(self):
+        """Return the ``(key, result)`` of the cells that finished since the
+        last call."""
+        if self.directory is None or not os.path.exists(self.results_path):
+            return []
+        with open(self.results_path) as f:
+            f.seek(self.offset)
+            lines = f.readlines()
+            # Leave incomplete lines for next time
+            if lines and not lines[-1].endswith('\n'):
+                lines.pop()
+            self.offset += sum(len(line) for line in lines)
+
+        runs = []
+        for line in lines:
+            try:
+                result = json.loads(line)
+                key = self.pending.pop(result['token'])
+            except (ValueError, KeyError):
+                continue
+            runs.append((key, result))
+        return runs
+
+    def connect(self, database=''):
+        """Return a connection to ``database``, or the default database."""
+        if not database:
+            data_dir = (os.environ.get('XDG_DATA_HOME')
+                        or os.path.expanduser(os.path.join('~', '.local',
+                                                           'share')))
+            database = os.path.join(data_dir, 'ipython-cell',
+                                    'runtimes.sqlite')
+        database = os.path.expanduser(database)
+
+        if self.connection is None or self.database != database:
+            import sqlite3
+
+            directory = os.path.dirname(database)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.connection = sqlite3.connect(database)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs (path TEXT, cell_hash TEXT, "
+                "started REAL, seconds REAL, max_rss INTEGER)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS runs_cell ON runs "
+                "(path, cell_hash, started)")
+            self.database = database
+        return self.connection
+
+    def add(self, database, path, cell_hash, started, seconds, max_rss=None):
+        """Store a runtime of a cell."""
+        connection = self.connect(database)
+        with connection:
+            connection.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?)",
+                               (path, cell_hash, started, seconds, max_rss))
+
+    def get_runs(self, database, path, cell_hash, limit=21):
+        """Return the last ``limit`` runtimes of a cell, most recent first."""
+        rows = self.connect(database).execute(
+            "SELECT seconds FROM runs WHERE path = ? AND cell_hash = ? "
+            "ORDER BY started DESC LIMIT ?", (path, cell_hash, limit))
+        return [seconds for seconds, in rows]
+
+    def schedule(self):
+        """Start a Vim timer that polls for results, if not started."""
+        if self.timer is None:
+            self.timer = vim.eval("timer_start(200, "
+                                  "'ipython_cell#poll_runtimes', "
+                                  "{'repeat': -1})")
+
+    def unschedule(self):
+        if self.timer is not None:
+            vim.eval('timer_stop({})'.format(int(self.timer)))
+            self.timer = None
+
+    def cleanup(self):
+        """Remove the files of this Vim session."""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.offset = 0
+            self.pending.clear()
+
+
+_runtime_history = _RuntimeHistory()
+
+
+def _runtime_summary(runs, regression=2.0):
+    """Summarize the runtimes ``runs`` of a cell, most recent first.
+
+    The last run has regressed if it took more than ``regression`` times the
+    median of at least three earlier runs.
 
     Returns
     -------
-    list:
-        List of row numbers.
+    dict:
+        ``last`` and ``median`` runtime, number of ``runs``, ``ratio`` of the
+        last runtime to the median of the earlier runs, and ``regressed``.
 
     """
-    if not isinstance(tags, list):
-        tags = [tags]
+    earlier = runs[1:]
+    ratio = None
+    if earlier:
+        previous_median = _percentile(earlier, 50)
+        if previous_median > 0:
+            ratio = runs[0] / previous_median
+    return {
+        'last': runs[0],
+        'median': _percentile(runs, 50),
+        'runs': len(runs),
+        'ratio': ratio,
+        'regressed': (ratio is not None and len(earlier) >= 3
+                      and ratio > regression),
+    }
 
-    rows_containing_tag = []
-    for i, line in enumerate(buffer):
-        for tag in tags:
-            if not use_regex:
-                tag_found = tag in line
+
+def _sanitize(string):
+    return "'" + re.sub(re.compile("'"), "''", string) + "'"
+
+
+class _SendQueue(object):
+    """Queue of send operations that are run in order from Vim timers.
+
+    Each operation is an iterator. It is advanced once per step and is
+    considered to be waiting (e.g. for the clipboard) while it yields.
+
+    Parameters
+    ----------
+    budget : float
+        Maximum time in seconds to spend on each drain before giving control
+        back to Vim.
+    session : str
+        The session the operations are sent to. Each session has its own
+        queue and timer, so that operations waiting in one session do not
+        hold up the others.
+
+    """
+    def __init__(self, budget=0.01, session=''):
+        self.budget = budget
+        self.session = session
+        self.operations = collections.deque()
+        self.head_started = False
+        self.timer_armed = False
+
+    def __len__(self):
+        return len(self.operations)
+
+    def push(self, operation, key=None):
+        """Add ``operation`` to the queue and make sure it will be run.
+
+        If ``key`` is not None and equal to the key of the last queued
+        operation that has not started yet, ``operation`` is dropped. This is
+        used to coalesce repeated control sequences.
+        """
+        if (key is not None and self.operations
+                and self.operations[-1][0] == key
+                and not (len(self.operations) == 1 and self.head_started)):
+            return
+
+        self.operations.append((key, operation))
+        self.schedule(0)
+
+    def drain(self):
+        """Run queued operations until the queue is empty, an operation is
+        waiting, or the time budget is exceeded.
+
+        Returns
+        -------
+        int or None:
+            Delay in milliseconds before the next drain, or None if the queue
+            is empty.
+
+        """
+        self.timer_armed = False
+        deadline = time.time() + self.budget
+        while self.operations:
+            _, operation = self.operations[0]
+            self.head_started = True
+            try:
+                next(operation)
+            except StopIteration:
+                self._pop()
+            except Exception as e:
+                self._pop()
+                _error("Could not send: {}".format(e))
             else:
-                match = re.search(tag, line)
-                tag_found = match is not None
+                return self.schedule(5)
 
-            if tag_found:
-                rows_containing_tag.append(i + 1)  # rows are counted from 1
-                break
+            if time.time() > deadline:
+                return self.schedule(0)
 
-    return rows_containing_tag
+        return None
 
+    def schedule(self, delay):
+        """Start a Vim timer that drains the queue after ``delay`` ms."""
+        if not self.timer_armed:
+            vim.eval("timer_start({}, function('ipython_cell#drain_queue', "
+                     "[{}]))".format(delay, _sanitize(self.session)))
+            self.timer_armed = True
+        return delay
+
+    def _pop(self):
+        self.operations.popleft()
+        self.head_started = False
+
+
+# Operations waiting to be sent if g:ipython_cell_send_async is enabled, by
+# session
+_send_queues = {}
+
+
+def _get_send_queue(session=''):
+    """Return the send queue of ``session``, creating it if needed."""
+    try:
+        return _send_queues[session]
+    except KeyError:
+        queue = _send_queues[session] = _SendQueue(session=session)
+        return queue
 
-def _get_rows_with_marks(buffer, valid_marks):
-    """Return a list of row numbers for lines containing a mark.
+
+def _send_command(string, session=None):
+    """Send ``string`` followed by a carriage return using the transport."""
+    transport = _get_transport(session)
+    if transport is not None:
+        transport.send_command(string)
+
+
+def _send_keys(string, session=None):
+    """Send ``string`` without a carriage return using the transport."""
+    transport = _get_transport(session)
+    if transport is not None:
+        transport.send_keys(string)
+
+
+def _send_segments(session, segments, lines, code,
+                   first_line_contains_cell_header, use_cpaste=False,
+                   runtime_key=None):
+    """Send several ranges of rows to ``session`` as a single block of code.
 
     Parameters
     ----------
-    buffer : buffer object
-        An object with a ``mark`` method.
-    valid_marks : list
-        A list of marks to search for.
+    lines : list
+        The lines of the rows, see ``_get_cell_lines``.
+    code : str
+        The code to send, see ``_get_cell_code``.
+
+    See ``_execute_segments`` for the other parameters.
 
     Returns
     -------
-    list:
-        List of row numbers.
+    tuple or None:
+        The number of lines and bytes sent, or None if there is no transport
+        for ``session``.
 
     """
-    rows_containing_marks = []
-    for mark in valid_marks:
-        mark_loc = buffer.mark(mark)
-        if mark_loc is not None and mark_loc[0] != 0:
-            rows_containing_marks.append(mark_loc[0])
+    transport = _get_transport(session)
+    if transport is None:
+        return None
 
-    return rows_containing_marks
+    settings = _get_settings()
+    buffer = vim.current.buffer
 
+    _clear_prompt(session)
 
-def _sanitize(string):
-    return "'" + re.sub(re.compile("'"), "''", string) + "'"
+    if runtime_key is not None:
+        transport.send_command(_runtime_history.arm(runtime_key))
+        if settings.has_timers:
+            _runtime_history.schedule()
+
+    # Send tags?
+    start_row = segments[0][0]
+    if settings.delimit_cells_by == 'tags' and settings.send_cell_headers:
+        if start_row == 1 and not first_line_contains_cell_header:
+            cell_header = "# cell 0"
+        else:
+            cell_header = buffer[start_row-1]
+
+        _send_keys(cell_header + CTRL_O + CTRL_N, session)
+
+    with _timings.phase('send'):
+        if not use_cpaste:
+            if lines in ([], [""]):
+                transport.send_command("# empty cell")
+            else:
+                transport.send_cell(code)
+        else:
+            transport.send_cell_verbose(code)
+
+    return len(lines), len(code.encode('utf-8'))
+
+
+def _get_cell_lines(buffer, segments, cell_boundaries,
+                    first_line_contains_cell_header):
+    """Return the lines of code in ``segments`` and the row of each line.
+
+    Cell headers are left out at the start of each segment, and sent as
+    empty lines within segments unless ``g:ipython_cell_send_cell_headers``
+    is enabled.
+
+    See ``_execute_segments`` for the parameters.
+
+    """
+    settings = _get_settings()
+    delimit_by_tags = settings.delimit_cells_by == 'tags'
+
+    lines = []
+    rows = []
+    for start_row, end_row in segments:
+        # Do not send the tag over
+        if delimit_by_tags:
+            if first_line_contains_cell_header or start_row != 1:
+                start_row += 1
+
+        # start_row and end_row are 1-indexed, need to subtract 1
+        segment = buffer[start_row-1:end_row]
+
+        if delimit_by_tags and not settings.send_cell_headers:
+            first = bisect.bisect_left(cell_boundaries, start_row)
+            last = bisect.bisect_right(cell_boundaries, end_row)
+            for row in cell_boundaries[first:last]:
+                if row != 1 or first_line_contains_cell_header:
+                    segment[row-start_row] = ""
+
+        lines.extend(segment)
+        rows.extend(range(start_row, start_row + len(segment)))
+
+    return lines, rows
+
+
+def _get_cell_code(lines, rows, filename):
+    """Return the code to send for ``lines`` and the row of each of its
+    lines, which includes an assignment to ``__file__`` if
+    ``g:ipython_cell_update_file_variable`` is enabled."""
+    code = "\n".join(lines)
+    if _get_settings().update_file_variable:
+        # Make sure the indentation is the same as the first line of the cell
+        first_row = lines[0] if lines else ""
+        indentation = re.match(r"[\t ]*", first_row).group()
+        code = indentation + "__file__ = '{}'\n".format(filename) + code
+        rows = rows[:1] + rows
+    return code, rows
+
+
+class _SlimeTransport(object):
+    """Send code to a terminal using vim-slime.
+
+    Parameters
+    ----------
+    session : str
+        Send to the vim-slime target in the ``slime_config`` of this session
+        in ``g:ipython_cell_sessions``, instead of the target of the current
+        buffer.
+
+    """
+    def __init__(self, session=''):
+        self.session = session
+
+    def send_keys(self, string):
+        _slimesend0(string, self.session)
+
+    def clear_prompt(self):
+        settings = _get_settings()
+        if settings.send_ctrl_u:
+            _slimesend0(CTRL_U, self.session)
+
+        if settings.send_ctrl_c:
+            _slimesend0("i", self.session)  # enter insert mode
+            _slimesend0(CTRL_C, self.session)
+
+    def send_command(self, string):
+        _slimesend(string, self.session)
+
+    def send_cell(self, cell):
+        """Send ``cell`` using the clipboard and the cell command."""
+        _copy_to_clipboard(cell)
+        _slimesend(_get_settings().cell_command, self.session)
+
+    def send_cell_steps(self, cell):
+        """Same as ``send_cell``, but yield while the clipboard is written.
+
+        Used by the send queue so that Vim is not blocked by the clipboard
+        program.
+        """
+        settings = _get_settings()
+        if settings.prefer_external_copy or not settings.has_clipboard:
+            job = _clipboard.copy_async(cell)
+            while job.is_alive():
+                yield
+            if job.error is not None:
+                _error(job.error)
+                return
+        else:
+            _copy_to_clipboard_internal(cell)
+        _slimesend(settings.cell_command, self.session)
+
+    def send_cell_verbose(self, cell):
+        """Send the text of ``cell`` to the terminal."""
+        if _get_settings().slime_python_ipython:
+            # Add a newline at the start of the cell to avoid problems if there
+            # is a global indentation level, see Issue #37 on GitHub
+            cell = "\n" + cell
+
+            _slimesend(cell, self.session)
+        else:
+            _slimesend("%cpaste -q", self.session)
+            # Send 25 lines at a time to avoid potential issues when sending
+            # a large number of lines
+            lines = cell.splitlines()
+            for i in range(0, len(lines), 25):
+                _slimesend("\n".join(lines[i:i+25]), self.session)
+            _slimesend("--", self.session)
+
+    def previous_command(self):
+        _slimesend(CTRL_P, self.session)
 
+    def restart(self, shell_prev_cmd):
+        _slimesend("exit", self.session)
+        _slimesend(shell_prev_cmd, self.session)
 
-def _slimesend(string):
+
+def _slime_command(command, session=''):
+    """Run the vim-slime ``command``, sending to the target of ``session``."""
+    if session:
+        vim.eval('ipython_cell#slime_command({}, {})'.format(
+            _sanitize(session), _sanitize(command)))
+    else:
+        vim.command(command)
+
+
+def _slimesend(string, session=''):
     """Send ``string`` using vim-slime."""
     if not string:
         return
 
     try:
-        vim.command('SlimeSend1 {}'.format(string))
+        with _timings.phase('slimesend'):
+            _slime_command('SlimeSend1 {}'.format(string), session)
     except vim.error:
         _error("Could not execute SlimeSend1 command, make sure vim-slime is "
                "installed")
 
 
-def _slimesend0(string):
+def _slimesend0(string, session=''):
     """Similar to _slimesend, but use SlimeSend0 (do not include carriage
     return) instead of SlimeSend1.
     """
@@ -585,7 +4159,445 @@ def _slimesend0(string):
         return
 
     try:
-        vim.command('SlimeSend0 "{}"'.format(string))
+        with _timings.phase('slimesend'):
+            _slime_command('SlimeSend0 "{}"'.format(string), session)
     except vim.error:
         _error("Could not execute SlimeSend0 command, make sure vim-slime is "
                "installed")
+
+
+class _Timings(object):
+    """Time the phases of cell executions.
+
+    The time of each phase excludes the time of the phases nested in it, e.g.
+    the clipboard copy is not counted in the time to send the cell. The most
+    recent executions are kept in ``records``.
+
+    Parameters
+    ----------
+    maxlen : int
+        Number of executions to keep.
+
+    """
+    def __init__(self, maxlen=200):
+        self.records = collections.deque(maxlen=maxlen)
+        self.current = None
+        self._stack = []
+
+    def start(self, command):
+        """Start timing an execution of ``command``."""
+        self.current = {
+            'command': command,
+            'time': time.time(),
+            'phases': collections.OrderedDict(),
+        }
+        self._stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the body of the ``with`` statement to the
+        phase ``name`` of the current execution, if any."""
+        if self.current is None:
+            yield
+            return
+
+        frame = [time.time(), 0.0]  # start time, time spent in nested phases
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.time() - frame[0]
+            if self._stack:
+                self._stack[-1][1] += elapsed
+            if self.current is not None:
+                phases = self.current['phases']
+                phases[name] = phases.get(name, 0.0) + elapsed - frame[1]
+
+    def cancel(self):
+        """Discard the current execution, e.g. if nothing was sent."""
+        self.current = None
+        self._stack = []
+
+    def finish(self, num_lines, num_bytes, trace_file=''):
+        """Store the current execution, and append it to ``trace_file`` as a
+        line of JSON if given."""
+        record = self.current
+        if record is None:
+            return
+
+        self.current = None
+        record['total'] = time.time() - record['time']
+        record['lines'] = num_lines
+        record['bytes'] = num_bytes
+        self.records.append(record)
+
+        if trace_file:
+            try:
+                with open(os.path.expanduser(trace_file), 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+            except (IOError, OSError) as e:
+                _error("Could not write trace file: {}".format(e))
+
+
+# Timings of recent cell executions, see stats
+_timings = _Timings()
+
+
+class _TmpfileTransport(_SlimeTransport):
+    """Send cells by writing them to a file and executing the file.
+
+    Only a short command is sent to the terminal, regardless of the size of
+    the cell. Files are written to a private directory in
+    ``$XDG_RUNTIME_DIR`` or ``/dev/shm`` if available, named by the hash of
+    their contents so that a file is never changed before IPython has read
+    it, and removed when Vim exits. ``%run`` commands keep the value of
+    ``__file__`` in IPython.
+
+    Parameters
+    ----------
+    max_files : int
+        Maximum number of files to keep. The oldest file is removed when the
+        limit is exceeded.
+
+    """
+    # The cell is written synchronously, there is nothing to wait for
+    send_cell_steps = None
+
+    def __init__(self, max_files=32, session=''):
+        super(_TmpfileTransport, self).__init__(session)
+        self.max_files = max_files
+        self.directory = None
+        self.files = collections.OrderedDict()
+
+    def send_cell(self, cell):
+        path = self.write(cell)
+        command = _get_settings().tmpfile_command.format(filepath=path)
+        if command.startswith('%run '):
+            command = _run_magic_command(command[len('%run '):])
+        _slimesend(command, self.session)
+
+    def send_cell_verbose(self, cell):
+        self.send_cell(cell)
+
+    def write(self, cell):
+        """Write ``cell`` to a file and return the path of the file."""
+        digest = hashlib.sha1(cell.encode('utf-8')).hexdigest()[:16]
+        try:
+            path = self.files.pop(digest)
+        except KeyError:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix='ipython-cell-',
+                                                  dir=_get_runtime_dir())
+                atexit.register(self.cleanup)
+            path = os.path.join(self.directory, 'cell-{}.py'.format(digest))
+            with open(path, 'wb') as f:
+                # %paste dedents cells, do the same here
+                f.write(textwrap.dedent(cell).encode('utf-8'))
+        self.files[digest] = path
+
+        while len(self.files) > self.max_files:
+            _, old_path = self.files.popitem(last=False)
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+        return path
+
+    def cleanup(self):
+        """Remove all files written by this transport."""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.files.clear()
+
+
+class _TmuxTransport(object):
+    """Send code to a tmux pane, without the clipboard or vim-slime.
+
+    Each cell is loaded into a tmux buffer from stdin and pasted with
+    bracketed paste (``paste-buffer -p``), and each sequence of keys is sent
+    with ``send-keys``, each in a single call of tmux.
+
+    Parameters
+    ----------
+    target : str
+        The target pane, e.g. ``'{right-of}'`` or ``'ipython:1.0'``.
+    socket : str
+        Name (``-L``) or path (``-S``) of the socket of the tmux server. If
+        empty, the default server is used.
+
+    """
+    buffer_name = 'ipython-cell'
+
+    def __init__(self, target, socket=''):
+        self.target = target
+        self.command = ['tmux']
+        if socket:
+            self.command += ['-S' if os.sep in socket else '-L', socket]
+
+    def send_keys(self, string):
+        self.tmux(self.keys(string))
+
+    def clear_prompt(self):
+        settings = _get_settings()
+        keys = []
+        if settings.send_ctrl_u:
+            keys.append('C-u')
+        if settings.send_ctrl_c:
+            keys += ['i', 'C-c']  # enter insert mode and clear the prompt
+        if keys:
+            self.tmux(['send-keys', '-t', self.target] + keys)
+
+    def send_command(self, string):
+        self.tmux(self.keys(string)
+                  + [';', 'send-keys', '-t', self.target, 'Enter'])
+
+    def send_cell(self, cell):
+        """Paste ``cell`` and execute it."""
+        # Like %paste, dedent the cell. The last newline completes indented
+        # blocks, so that a single Enter executes the cell.
+        self.tmux(['load-buffer', '-b', self.buffer_name, '-',
+                   ';', 'paste-buffer', '-p', '-d', '-b', self.buffer_name,
+                   '-t', self.target,
+                   ';', 'send-keys', '-t', self.target, 'Enter'],
+                  textwrap.dedent(cell) + '\n')
+
+    def send_cell_verbose(self, cell):
+        self.send_cell(cell)
+
+    def previous_command(self):
+        self.send_command(CTRL_P)
+
+    def restart(self, shell_prev_cmd):
+        self.send_command("exit")
+        self.send_command(shell_prev_cmd)
+
+    def keys(self, string):
+        """Return the tmux commands that type ``string``."""
+        args = []
+        for text, controls in re.findall(r'([^\x00-\x1f]*)([\x00-\x1f]*)',
+                                         string):
+            if text:
+                args += [';', 'send-keys', '-t', self.target, '-l', '--', text]
+            if controls:
+                args += [';', 'send-keys', '-t', self.target]
+                args += [_TMUX_CONTROL_KEYS[ord(c)] for c in controls]
+        return args[1:]
+
+    def tmux(self, args, input=None):
+        """Run tmux with ``args``, writing ``input`` to its stdin."""
+        if not args:
+            return
+        with _timings.phase('tmux'):
+            try:
+                process = Popen(self.command + args, stdin=PIPE, stdout=PIPE,
+                                stderr=PIPE)
+                _, stderr = process.communicate(
+                    None if input is None else input.encode('utf-8'))
+            except OSError as e:
+                _error("Could not run tmux: {}".format(e))
+                return
+        if process.returncode != 0:
+            _error("tmux failed: {}".format(
+                stderr.decode('utf-8', 'replace').strip()))
+
+
+# tmux key names of the control characters 0 to 31
+_TMUX_CONTROL_KEYS = (['C-Space']
+                      + ['C-' + chr(ord('a') + i) for i in range(26)]
+                      + ['Escape', 'C-\\', 'C-]', 'C-^', 'C-_'])
+
+
+def _validate_blocks(buffer, blocks):
+    """Check the syntax of the code of ``blocks`` before it is sent.
+
+    Syntax errors are put in the quickfix list with the rows of ``buffer``
+    they are on. The quickfix list is cleared again once the errors are
+    fixed.
+
+    Parameters
+    ----------
+    blocks : list
+        A list of ``(session, segments, lines, code, rows)``, see
+        ``_execute_segments``.
+
+    Returns
+    -------
+    bool:
+        True if all blocks are valid.
+
+    """
+    global _syntax_errors_shown
+
+    items = []
+    with _timings.phase('validate'):
+        for _, _, _, code, rows in blocks:
+            error = _validate_code(code, buffer.name)
+            if error is not None:
+                lineno, col, message = error
+                items.append({
+                    'bufnr': buffer.number,
+                    'lnum': rows[min(lineno, len(rows)) - 1] if rows else 1,
+                    'col': col,
+                    'text': 'SyntaxError: ' + message,
+                    'type': 'E',
+                })
+
+    if items or _syntax_errors_shown:
+        vim.eval('ipython_cell#set_errors({})'.format(json.dumps(items)))
+        _syntax_errors_shown = bool(items)
+    if items:
+        _error("Syntax error in line {}, the cell was not sent"
+               .format(items[0]['lnum']))
+    return not items
+
+
+# True if syntax errors found by _validate_blocks are in the quickfix list
+_syntax_errors_shown = False
+
+
+def _validate_code(code, filename):
+    """Return the syntax error in ``code``, or None if it compiles.
+
+    The code is dedented as IPython does when it is pasted, and lines with
+    IPython syntax are masked. Cell magics such as ``%%timeit`` are not
+    checked. The results are cached by the hash of the code.
+
+    Returns
+    -------
+    tuple or None:
+        ``(lineno, col, message)``, where ``lineno`` is the line in ``code``
+        and ``col`` is the column in that line, both 1-indexed.
+
+    """
+    key = hashlib.sha1(code.encode('utf-8')).hexdigest()
+    if key in _validated_code:
+        return _validated_code[key]
+
+    error = None
+    dedented = textwrap.dedent(code)
+    if not dedented.lstrip().startswith('%%'):
+        try:
+            compile(_mask_ipython_syntax(dedented), filename, 'exec',
+                    _COMPILE_FLAGS, True)
+        except SyntaxError as e:
+            # Masking can break e.g. an expression continued on a line that
+            # starts with %, so try the code as it is too
+            try:
+                compile(dedented, filename, 'exec', _COMPILE_FLAGS, True)
+            except (SyntaxError, ValueError, TypeError):
+                lines = code.split("\n")
+                lineno = min(max(e.lineno or 1, 1), len(lines))
+                # Add the indentation removed by dedent to the column
+                indentation = (len(lines[lineno-1])
+                               - len(dedented.split("\n")[lineno-1]))
+                error = (lineno, max(e.offset or 1, 1) + indentation, e.msg)
+        except (ValueError, TypeError) as e:
+            # e.g. null bytes
+            error = (1, 1, str(e))
+
+    if len(_validated_code) >= 1000:
+        _validated_code.clear()
+    _validated_code[key] = error
+    return error
+
+
+# Allow await outside of functions, as IPython does
+_COMPILE_FLAGS = getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0)
+
+
+def _which(program):
+    """Return the full path of executable ``program``, or None."""
+    try:
+        from shutil import which
+    except ImportError:
+        # Python 2
+        from distutils.spawn import find_executable as which
+    return which(program)
+
+
+def _write_notebook(path, cells, original=None):
+    """Write ``cells`` as a notebook to ``path``.
+
+    Cells of the notebook ``original`` with the same type and source as a
+    cell in ``cells`` are copied verbatim, including their outputs and
+    metadata, and so is everything in ``original`` but the cells. The
+    notebook is written to a temporary file that is then renamed.
+
+    Parameters
+    ----------
+    path : str
+        Path of the notebook to write.
+    cells : list
+        A list of ``(cell_type, source)``, see ``_percent_to_cells``.
+    original : str or None
+        Path of the notebook that the cells were read from.
+
+    Returns
+    -------
+    int:
+        The number of cells copied from ``original``.
+
+    """
+    notebook = _Notebook(original) if original else None
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                    prefix='.ipython-cell-', suffix='.ipynb',
+                                    delete=False)
+    num_copied = 0
+    try:
+        with f:
+            # Unchanged cells, matched in order if there are duplicates
+            spans = collections.defaultdict(collections.deque)
+            if notebook is None:
+                nbformat_minor = 5
+                f.write(b'{\n "cells": ')
+            else:
+                nbformat_minor = notebook.nbformat_minor
+                for cell in notebook.cells:
+                    key = (cell.get('cell_type', 'code'),
+                           _notebook_source(cell))
+                    spans[key].append(cell['span'])
+                notebook.copy(0, notebook.cells_span[0], f)
+
+            f.write(b'[')
+            for i, (cell_type, source) in enumerate(cells):
+                f.write(b',\n  ' if i else b'\n  ')
+                if spans[cell_type, source]:
+                    start, end = spans[cell_type, source].popleft()
+                    notebook.copy(start, end, f)
+                    num_copied += 1
+                    continue
+
+                cell = {'cell_type': cell_type, 'metadata': {},
+                        'source': source.splitlines(True)}
+                if cell_type == 'code':
+                    cell['execution_count'] = None
+                    cell['outputs'] = []
+                if nbformat_minor >= 5:
+                    cell['id'] = uuid.uuid4().hex[:8]
+                text = json.dumps(cell, indent=1, sort_keys=True,
+                                  ensure_ascii=False)
+                f.write(text.replace('\n', '\n  ').encode('utf-8'))
+            f.write(b'\n ]' if cells else b']')
+
+            if notebook is None:
+                f.write(b',\n "metadata": {\n  "language_info": {\n'
+                        b'   "name": "python"\n  }\n },\n'
+                        b' "nbformat": 4,\n "nbformat_minor": 5\n}\n')
+            else:
+                notebook.copy(notebook.cells_span[1], len(notebook.data), f)
+    except Exception:
+        os.remove(f.name)
+        raise
+    finally:
+        if notebook is not None:
+            notebook.close()
+
+    if os.path.exists(path):
+        shutil.copymode(path, f.name)
+    else:
+        os.chmod(f.name, 0o644)
+    getattr(os, 'replace', os.rename)(f.name, path)
+    return num_copied
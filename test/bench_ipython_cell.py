@@ -0,0 +1,230 @@
+"""Benchmarks for the hot paths of ipython_cell.
+
+Run from the root of the repository::
+
+    python test/bench_ipython_cell.py                     # print results
+    python test/bench_ipython_cell.py --save              # update baseline
+    python test/bench_ipython_cell.py --compare           # check baseline
+
+Each benchmark runs on synthetic buffers of 1k to 1M lines with a stub of
+the ``vim`` module that counts round trips to Vim (``vim.eval``,
+``vim.command`` and ``buffer.mark`` calls). Results are stored in
+``bench_baseline.json`` next to this file. ``--compare`` exits with status 1
+if a benchmark makes more round trips than the baseline, or takes more than
+``--tolerance`` times as long and at least ``--min-difference`` seconds
+longer, so that the noise of timings in the microseconds is ignored. Round
+trips do not depend on the machine, so they are compared exactly; times
+should only be compared against a baseline saved on the same machine.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from python import ipython_cell as ic  # noqa: E402
+from vim_stub import OPTIONS, FakeBuffer, FakeVim  # noqa: E402
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bench_baseline.json')
+SIZES = [1000, 10000, 100000, 1000000]
+CELL_LENGTH = 20
+# Slowdowns smaller than this are noise, in seconds
+MIN_DIFFERENCE = 50e-6
+TAGS = OPTIONS['tag']
+REGEX_TAGS = [r'#\s*%%', r'#\s*<codecell>', r'##'] + [
+    r'# cell {}\b'.format(i) for i in range(17)]
+MARKS = OPTIONS['valid_marks']
+
+
+def make_buffer(num_lines):
+    """Return a buffer of ``num_lines`` lines with a cell header every
+    ``CELL_LENGTH`` lines and five marks set."""
+    contents = []
+    for row in range(num_lines):
+        if row % CELL_LENGTH == 0:
+            contents.append('# %% cell {}'.format(row // CELL_LENGTH))
+        elif row % CELL_LENGTH == 1:
+            contents.append('# Compute the value of x')
+        else:
+            contents.append('x = {} * (x + 1)'.format(row))
+
+    step = num_lines // 5
+    marks = {mark: (1 + i * step, 0) for i, mark in enumerate('adkpZ')}
+    return FakeBuffer(contents, marks)
+
+
+def bench_tag_literal(buffer, vim):
+    return lambda: ic._get_rows_with_tag(buffer, TAGS)
+
+
+def bench_tag_regex(buffer, vim):
+    return lambda: ic._get_rows_with_tag(buffer, REGEX_TAGS, use_regex=True)
+
+
+def bench_marks(buffer, vim):
+    return lambda: ic._get_rows_with_marks(buffer, MARKS)
+
+
+def bench_marklist(buffer, vim):
+    return lambda: ic._get_rows_with_marklist(buffer.number, MARKS)
+
+
+def bench_lookups(buffer, vim):
+    boundaries = ic._get_rows_with_tag(buffer, TAGS)
+    rows = range(1, len(buffer) + 1, max(1, len(buffer) // 1000))
+
+    def run():
+        for row in rows:
+            ic._get_current_cell_boundaries(row, boundaries)
+            ic._get_next_cell(row, boundaries)
+            ic._get_prev_cell(row, boundaries)
+    return run
+
+
+def bench_cpaste(buffer, vim):
+    transport = ic._SlimeTransport()
+    cell = '\n'.join(buffer[:])
+    return lambda: transport.send_cell_verbose(cell)
+
+
+def bench_execute_cell(buffer, vim):
+    vim.current.window.cursor = (len(buffer) // 2, 0)
+    return lambda: ic.execute_cell()
+
+
+def bench_move_cell(buffer, vim):
+    vim.current.window.cursor = (len(buffer) // 2, 0)
+    return lambda: ic.move_cell(1)
+
+
+BENCHMARKS = [
+    ('tag_literal', bench_tag_literal),
+    ('tag_regex', bench_tag_regex),
+    ('marks', bench_marks),
+    ('marklist', bench_marklist),
+    ('lookups', bench_lookups),
+    ('cpaste', bench_cpaste),
+    ('execute_cell', bench_execute_cell),
+    ('move_cell', bench_move_cell),
+]
+
+
+def run_benchmarks(sizes=SIZES, names=None, repeat=3):
+    """Run the benchmarks and return the results.
+
+    Returns
+    -------
+    dict:
+        ``{'<name>/<size>': {'seconds': ..., 'round_trips': ...}}``, where
+        ``seconds`` is the best time of ``repeat`` runs and ``round_trips``
+        the number of round trips to Vim in one run.
+
+    """
+    results = {}
+    for size in sizes:
+        buffer = make_buffer(size)
+        for name, make in BENCHMARKS:
+            if names and name not in names:
+                continue
+
+            vim = FakeVim(buffer)
+            buffer.vim = vim
+            ic.vim = vim
+            ic._settings = None
+            ic._cell_indexes.clear()
+            ic._executed_cells.clear()
+            func = make(buffer, vim)
+
+            # Warm up caches, then count the round trips of a single run
+            func()
+            vim.round_trips = 0
+            func()
+            round_trips = vim.round_trips
+
+            seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+            results['{}/{}'.format(name, size)] = {
+                'seconds': seconds,
+                'round_trips': round_trips,
+            }
+    return results
+
+
+def compare(results, baseline, tolerance, min_difference=MIN_DIFFERENCE):
+    """Return a list of regressions of ``results`` compared to ``baseline``.
+
+    A benchmark regresses if it makes more round trips, or takes more than
+    ``tolerance`` times as long and more than ``min_difference`` seconds
+    longer than the baseline.
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        if result['round_trips'] > expected['round_trips']:
+            regressions.append('{}: {} round trips, baseline {}'.format(
+                key, result['round_trips'], expected['round_trips']))
+        if result['seconds'] > max(tolerance * expected['seconds'],
+                                   expected['seconds'] + min_difference):
+            regressions.append('{}: {:.3g} s, baseline {:.3g} s'.format(
+                key, result['seconds'], expected['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths of ipython_cell.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help="Buffer sizes in lines")
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        choices=[name for name, _ in BENCHMARKS],
+                        help="Benchmarks to run")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--save', action='store_true',
+                       help="Save the results as the baseline")
+    group.add_argument('--compare', action='store_true',
+                       help="Compare the results with the baseline")
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help="Allowed slowdown factor for --compare")
+    parser.add_argument('--min-difference', type=float,
+                        default=MIN_DIFFERENCE,
+                        help="Allowed slowdown in seconds for --compare")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.only, args.repeat)
+    for key in sorted(results, key=lambda k: (k.split('/')[0],
+                                              int(k.split('/')[1]))):
+        print('{:<24}{:>12.6f} s{:>10} round trips'.format(
+            key, results[key]['seconds'], results[key]['round_trips']))
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+    elif args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance,
+                              args.min_difference)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
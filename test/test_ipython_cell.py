@@ -1,30 +1,35 @@
 from __future__ import absolute_import
 
+import ast
+import json
+import os
+import pickle
+import re
+import shutil
+from subprocess import call
+import sys
+import tempfile
+import time
 import unittest
 
 from python import ipython_cell as ic
+from python.ipython_cell import _hash_cell
+from vim_stub import OPTIONS, Buffer, FakeBuffer, FakeVim
 
+try:
+    from ipykernel.inprocess.manager import InProcessKernelManager
+except ImportError:
+    InProcessKernelManager = None
 
-CELL_BOUNDARIES = [1, 4, 8, 15, 20]
-TAG = '##'
-
-
-class Buffer(object):
-    """A simple buffer-like object for testing."""
-    def __init__(self, contents=None, marks=None):
-        if contents is None:
-            contents = []
-        if marks is None:
-            marks = {}
-        self.contents = contents
-        self.marks = marks
+try:
+    from IPython.core.interactiveshell import InteractiveShell
+except ImportError:
+    InteractiveShell = None
 
-    def __iter__(self):
-        for element in self.contents:
-            yield element
 
-    def mark(self, mark):
-        return self.marks.get(mark, None)
+CELL_BOUNDARIES = [1, 4, 8, 15, 20]
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+TAG = '##'
 
 
 class TestIPythonCell(unittest.TestCase):
@@ -148,3 +153,1436 @@ class TestIPythonCell(unittest.TestCase):
         buffer = Buffer(marks=marks)
         rows = ic._get_rows_with_marks(buffer, valid_marks='abcdefg')
         self.assertEqual(rows, [1, 4, 8])
+
+    def test_apply_line_changes_insert_lines(self):
+        rows, dirty = ic._apply_line_changes([1, 4, 8], [(5, 5, 2)])
+        self.assertEqual(rows, [1, 4, 10])
+        self.assertEqual(dirty, [(5, 7)])
+
+    def test_apply_line_changes_delete_lines(self):
+        rows, dirty = ic._apply_line_changes([1, 4, 8, 15], [(4, 9, -5)])
+        self.assertEqual(rows, [1, 10])
+        self.assertEqual(dirty, [])
+
+    def test_apply_line_changes_keep_deleted(self):
+        _, dirty = ic._apply_line_changes([], [(4, 9, -5), (2, 3, 0)],
+                                          keep_deleted=True)
+        self.assertEqual(dirty, [(2, 3), (4, 4)])
+
+    def test_apply_line_changes_change_line(self):
+        rows, dirty = ic._apply_line_changes([1, 4, 8], [(4, 5, 0)])
+        self.assertEqual(rows, [1, 8])
+        self.assertEqual(dirty, [(4, 5)])
+
+    def test_apply_line_changes_overlapping_changes(self):
+        rows, dirty = ic._apply_line_changes([1, 4, 8, 20],
+                                             [(3, 4, 2), (5, 9, -1)])
+        self.assertEqual(rows, [1, 9, 21])
+        self.assertEqual(dirty, [(3, 8)])
+
+    def test_cell_index_incremental_update(self):
+        lines = ["## cell 1", "a = 1", "## cell 2", "b = 2"]
+        scan = lambda lines: ic._get_rows_with_tag(lines, TAG)
+        index = ic._CellIndex()
+        index.update(lines, 1, None, key=TAG, scan=scan)
+        self.assertEqual(index.rows, [1, 3])
+
+        lines[1:2] = ["a = 1", "## cell 1b", "c = 3"]
+        dirty = index.update(lines, 2, [(2, 3, 2)], key=TAG, scan=scan)
+        self.assertEqual(dirty, [(2, 5)])
+        self.assertEqual(index.rows, [1, 3, 5])
+
+    def test_cell_index_unreported_change(self):
+        lines = ["## cell 1", "a = 1", "## cell 2", "b = 2"]
+        scan = lambda lines: ic._get_rows_with_tag(lines, TAG)
+        index = ic._CellIndex()
+        index.update(lines, 1, None, key=TAG, scan=scan)
+
+        lines.insert(0, "## cell 0")
+        index.update(lines, 2, [], key=TAG, scan=scan)
+        self.assertEqual(index.rows, [1, 2, 4])
+
+    def test_cell_index_changed_ranges(self):
+        lines = ["## cell 1", "a = 1", "## cell 2", "b = 2"]
+        scan = lambda lines: ic._get_rows_with_tag(lines, TAG)
+        index = ic._CellIndex()
+        index.update(lines, 1, None, key=TAG, scan=scan)
+        self.assertIsNone(index.take_changed_ranges())
+        self.assertEqual(index.take_changed_ranges(), [])
+
+        lines[3] = "## cell 3"
+        index.update(lines, 2, [(4, 5, 0)], key=TAG, scan=scan)
+        lines[0:0] = ["import os", "import sys"]
+        index.update(lines, 3, [(1, 1, 2)], key=TAG, scan=scan)
+        self.assertEqual(index.take_changed_ranges(), [(1, 3), (6, 7)])
+        self.assertEqual(index.rows, [3, 5, 6])
+
+    def test_cell_index_cell_keys(self):
+        lines = ["a = 1", "## cell", "b = 2", "## cell", "c = 3"]
+        scan = lambda lines: ic._get_rows_with_tag(lines, TAG)
+        index = ic._CellIndex()
+        index.update(lines, 1, None, key=TAG, scan=scan)
+        cells = ic._get_cells(lines, [1, 2, 4], False, delimit_by_tags=True)
+        self.assertEqual([index.get_cell(lines, i) for i in range(3)], cells)
+        keys = index.cell_keys(lines)
+
+        lines[2] = "b = 3"
+        index.update(lines, 2, [(3, 4, 0)], key=TAG, scan=scan)
+        self.assertIs(index.cell_keys(lines), keys)
+
+        lines[1] = "## renamed cell"
+        index.update(lines, 3, [(2, 3, 0)], key=TAG, scan=scan)
+        self.assertEqual(index.cell_keys(lines),
+                         [("## renamed cell", 0), ("## cell", 0)])
+
+    def test_get_rows_with_tag_multiple_tags(self):
+        buffer = [
+            "# %% cell 1",
+            "a = 1",
+            "#%% cell 2",
+            "b = 2  # 100%",
+            "# <codecell>",
+        ]
+        rows = ic._get_rows_with_tag(buffer, ['# %%', '#%%', '# <codecell>'])
+        self.assertEqual(rows, [1, 3, 5])
+
+    def test_get_rows_with_tag_regex(self):
+        buffer = [
+            "# In[1]:",
+            "a = 1",
+            "# In[ ]:",
+            "## cell",
+        ]
+        rows = ic._get_rows_with_tag(buffer, [r'^# In\[[0-9 ]*\]:', r'^##'],
+                                     use_regex=True)
+        self.assertEqual(rows, [1, 3, 4])
+
+    def test_get_rows_with_tag_regex_not_combinable(self):
+        buffer = [
+            "# CELL",
+            "# cell",
+            "aa = 1",
+        ]
+        rows = ic._get_rows_with_tag(buffer, [r'(?i)^# cell', r'(a)\1'],
+                                     use_regex=True)
+        self.assertEqual(rows, [1, 2, 3])
+
+    def test_get_rows_with_tag_regex_back_reference(self):
+        buffer = [
+            "xy = 1",
+            "aa = 2",
+            "ab = 3",
+        ]
+        rows = ic._get_rows_with_tag(buffer, [r'^(x)y', r'^(a)\1'],
+                                     use_regex=True)
+        self.assertEqual(rows, [1, 2])
+
+    def test_get_rows_with_tag_regex_inline_flags(self):
+        buffer = [
+            "#X",
+            "#x",
+            "# CELL",
+        ]
+        rows = ic._get_rows_with_tag(buffer, [r'^#x', r'(?i)^# cell'],
+                                     use_regex=True)
+        self.assertEqual(rows, [2, 3])
+
+    def test_settings(self):
+        options = dict(OPTIONS, tag='##', regex='yes', valid_marks='abc ',
+                       prefer_external_copy='0', send_ctrl_c='1',
+                       send_ctrl_u=1, update_file_variable='0', send_async=1,
+                       sessions={'gpu': {'transport': 'tmpfile'}})
+        del options['slime_python_ipython']
+        del options['has_timers']
+        settings = ic._Settings(options)
+        self.assertEqual(settings.tag, ['##'])
+        self.assertTrue(settings.regex)
+        self.assertEqual(settings.valid_marks, 'abc')
+        self.assertFalse(settings.prefer_external_copy)
+        self.assertFalse(settings.send_cell_headers)
+        self.assertTrue(settings.send_ctrl_c)
+        self.assertTrue(settings.send_ctrl_u)
+        self.assertFalse(settings.slime_python_ipython)
+        self.assertFalse(settings.send_async)  # requires +timers
+        self.assertEqual(settings.sessions, {'gpu': {'transport': 'tmpfile'}})
+
+    def test_options_match_plugin(self):
+        with open(os.path.join(REPO_DIR, 'plugin', 'ipython-cell.vim')) as f:
+            names = re.findall(r"^let g:ipython_cell_(\w+) = get\(g:",
+                               f.read(), re.MULTILINE)
+        self.assertTrue(names)
+        self.assertEqual(set(names) - set(OPTIONS), set())
+
+    def test_get_cells(self):
+        buffer = [
+            "import numpy as np",
+            "## cell",
+            "a = 1",
+            "## cell",
+            "b = 2",
+            "## other cell",
+        ]
+        cells = ic._get_cells(buffer, [1, 2, 4, 6], False,
+                              delimit_by_tags=True)
+        self.assertEqual(cells, [
+            ic._Cell(1, 1, 1, ("", 0)),
+            ic._Cell(2, 3, 3, ("## cell", 0)),
+            ic._Cell(4, 5, 5, ("## cell", 1)),
+            ic._Cell(6, 6, 7, ("## other cell", 0)),
+        ])
+
+    def test_get_cells_marks(self):
+        buffer = ["a = 1", "b = 2", "c = 3"]
+        cells = ic._get_cells(buffer, [1, 2], False, delimit_by_tags=False)
+        self.assertEqual(cells, [
+            ic._Cell(1, 1, 1, ("", 0)),
+            ic._Cell(2, 3, 2, ("", 1)),
+        ])
+
+    def test_hash_cell_ignores_header(self):
+        cell = ic._Cell(1, 2, 2, ("## cell", 0))
+        hash1 = ic._hash_cell(["## cell", "a = 1"], cell)
+        hash2 = ic._hash_cell(["## renamed cell", "a = 1"], cell)
+        hash3 = ic._hash_cell(["## cell", "a = 2"], cell)
+        self.assertEqual(hash1, hash2)
+        self.assertNotEqual(hash1, hash3)
+
+    def test_get_names(self):
+        code = "\n".join([
+            "import numpy as np",
+            "from os import path as p",
+            "data = np.loadtxt(p.join(directory, 'data.txt'))",
+            "def scale(x):",
+            "    return factor * x",
+            "data['x'] = 1",
+            "total = total + 1",
+            "%matplotlib inline",
+            "data?",
+            "result = check(data)  # ok?",
+        ])
+        defined, used = ic._get_names(code)
+        self.assertEqual(defined,
+                         {'np', 'p', 'data', 'scale', 'total', 'result'})
+        self.assertEqual(used, {'directory', 'factor', 'total', 'check'})
+
+    def test_get_names_parameters(self):
+        code = "\n".join([
+            "def fit(x, y=default, *args, **kwargs):",
+            "    model = make_model(x)",
+            "    return model.fit(y, *args, **kwargs)",
+            "predict = lambda x, n=steps: model(x, n)",
+        ])
+        defined, used = ic._get_names(code)
+        self.assertEqual(defined, {'fit', 'predict'})
+        self.assertEqual(used, {'default', 'make_model', 'steps', 'model'})
+
+    def test_get_names_comprehensions(self):
+        code = "\n".join([
+            "squares = [x * x for x in values if x > limit]",
+            "pairs = {k: v for k, v in items for v in k}",
+            "total = sum(n for row in matrix for n in row)",
+            "first = [x for x in x]",
+        ])
+        defined, used = ic._get_names(code)
+        self.assertEqual(defined, {'squares', 'pairs', 'total', 'first'})
+        self.assertEqual(used, {'values', 'limit', 'items', 'sum', 'matrix',
+                                'x'})
+
+    def test_get_names_syntax_error(self):
+        self.assertIsNone(ic._get_names("for"))
+
+    def test_get_upstream_cells(self):
+        names = [
+            ({'data'}, set()),            # 0: load data
+            ({'unrelated'}, set()),       # 1: expensive, unrelated
+            ({'data'}, {'data'}),         # 2: clean data
+            ({'model'}, {'data'}),        # 3: fit model
+            None,                         # 4: cannot be parsed
+            ({'result'}, {'model'}),      # 5: current cell
+        ]
+        self.assertEqual(ic._get_upstream_cells(names, 5), {0, 2, 3})
+
+    def test_get_rows_with_marklist(self):
+        class Vim(object):
+            def eval(self, expression):
+                self.expression = expression
+                return ['8', '3']
+
+        ic.vim = Vim()
+        try:
+            rows = ic._get_rows_with_marklist(2, "ab'c")
+            self.assertEqual(ic.vim.expression,
+                             "ipython_cell#mark_rows(2, 'ab''c')")
+        finally:
+            del ic.vim
+        self.assertEqual(rows, [8, 3])
+
+    def test_get_outline(self):
+        buffer = Buffer(["import os", "  ## Load data", "a = 1", "## Plot"])
+        buffer.number = 3
+        self.assertEqual(ic._get_outline(buffer, [2, 4]), [
+            {'bufnr': 3, 'lnum': 2, 'text': "## Load data"},
+            {'bufnr': 3, 'lnum': 4, 'text': "## Plot"},
+        ])
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(ic._percentile(values, 50), 3)
+        self.assertEqual(ic._percentile(values, 90), 5)
+        self.assertEqual(ic._percentile(values, 0), 1)
+        self.assertEqual(ic._percentile(values, 100), 5)
+
+    def test_get_header_session(self):
+        self.assertEqual(ic._get_header_session("# %% Train [session=gpu]"),
+                         "gpu")
+        self.assertIsNone(ic._get_header_session("# %% [markdown]"))
+
+    def test_group_segments_by_session(self):
+        buffer = [
+            "import os",
+            "## a [session=gpu]",
+            "a = 1",
+            "## b [session=gpu]",
+            "b = 2",
+            "## c",
+            "c = 3",
+        ]
+        boundaries = [1, 2, 4, 6]
+        self.assertEqual(
+            ic._group_segments_by_session(buffer, [(1, 7)], boundaries,
+                                          False, 'cpu'),
+            [('cpu', [(1, 1)]), ('gpu', [(2, 5)]), ('cpu', [(6, 7)])])
+        self.assertEqual(
+            ic._group_segments_by_session(buffer, [(2, 3), (6, 7)],
+                                          boundaries, False),
+            [('gpu', [(2, 3)]), ('', [(6, 7)])])
+
+    def test_get_transport_for_session(self):
+        class Vim(object):
+            class current(object):
+                class buffer(object):
+                    vars = {'ipython_cell_session': b'explore'}
+
+        options = dict(OPTIONS, sessions={
+            'explore': {'transport': 'tmpfile'}})
+        ic.vim = Vim()
+        ic._settings = ic._Settings(options)
+        try:
+            transport = ic._get_transport()
+            self.assertIsInstance(transport, ic._TmpfileTransport)
+            self.assertEqual(transport.session, 'explore')
+            self.assertIs(ic._get_transport('explore'), transport)
+            self.assertIsInstance(ic._get_transport(''), ic._SlimeTransport)
+            self.assertNotIsInstance(ic._get_transport(''),
+                                     ic._TmpfileTransport)
+            self.assertIsNone(ic._get_transport('unknown'))
+        finally:
+            del ic.vim
+            ic._settings = None
+            ic._transports.clear()
+
+    def test_get_cell_code(self):
+        buffer = ["## a", "    x = 1", "## b", "    y = 2"]
+        ic._settings = ic._Settings(dict(OPTIONS, tag=['##'],
+                                         update_file_variable=1))
+        try:
+            lines, rows = ic._get_cell_lines(buffer, [(1, 4)], [1, 3], True)
+            self.assertEqual(lines, ["    x = 1", "", "    y = 2"])
+            self.assertEqual(rows, [2, 3, 4])
+            code, rows = ic._get_cell_code(lines, rows, "/a.py")
+            self.assertEqual(code.split("\n")[0], "    __file__ = '/a.py'")
+            self.assertEqual(rows, [2, 2, 3, 4])
+        finally:
+            ic._settings = None
+
+    def test_validate_code(self):
+        self.assertIsNone(ic._validate_code("x = 1\n%time f(x)\n!ls", "a"))
+        self.assertIsNone(ic._validate_code("    if x:\n        y = 1", "a"))
+        self.assertIsNone(ic._validate_code("%%bash\nls -l (", "a"))
+        self.assertIsNone(ic._validate_code("y = (1\n     % 2)", "a"))
+        self.assertIsNone(ic._validate_code("await f()", "a"))
+        for line in ["?obj", "??obj", "?os.path", "  ?x", "obj?", "os.path??",
+                     ",f a b", "/f a", ";f a b"]:
+            self.assertIsNone(ic._validate_code(line, "a"), line)
+            self.assertIsNone(ic._validate_code("if x:\n    " + line, "a"),
+                              line)
+        self.assertIsNone(ic._validate_code("y = (1\n     / 2)", "a"))
+        self.assertIsNone(ic._validate_code(
+            "%matplotlib inline\nx = (10\n     % 3)\n", "a"))
+        self.assertIsNone(ic._validate_code(
+            "%time f()\ns = \"\"\"a\n%b\"\"\"\nt = 1 \\\n    % 2", "a"))
+        self.assertIsNotNone(ic._validate_code("%time f()\nx = (", "a"))
+        self.assertIsNotNone(ic._validate_code("x = (  # ok?", "a"))
+
+        lineno, col, message = ic._validate_code("    x = 1\n    y = (", "a")
+        self.assertEqual(lineno, 2)
+        self.assertGreater(col, 4)
+        self.assertTrue(message)
+
+    def test_validate_blocks(self):
+        class Vim(FakeVim):
+            def eval(self, expression):
+                self.evals.append(expression)
+                return super(Vim, self).eval(expression)
+
+        buffer = FakeBuffer(["## a", "x = (", "## b", "y = 1"])
+        vim = Vim(buffer)
+        vim.evals = []
+        ic.vim = vim
+        try:
+            blocks = [('', [(1, 2)], ["x = ("], "x = (", [2]),
+                      ('', [(3, 4)], ["y = 1"], "y = 1", [4])]
+            self.assertFalse(ic._validate_blocks(buffer, blocks))
+            self.assertEqual(len(vim.evals), 1)
+            items = json.loads(
+                re.match(r'ipython_cell#set_errors\((.*)\)$',
+                         vim.evals[0]).group(1))
+            self.assertEqual([item['lnum'] for item in items], [2])
+
+            # The errors are cleared once, then nothing is sent to Vim
+            self.assertTrue(ic._validate_blocks(buffer, blocks[1:]))
+            self.assertTrue(ic._validate_blocks(buffer, blocks[1:]))
+            self.assertEqual(vim.evals[1:], ['ipython_cell#set_errors([])'])
+        finally:
+            del ic.vim
+            ic._syntax_errors_shown = False
+
+    def test_format_time(self):
+        self.assertEqual(ic._format_time(2.5), "2.5 s")
+        self.assertEqual(ic._format_time(0.0123), "12.3 ms")
+        self.assertEqual(ic._format_time(4e-6), "4 us")
+        self.assertEqual(ic._format_time(5e-8), "50 ns")
+
+    def test_format_profile(self):
+        buffer = ["## cell", "import time", "time.sleep(1)", "x = 1"]
+        result = {'mode': 'prun', 'stats': [
+            ['t.py', 1, '<module>', 1, 0.001, 1.5],
+            ['~', 0, '<built-in method time.sleep>', 1, 1.0, 1.0],
+            ['other.py', 7, 'g', 2, 0.25, 0.5],
+        ]}
+        lines, jumps = ic._format_profile(result, buffer, '/home/t.py',
+                                          (1, 4))
+        self.assertEqual(lines[0], "%prun of rows 1-4 of t.py")
+        self.assertTrue(lines[3].endswith("  t.py:1(<module>)"))
+        self.assertTrue(lines[4].endswith("  <built-in method time.sleep>"))
+        self.assertTrue(lines[5].endswith("  other.py:7(g)"))
+        self.assertEqual(jumps, {'4': 1})
+
+        result = {'mode': 'lprun',
+                  'timings': [[2, 1, 0.001], [3, 1, 1.0], [3, 1, 1.0],
+                              [4, 1, 0.0]]}
+        lines, jumps = ic._format_profile(result, buffer, 't.py', (1, 4))
+        self.assertEqual(lines[3].split(), ["3", "2", "2", "s", "100.0",
+                                            "time.sleep(1)"])
+        self.assertEqual(jumps, {'4': 3, '5': 2, '6': 4})
+
+        lines, jumps = ic._format_profile(
+            {'mode': 'timeit', 'error': "NameError: x"}, buffer, 't.py',
+            (1, 4))
+        self.assertEqual(lines[2:], ["Error: NameError: x"])
+        self.assertEqual(jumps, {})
+
+    def _apply_edit(self, lines, edit):
+        lines = list(lines)
+        lines[edit.start_row-1:edit.end_row] = edit.lines
+        return lines, edit.cursor
+
+    def test_edit_insert_cell(self):
+        lines = ["import os", "", "## A", "a = 1", "", "## B", "b = 2"]
+        boundaries = [1, 3, 6]
+
+        edit = ic._edit_insert_cell_below(lines, boundaries, (4, 0), "# %% ")
+        self.assertEqual(self._apply_edit(lines, edit), (
+            ["import os", "", "## A", "a = 1", "", "# %% ", "", "## B",
+             "b = 2"], (6, 4)))
+
+        edit = ic._edit_insert_cell_below(lines, boundaries, (7, 0), "# %% ")
+        self.assertEqual(self._apply_edit(lines, edit), (
+            lines + ["", "# %% "], (9, 4)))
+
+        edit = ic._edit_insert_cell_above(lines, boundaries, False, (4, 0),
+                                          "# %% ")
+        self.assertEqual(self._apply_edit(lines, edit), (
+            ["import os", "", "# %% ", "", "## A", "a = 1", "", "## B",
+             "b = 2"], (3, 4)))
+
+        edit = ic._edit_insert_cell_above(lines, boundaries, False, (1, 0),
+                                          "# %% ")
+        self.assertEqual(self._apply_edit(lines, edit), (
+            ["# %% "] + lines, (1, 4)))
+
+    def test_edit_to_markdown(self):
+        lines = ["## A", "Some text", "", "## B", "b = 2"]
+        edit = ic._edit_to_markdown(lines, [1, 4], True, (2, 0), "# %% ")
+        self.assertEqual(self._apply_edit(lines, edit), (
+            ["## A [markdown]", '"""', "Some text", '"""', "", "## B",
+             "b = 2"], (3, 0)))
+
+        edit = ic._edit_to_markdown(lines, [1, 4], True, (5, 0), "# %% ")
+        self.assertEqual(self._apply_edit(lines, edit)[0], [
+            "## A", "Some text", "", "## B [markdown]", '"""', "b = 2",
+            '"""'])
+
+    def test_edit_split_merge_cell(self):
+        lines = ["## A", "a = 1", "b = 2"]
+        self.assertIsNone(ic._edit_split_cell(lines, [1], (1, 0), "##"))
+
+        edit = ic._edit_split_cell(lines, [1], (3, 0), "##")
+        split, cursor = self._apply_edit(lines, edit)
+        self.assertEqual(split, ["## A", "a = 1", "", "##", "b = 2"])
+        self.assertEqual(cursor, (4, 1))
+
+        self.assertIsNone(ic._edit_merge_cell([1, 4], (4, 0)))
+        edit = ic._edit_merge_cell([1, 4], (2, 3))
+        self.assertEqual(self._apply_edit(split, edit),
+                         (["## A", "a = 1", "", "b = 2"], (2, 3)))
+
+    def test_edit_move_cell(self):
+        lines = ["import os", "## A", "a = 1", "## B", "b = 2", "c = 3"]
+        boundaries = [1, 2, 4]
+
+        edit = ic._edit_move_cell(lines, boundaries, False, (3, 2), 1)
+        self.assertEqual(self._apply_edit(lines, edit), (
+            ["import os", "## B", "b = 2", "c = 3", "## A", "a = 1"],
+            (6, 2)))
+
+        edit = ic._edit_move_cell(lines, boundaries, False, (6, 0), -1)
+        self.assertEqual(self._apply_edit(lines, edit), (
+            ["import os", "## B", "b = 2", "c = 3", "## A", "a = 1"],
+            (4, 0)))
+
+        # The first cell has no header and stays in place
+        self.assertIsNone(ic._edit_move_cell(lines, boundaries, False,
+                                             (3, 0), -1))
+        self.assertIsNone(ic._edit_move_cell(lines, boundaries, False,
+                                             (5, 0), 1))
+        edit = ic._edit_move_cell(lines[1:], [1, 3], True, (1, 0), 1)
+        self.assertEqual(self._apply_edit(lines[1:], edit)[0],
+                         ["## B", "b = 2", "c = 3", "## A", "a = 1"])
+
+    def test_edit_delete_cell(self):
+        lines = ["## A", "a = 1", "## B", "b = 2"]
+        edit = ic._edit_delete_cell(lines, [1, 3], (2, 0))
+        self.assertEqual(self._apply_edit(lines, edit),
+                         (["## B", "b = 2"], (1, 0)))
+        edit = ic._edit_delete_cell(lines, [1, 3], (4, 0))
+        self.assertEqual(self._apply_edit(lines, edit),
+                         (["## A", "a = 1"], (3, 0)))
+
+
+@unittest.skipIf(InProcessKernelManager is None, "ipykernel is not installed")
+class TestJupyterTransport(unittest.TestCase):
+    def setUp(self):
+        self.kernel_manager = InProcessKernelManager()
+        self.kernel_manager.start_kernel()
+        self.client = self.kernel_manager.client()
+        self.client.start_channels()
+        self.transport = ic._JupyterTransport(self.client)
+
+    def tearDown(self):
+        self.client.stop_channels()
+        self.kernel_manager.shutdown_kernel()
+
+    def test_send_cell(self):
+        self.transport.send_cell("numbers = [1, 2, 3]\ntotal = sum(numbers)")
+        user_ns = self.kernel_manager.kernel.shell.user_ns
+        self.assertEqual(user_ns['total'], 6)
+
+    def test_previous_command(self):
+        self.transport.send_cell("counter = 0")
+        self.transport.send_command("counter += 1")
+        self.transport.previous_command()
+        user_ns = self.kernel_manager.kernel.shell.user_ns
+        self.assertEqual(user_ns['counter'], 2)
+
+
+class FakeClipboard(ic._Clipboard):
+    PROGRAMS = [
+        ["ipython-cell-nonexistent-program"],
+        ["true"],
+    ]
+
+
+class TestClipboard(unittest.TestCase):
+    def test_find_program(self):
+        clipboard = FakeClipboard()
+        program = clipboard.find_program()
+        self.assertTrue(program[0].endswith("true"))
+        self.assertIs(clipboard.find_program(), program)
+
+    def test_find_program_not_found(self):
+        clipboard = FakeClipboard()
+        program = clipboard.find_program("ipython-cell-nonexistent-program")
+        self.assertIsNone(program)
+
+    def test_copy_records_latency(self):
+        clipboard = FakeClipboard()
+        clipboard.copy("a = 1")
+        self.assertEqual(len(clipboard.latencies), 1)
+
+    def test_copy_async(self):
+        clipboard = FakeClipboard()
+        job = clipboard.copy_async("a = 1", "ipython-cell-nonexistent-program")
+        job.join()
+        self.assertIsInstance(job.error, ic._ClipboardError)
+
+
+class SendQueue(ic._SendQueue):
+    """A send queue that does not start Vim timers."""
+    def schedule(self, delay):
+        return delay
+
+
+class RecordingTransport(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_keys(self, string):
+        self.sent.append(('keys', string))
+
+    def clear_prompt(self):
+        self.sent.append(('clear_prompt',))
+
+    def send_command(self, string):
+        self.sent.append(('command', string))
+
+    def send_cell(self, cell):
+        self.sent.append(('cell', cell))
+
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingTransport()
+        self.queue = SendQueue()
+        self.queued = ic._QueuedTransport(self.transport, self.queue)
+
+    def test_operations_run_in_order(self):
+        self.queued.send_command("a = 1")
+        self.queued.send_cell("b = 2")
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.transport.sent, [])
+
+        self.assertIsNone(self.queue.drain())
+        self.assertEqual(self.transport.sent,
+                         [('command', 'a = 1'), ('cell', 'b = 2')])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_coalesce_control_sequences(self):
+        self.queued.clear_prompt()
+        self.queued.clear_prompt()
+        self.queued.send_keys(ic.CTRL_U)
+        self.queued.send_keys(ic.CTRL_U)
+        self.queued.send_keys("x")
+        self.queued.send_keys("x")
+        self.assertEqual(len(self.queue), 4)
+
+    def test_waiting_operation(self):
+        ready = []
+
+        def wait_until_ready():
+            while not ready:
+                yield
+            self.transport.send_command("ready")
+
+        self.queue.push(wait_until_ready())
+        self.queued.send_command("after")
+        self.assertEqual(self.queue.drain(), 5)
+        self.assertEqual(self.transport.sent, [])
+
+        ready.append(True)
+        self.assertIsNone(self.queue.drain())
+        self.assertEqual(self.transport.sent,
+                         [('command', 'ready'), ('command', 'after')])
+
+
+class TestExecuteCells(unittest.TestCase):
+    BUFFER = [
+        "import os",
+        "## a",
+        "x = 1",
+        "## b",
+        "y = 2",
+        "## c",
+        "z = 3",
+    ]
+
+    def setUp(self):
+        self.buffer = FakeBuffer(list(self.BUFFER))
+        ic.vim = FakeVim(self.buffer)
+        self.buffer.vim = ic.vim
+        ic._settings = ic._Settings(dict(OPTIONS, tag=['##']))
+        self.transport = RecordingTransport()
+        ic._transports[('', 'slime', None)] = self.transport
+
+    def tearDown(self):
+        del ic.vim
+        ic._settings = None
+        ic._transports.clear()
+        ic._forget_buffer(self.buffer.number)
+
+    def execute(self, which, row, first_row=None, last_row=None):
+        ic.vim.current.window.cursor = (row, 0)
+        self.transport.sent = []
+        ic.execute_cells(which, first_row=first_row, last_row=last_row)
+        return [item for item in self.transport.sent
+                if item != ('clear_prompt',)]
+
+    def test_above(self):
+        self.assertEqual(self.execute('above', 5),
+                         [('cell', "import os\n\nx = 1")])
+        self.assertEqual(self.execute('above', 1), [])
+        self.assertIsNone(ic._timings.current)
+
+    def test_no_transport(self):
+        del ic._transports[('', 'slime', None)]
+        ic._settings.transport = 'unknown'
+        self.execute('all', 1)
+        self.assertIsNone(ic._timings.current)
+
+    def test_below(self):
+        self.assertEqual(self.execute('below', 5),
+                         [('cell', "y = 2\n\nz = 3")])
+
+    def test_all(self):
+        self.assertEqual(self.execute('all', 5),
+                         [('cell', "import os\n\nx = 1\n\ny = 2\n\nz = 3")])
+
+    def test_range(self):
+        self.assertEqual(self.execute('range', 1, 3, 5),
+                         [('cell', "x = 1\n\ny = 2")])
+        self.assertEqual(self.execute('range', 1, 7, 7),
+                         [('cell', "z = 3")])
+
+    def test_executed_cells_not_tracked(self):
+        self.execute('all', 1)
+        self.assertNotIn(self.buffer.number, ic._executed_cells)
+
+    def test_executed_cells(self):
+        ic._settings.stale_signs = True
+        self.execute('range', 1, 4, 5)
+        executed = ic._executed_cells[self.buffer.number]
+        self.assertEqual(list(executed), [("## b", 0)])
+
+        self.transport.sent = []
+        ic.execute_stale_cells()
+        self.assertEqual(self.transport.sent[-1],
+                         ('cell', "import os\n\nx = 1\nz = 3"))
+        self.transport.sent = []
+        ic.execute_stale_cells()
+        self.assertEqual(self.transport.sent, [])
+
+    def test_empty_cell(self):
+        self.buffer.contents[:] = ["## a", "", "## b", "x = 1"]
+        boundaries, first_line_contains_cell_header = \
+            ic._get_cell_boundaries_with_first_line()
+        ic._execute_rows(1, 2, boundaries, first_line_contains_cell_header)
+        self.assertEqual(self.transport.sent[-1], ('command', "# empty cell"))
+
+
+class SignVim(FakeVim):
+    """``FakeVim`` that reports line changes and keeps track of the placed
+    signs, which move with their line like in Vim."""
+    def __init__(self, buffer):
+        super(SignVim, self).__init__(buffer)
+        self.changedtick = 1
+        self.changes = []
+        self.signs = {}
+        self.num_placed = 0
+
+    def edit(self, start, end, lines):
+        """Replace rows ``start`` to ``end`` (exclusive) with ``lines``."""
+        self.current.buffer.contents[start-1:end-1] = lines
+        added = len(lines) - (end - start)
+        self.changedtick += 1
+        self.changes.append([start, end, added])
+        for id, (row, name) in list(self.signs.items()):
+            if row >= end:
+                self.signs[id] = (row + added, name)
+            elif row >= start:
+                self.signs[id] = (min(row, start + len(lines) - 1), name)
+
+    def eval(self, expression):
+        if expression.startswith('ipython_cell#buffer_changes('):
+            self.round_trips += 1
+            changes, self.changes = self.changes, []
+            return ['1', str(self.changedtick), changes]
+        elif expression.startswith('ipython_cell#update_signs('):
+            self.round_trips += 1
+            _, removed, placed = ast.literal_eval(
+                expression[len('ipython_cell#update_signs'):])
+            if removed == '*':
+                removed = list(self.signs)
+            for id in removed:
+                del self.signs[id]
+            for id, row, name in placed:
+                self.signs[id] = (row, name)
+            self.num_placed = len(placed)
+            return '0'
+        return super(SignVim, self).eval(expression)
+
+    def get_signs(self):
+        return sorted((row, name[len('IPythonCell'):])
+                      for row, name in self.signs.values())
+
+
+class TestStaleSigns(unittest.TestCase):
+    def setUp(self):
+        self.buffer = FakeBuffer(list(TestExecuteCells.BUFFER))
+        ic.vim = SignVim(self.buffer)
+        self.buffer.vim = ic.vim
+        ic._settings = ic._Settings(dict(OPTIONS, tag=['##'],
+                                         stale_signs=1))
+        ic._transports[('', 'slime', None)] = RecordingTransport()
+        self.hashed = []
+        ic._hash_cell = self.hash_cell
+
+    def tearDown(self):
+        del ic.vim
+        ic._settings = None
+        ic._transports.clear()
+        ic._forget_buffer(self.buffer.number)
+        del ic._hash_cell
+
+    def hash_cell(self, buffer, cell):
+        self.hashed.append(cell.start_row)
+        return _hash_cell(buffer, cell)
+
+    def test_signs(self):
+        ic.execute_cells('range', first_row=4, last_row=5)
+        self.assertEqual(ic.vim.get_signs(), [
+            (1, 'Stale'), (2, 'Stale'), (4, 'Fresh'), (6, 'Stale')])
+
+        # Only the edited cell is hashed again and gets a new sign
+        self.hashed = []
+        ic.vim.edit(5, 6, ["y = 3"])
+        ic.update_stale_signs()
+        self.assertEqual(self.hashed, [4])
+        self.assertEqual(ic.vim.num_placed, 1)
+        self.assertEqual(ic.vim.get_signs(), [
+            (1, 'Stale'), (2, 'Stale'), (4, 'Stale'), (6, 'Stale')])
+
+        # Signs that keep their state are not placed again
+        ic.execute_cells('range', first_row=6, last_row=7)
+        self.hashed = []
+        ic.vim.num_placed = 0
+        ic.vim.edit(3, 3, ["import sys"])
+        ic.update_stale_signs()
+        self.assertEqual(self.hashed, [2])
+        self.assertEqual(ic.vim.num_placed, 0)
+        self.assertEqual(ic.vim.get_signs(), [
+            (1, 'Stale'), (2, 'Stale'), (5, 'Stale'), (7, 'Fresh')])
+
+        ic.vim.edit(1, 1, ["import sys"])
+        ic.vim.edit(7, 8, ["y = 2"])
+        ic.update_stale_signs()
+        self.assertEqual(ic.vim.get_signs(), [
+            (1, 'Stale'), (3, 'Stale'), (6, 'Fresh'), (8, 'Fresh')])
+
+    def test_signs_removed_header(self):
+        ic.execute_cells('all')
+        ic.vim.edit(4, 5, [])
+        ic.update_stale_signs()
+        self.assertEqual(ic.vim.get_signs(), [
+            (1, 'Fresh'), (2, 'Stale'), (5, 'Fresh')])
+
+        ic.vim.edit(4, 4, ["## b"])
+        ic.update_stale_signs()
+        self.assertEqual(ic.vim.get_signs(), [
+            (1, 'Fresh'), (2, 'Fresh'), (4, 'Fresh'), (6, 'Fresh')])
+
+
+@unittest.skipIf(InteractiveShell is None, "IPython is not installed")
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.shell = InteractiveShell.instance()
+        self.profiler = ic._Profiler()
+
+    def tearDown(self):
+        self.profiler.cleanup()
+
+    def profile(self, mode, code, first_row):
+        driver = self.profiler.start(mode, code, first_row, '/tmp/cell.py',
+                                     1, (first_row - 1, first_row + 3))
+        self.assertIsNone(self.profiler.poll())
+        self.shell.user_ns['__file__'] = '/a.py'
+        self.shell.run_cell(ic._run_helper_command(driver))
+        self.assertEqual(self.shell.user_ns.pop('__file__'), '/a.py')
+        return self.profiler.poll()
+
+    def test_prun(self):
+        code = "def f():\n    return 1\n\nx = f()"
+        result = self.profile('prun', code, 10)
+        self.assertEqual(self.shell.user_ns['x'], 1)
+        self.assertNotIn('_ipython_cell_code', self.shell.user_ns)
+        self.assertNotIn('_ipython_cell_profile', self.shell.user_ns)
+        rows = [row for path, row, function, _, _, _ in result['stats']
+                if function == 'f']
+        self.assertEqual(rows, [10])
+
+    def test_timeit(self):
+        result = self.profile('timeit', "y = 2 ** 10", 2)
+        self.assertGreater(result['timeit']['loops'], 0)
+        self.assertGreaterEqual(result['timeit']['average'],
+                                result['timeit']['best'])
+
+    def test_error(self):
+        result = self.profile('prun', "undefined_name", 2)
+        self.assertIn("NameError", result['error'])
+
+        self.profiler.finish()
+        self.assertIsNone(self.profiler.job)
+
+
+class TestRuntimeHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = ic._RuntimeHistory()
+        fd, self.database = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        self.history.cleanup()
+        if self.history.connection is not None:
+            self.history.connection.close()
+        os.remove(self.database)
+
+    def test_database(self):
+        for started, seconds in [(1, 1.0), (3, 3.0), (2, 2.0)]:
+            self.history.add(self.database, '/a.py', 'abc', started, seconds)
+        self.history.add(self.database, '/a.py', 'def', 4, 4.0)
+        self.assertEqual(self.history.get_runs(self.database, '/a.py', 'abc'),
+                         [3.0, 2.0, 1.0])
+        self.assertEqual(
+            self.history.get_runs(self.database, '/a.py', 'abc', limit=1),
+            [3.0])
+        self.assertEqual(self.history.get_runs(self.database, '/b.py', 'abc'),
+                         [])
+
+    def test_runtime_summary(self):
+        summary = ic._runtime_summary([5.0, 1.0, 1.0, 2.0], regression=2.0)
+        self.assertEqual(summary['last'], 5.0)
+        self.assertEqual(summary['median'], 1.0)
+        self.assertEqual(summary['runs'], 4)
+        self.assertEqual(summary['ratio'], 5.0)
+        self.assertTrue(summary['regressed'])
+
+        # Too few earlier runs to tell
+        self.assertFalse(ic._runtime_summary([5.0, 1.0])['regressed'])
+        self.assertIsNone(ic._runtime_summary([5.0])['ratio'])
+
+    def test_poll_runtimes_keeps_other_runs(self):
+        add = self.history.add
+
+        def failing_add(database, path, *args):
+            if path == '/bad.py':
+                raise ValueError("bad")
+            return add(database, path, *args)
+
+        runs = [((2, path, 'abc', 1), {'started': 1, 'seconds': 1.0})
+                for path in ['/bad.py', '/a.py']]
+        self.history.add = failing_add
+        self.history.read_results = lambda: runs
+        history, ic._runtime_history = ic._runtime_history, self.history
+        ic.vim = FakeVim(FakeBuffer([]))
+        ic._settings = ic._Settings(dict(OPTIONS,
+                                         runtime_history_file=self.database))
+        try:
+            ic.poll_runtimes()
+        finally:
+            ic._runtime_history = history
+            ic._settings = None
+            del ic.vim
+        self.assertEqual(self.history.get_runs(self.database, '/a.py', 'abc'),
+                         [1.0])
+
+    @unittest.skipIf(InteractiveShell is None, "IPython is not installed")
+    def test_record_runtime(self):
+        shell = InteractiveShell.instance()
+        key = (1, '/a.py', 'abc', 3)
+        shell.user_ns['__file__'] = '/a.py'
+        shell.run_cell(self.history.arm(key))
+        self.assertEqual(self.history.read_results(), [])
+        self.assertEqual(shell.user_ns.pop('__file__'), '/a.py')
+        shell.run_cell("import time; time.sleep(0.01)")
+        shell.run_cell("y = 1")
+
+        runs = self.history.read_results()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0][0], key)
+        self.assertGreaterEqual(runs[0][1]['seconds'], 0.01)
+        self.assertFalse(runs[0][1]['error'])
+        self.assertEqual(self.history.pending, {})
+        self.assertNotIn('_ipython_cell_runtime', shell.user_ns)
+
+        shell.run_cell(self.history.arm(key))
+        shell.run_cell("1 / 0")
+        self.assertTrue(self.history.read_results()[0][1]['error'])
+
+
+class ZeroCopyBytes(bytearray):
+    """``bytearray`` that is pickled with an out-of-band buffer."""
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return type(self)._reconstruct, (pickle.PickleBuffer(self),)
+        return type(self)._reconstruct, (bytearray(self),)
+
+    @classmethod
+    def _reconstruct(cls, buffer):
+        return cls(buffer)
+
+
+@unittest.skipIf(InteractiveShell is None, "IPython is not installed")
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        ic.vim = FakeVim(FakeBuffer([]))
+        ic._settings = ic._Settings(dict(OPTIONS,
+                                         checkpoint_dir=self.directory))
+        self.shell = InteractiveShell.instance()
+        self.shell.reset()
+
+    def tearDown(self):
+        del ic.vim
+        ic._settings = None
+        shutil.rmtree(self.directory)
+        self.shell.reset()
+
+    def run_command(self, action, names=()):
+        self.shell.user_ns['__file__'] = '/a.py'
+        self.assertTrue(self.shell.run_cell(
+            ic._checkpoint_command(action, names)).success)
+        self.assertEqual(self.shell.user_ns.pop('__file__'), '/a.py')
+
+    def test_save_and_load(self):
+        self.shell.run_cell("import os\n"
+                            "data = {'a': [1, 2]}\n"
+                            "numbers = list(range(5))\n"
+                            "gen = (i for i in range(3))")
+        self.shell.user_ns['blob'] = ZeroCopyBytes(b'x' * 1000)
+        self.run_command('save')
+
+        directory = os.path.join(self.directory, 'default')
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(manifest), ['blob', 'data', 'numbers'])
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            self.assertEqual(manifest['blob']['buffers'], 1)
+        self.assertNotIn('_ipython_cell_checkpoint', self.shell.user_ns)
+
+        for name in ['data', 'blob', 'numbers']:
+            del self.shell.user_ns[name]
+        self.run_command('load', ['data', 'blob'])
+        self.assertEqual(self.shell.user_ns['data'], {'a': [1, 2]})
+        self.assertEqual(self.shell.user_ns['blob'], b'x' * 1000)
+        self.assertNotIn('numbers', self.shell.user_ns)
+
+    def test_invalid_names(self):
+        self.assertIsNone(ic._checkpoint_command('save', ['a', 'b; c']))
+
+
+class TestOutputPane(unittest.TestCase):
+    TRACEBACK = [
+        "In [3]:",
+        "---------------------------------------------------------------",
+        "ZeroDivisionError              Traceback (most recent call last)",
+        "Cell In[3], line 3",
+        "      1 x = 1",
+        "      2 y = 2",
+        "----> 3 z = x / 0",
+        "",
+        "File ~/lib/util.py:12, in f(a)",
+        "     11 def f(a):",
+        "---> 12     return a / 0",
+        "",
+        "ZeroDivisionError: division by zero",
+    ]
+
+    def setUp(self):
+        self.output = ic._OutputPane()
+        self.output.directory = tempfile.mkdtemp()
+        self.output.path = os.path.join(self.output.directory, 'output.log')
+        ic._settings = ic._Settings(dict(OPTIONS, tag=['##']))
+
+    def tearDown(self):
+        self.output.cleanup()
+        ic._settings = None
+
+    def write(self, data):
+        with open(self.output.path, 'ab') as f:
+            f.write(data)
+
+    def test_parse_traceback_location(self):
+        lines = self.TRACEBACK
+        self.assertEqual(ic._parse_traceback_location(lines, 4),
+                         (None, 3, "z = x / 0"))
+        self.assertEqual(ic._parse_traceback_location(lines, 5),
+                         (None, 1, "x = 1"))
+        self.assertEqual(ic._parse_traceback_location(lines, 9),
+                         ("~/lib/util.py", 12, "    return a / 0"))
+        self.assertEqual(
+            ic._parse_traceback_location(
+                ['  File "/a.py", line 7, in <module>'], 1),
+            ("/a.py", 7, None))
+        self.assertIsNone(ic._parse_traceback_location(lines, 13))
+
+    def test_read(self):
+        self.assertEqual(self.output.read(100), [])
+        self.write(b"one\n\x1b[0;31mtwo\x1b[0m\nthr")
+        self.assertEqual(self.output.read(100), ["one", "two"])
+        self.write(b"ee\n10%\r50%\r100%\n")
+        self.assertEqual(self.output.read(100), ["three", "100%"])
+
+        # Only the last lines of a lot of output
+        self.write(b"".join(b"line %d\n" % i for i in range(100)))
+        lines = self.output.read(30)
+        self.assertTrue(lines[0].startswith("["))
+        self.assertEqual(lines[1:], ["line 97", "line 98", "line 99"])
+
+        # Truncated by IPython
+        open(self.output.path, 'w').close()
+        self.write(b"new\n")
+        self.assertEqual(self.output.read(100), ["new"])
+
+    def test_locate(self):
+        buffer = FakeBuffer(["## a", "x = 1", "y = 2", "z = x / 0"])
+        buffer.number = 3
+        ic.vim = FakeVim(FakeBuffer([]))
+        ic.vim.buffers = {3: buffer}
+        self.addCleanup(ic._forget_buffer, 3)
+        try:
+            self.output.record(3, [2, 3, 4])
+            self.assertEqual(self.output.locate(None, 3, "z = x / 0"),
+                             (3, 4))
+
+            # The line moved since the cell was executed
+            buffer.contents.insert(2, "w = 0")
+            self.assertEqual(self.output.locate(None, 3, "z = x / 0"),
+                             (3, 5))
+            self.assertIsNone(self.output.locate(None, 3, "other"))
+            self.write(b"")
+            self.assertEqual(self.output.locate(self.output.path, 1, None),
+                             (self.output.path, 1))
+        finally:
+            del ic.vim
+
+    @unittest.skipIf(InteractiveShell is None, "IPython is not installed")
+    def test_helper(self):
+        shell = InteractiveShell.instance()
+        helper = os.path.join(self.output.directory, 'output.py')
+        with open(helper, 'w') as f:
+            f.write(ic._OUTPUT_HELPER)
+
+        stdout, stderr = sys.stdout, sys.stderr
+        try:
+            shell.user_ns['__file__'] = '/a.py'
+            shell.run_cell(ic._run_helper_command(
+                helper, ['"{}"'.format(self.output.path), 1000]))
+            self.assertEqual(shell.user_ns.pop('__file__'), '/a.py')
+            shell.run_cell("print('hello')", store_history=True)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            log = shell.user_ns.pop('_ipython_cell_output_log')
+            shell.events.unregister('pre_run_cell', log.pre_run_cell)
+            log.file.close()
+
+        lines = self.output.read(1000)
+        self.assertEqual(lines[-1], "hello")
+        self.assertTrue(lines[-2].startswith("In ["))
+
+
+class TestNotebook(unittest.TestCase):
+    NOTEBOOK = {
+        'cells': [
+            {'cell_type': 'markdown', 'id': 'm1', 'metadata': {},
+             'source': ['# Title\n', 'Some "text" with {braces]']},
+            {'cell_type': 'code', 'execution_count': 1, 'id': 'c1',
+             'metadata': {'tags': ['setup']},
+             'outputs': [{'data': {'image/png': 'A' * 100000},
+                          'metadata': {}, 'output_type': 'display_data'}],
+             'source': ['import os\n', "x = '}]'\n"]},
+            {'cell_type': 'code', 'execution_count': 2, 'id': 'c2',
+             'metadata': {}, 'outputs': [], 'source': 'y = 1'},
+        ],
+        'metadata': {'kernelspec': {'name': 'python3'}},
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+
+    def setUp(self):
+        ic._settings = ic._Settings(dict(OPTIONS))
+        fd, self.path = tempfile.mkstemp(suffix='.ipynb')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.NOTEBOOK, f, indent=1)
+
+    def tearDown(self):
+        os.remove(self.path)
+        ic._settings = None
+
+    def read_percent(self):
+        with ic._Notebook(self.path) as notebook:
+            self.assertEqual(notebook.nbformat_minor, 5)
+            self.assertNotIn('outputs', notebook.cells[1])
+            lines = ic._notebook_to_percent(notebook.cells, '# %% ')
+        cell_boundaries = ic._get_rows_with_tag(lines, ['# %%'])
+        return ic._percent_to_cells(lines, cell_boundaries, True), lines
+
+    def test_read(self):
+        cells, lines = self.read_percent()
+        self.assertEqual(lines, [
+            '# %% [markdown]', '"""', '# Title', 'Some "text" with {braces]',
+            '"""', '', '# %%', 'import os', "x = '}]'", '', '# %%', 'y = 1'])
+        self.assertEqual(cells, [
+            ('markdown', '# Title\nSome "text" with {braces]'),
+            ('code', "import os\nx = '}]'"),
+            ('code', 'y = 1')])
+
+    def test_write(self):
+        cells, _ = self.read_percent()
+        cells[2] = ('code', 'y = 2')
+        cells.append(('raw', 'z'))
+        self.assertEqual(ic._write_notebook(self.path, cells, self.path), 2)
+
+        with open(self.path) as f:
+            notebook = json.load(f)
+        self.assertEqual(notebook['metadata'],
+                         self.NOTEBOOK['metadata'])
+        self.assertEqual(notebook['cells'][:2], self.NOTEBOOK['cells'][:2])
+        self.assertEqual(notebook['cells'][2]['source'], ['y = 2'])
+        self.assertEqual(notebook['cells'][2]['outputs'], [])
+        self.assertEqual(notebook['cells'][3]['cell_type'], 'raw')
+        self.assertNotIn('outputs', notebook['cells'][3])
+
+    def test_write_new(self):
+        os.remove(self.path)
+        ic._write_notebook(self.path, [('code', 'x = 1\ny = 2')])
+        with open(self.path) as f:
+            notebook = json.load(f)
+        self.assertEqual(notebook['nbformat'], 4)
+        self.assertEqual(notebook['cells'][0]['source'], ['x = 1\n', 'y = 2'])
+
+    def test_invalid(self):
+        with open(self.path, 'w') as f:
+            f.write('{"cells": [{"source": "x"')
+        self.assertRaises(ValueError, ic._Notebook, self.path)
+
+
+@unittest.skipIf(ic._which('tmux') is None, "tmux is not installed")
+class TestTmuxTransport(unittest.TestCase):
+    SOCKET = 'ipython-cell-test-{}'.format(os.getpid())
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        call(['tmux', '-L', self.SOCKET, 'new-session', '-d', '-s', 'test',
+              'cat > "{}"'.format(self.path)])
+        self.transport = ic._TmuxTransport('test', self.SOCKET)
+        ic._settings = ic._Settings(dict(OPTIONS, send_ctrl_c=0,
+                                         send_ctrl_u=1))
+
+    def tearDown(self):
+        call(['tmux', '-L', self.SOCKET, 'kill-server'])
+        os.remove(self.path)
+        ic._settings = None
+
+    def read(self):
+        # End the input of cat and wait for it to exit
+        call(['tmux', '-L', self.SOCKET, 'send-keys', '-t', 'test', 'C-d'])
+        for _ in range(100):
+            if call(['tmux', '-L', self.SOCKET, 'has-session'],
+                    stderr=open(os.devnull, 'w')) != 0:
+                break
+            time.sleep(0.01)
+        with open(self.path) as f:
+            return f.read()
+
+    def test_send(self):
+        self.transport.clear_prompt()
+        self.transport.send_cell("    for i in x:\n        print(i)")
+        self.transport.send_command("-1")
+        self.transport.send_keys("## a\r")
+        self.assertEqual(self.read(),
+                         "for i in x:\n    print(i)\n\n-1\n## a\n")
+
+
+class TestTmpfileTransport(unittest.TestCase):
+    def setUp(self):
+        self.transport = ic._TmpfileTransport(max_files=2)
+
+    def tearDown(self):
+        self.transport.cleanup()
+
+    def test_write_dedents_cell(self):
+        path = self.transport.write("    a = 1\n    if a:\n        b = 2")
+        with open(path) as f:
+            self.assertEqual(f.read(), "a = 1\nif a:\n    b = 2")
+
+    def test_write_reuses_file(self):
+        path1 = self.transport.write("a = 1")
+        path2 = self.transport.write("a = 1")
+        self.assertEqual(path1, path2)
+        self.assertEqual(len(os.listdir(self.transport.directory)), 1)
+
+    def test_write_removes_old_files(self):
+        path1 = self.transport.write("a = 1")
+        self.transport.write("a = 2")
+        self.transport.write("a = 3")
+        self.assertFalse(os.path.exists(path1))
+        self.assertEqual(len(os.listdir(self.transport.directory)), 2)
+
+    @unittest.skipIf(InteractiveShell is None, "IPython is not installed")
+    def test_send_cell_keeps_file_variable(self):
+        shell = InteractiveShell.instance()
+        commands = []
+        ic._settings = ic._Settings(OPTIONS)
+        self.addCleanup(setattr, ic, '_settings', None)
+        original = ic._slimesend
+        ic._slimesend = lambda command, session: commands.append(command)
+        try:
+            self.transport.send_cell("a = __file__")
+        finally:
+            ic._slimesend = original
+
+        shell.user_ns['__file__'] = '/a.py'
+        self.assertTrue(shell.run_cell(commands[0]).success)
+        self.assertEqual(shell.user_ns.pop('__file__'), '/a.py')
+        self.assertTrue(shell.user_ns.pop('a').startswith(
+            self.transport.directory))
+
+    def test_cleanup(self):
+        self.transport.write("a = 1")
+        directory = self.transport.directory
+        self.transport.cleanup()
+        self.assertFalse(os.path.exists(directory))
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class TestTimings(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.time = ic.time
+        ic.time = self.clock
+        self.timings = ic._Timings(maxlen=2)
+
+    def tearDown(self):
+        ic.time = self.time
+
+    def test_nested_phases_are_exclusive(self):
+        self.timings.start('execute_cell')
+        with self.timings.phase('send'):
+            self.clock.now += 1
+            with self.timings.phase('clipboard'):
+                self.clock.now += 2
+            with self.timings.phase('slimesend'):
+                self.clock.now += 4
+        with self.timings.phase('slimesend'):
+            self.clock.now += 8
+        self.clock.now += 16
+        self.timings.finish(3, 20)
+
+        record = self.timings.records[-1]
+        self.assertEqual(dict(record['phases']),
+                         {'send': 1, 'clipboard': 2, 'slimesend': 12})
+        self.assertEqual(record['total'], 31)
+        self.assertEqual(record['lines'], 3)
+        self.assertEqual(record['bytes'], 20)
+
+    def test_phase_without_execution(self):
+        with self.timings.phase('boundaries'):
+            self.clock.now += 1
+        self.timings.finish(1, 1)
+        self.assertEqual(len(self.timings.records), 0)
+
+    def test_records_are_limited(self):
+        for _ in range(3):
+            self.timings.start('execute_cell')
+            self.timings.finish(1, 1)
+        self.assertEqual(len(self.timings.records), 2)
+
+    def test_trace_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for command in ['execute_cell', 'execute_cells_all']:
+                self.timings.start(command)
+                with self.timings.phase('send'):
+                    self.clock.now += 1
+                self.timings.finish(1, 1, trace_file=path)
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+
+        self.assertEqual([r['command'] for r in records],
+                         ['execute_cell', 'execute_cells_all'])
+        self.assertEqual(records[0]['phases'], {'send': 1})
+
+
+class TestBenchmarks(unittest.TestCase):
+    def tearDown(self):
+        if hasattr(ic, 'vim'):
+            del ic.vim
+        ic._settings = None
+        ic._transports.clear()
+        ic._cell_indexes.clear()
+        ic._executed_cells.clear()
+
+    def test_round_trips(self):
+        import bench_ipython_cell as bench
+        results = bench.run_benchmarks(sizes=[1000], repeat=1)
+        with open(bench.BASELINE) as f:
+            baseline = json.load(f)
+        for key, result in results.items():
+            self.assertLessEqual(result['round_trips'],
+                                 baseline[key]['round_trips'], key)
+
+    def test_compare(self):
+        import bench_ipython_cell as bench
+        baseline = {'a/1': {'seconds': 10e-6, 'round_trips': 2},
+                    'b/1': {'seconds': 1.0, 'round_trips': 2}}
+        results = {'a/1': {'seconds': 50e-6, 'round_trips': 2},
+                   'b/1': {'seconds': 2.5, 'round_trips': 3}}
+        self.assertEqual(len(bench.compare(results, baseline, 2.0)), 2)
+        self.assertEqual(len(bench.compare(results, baseline, 2.0, 0.0)), 3)
+
+
+@unittest.skipIf(ic._which('vim') is None, "vim is not installed")
+class TestStartup(unittest.TestCase):
+    # Maximum time in milliseconds to source plugin/ipython-cell.vim
+    BUDGET = 5.0
+
+    def get_sourced_files(self, filename):
+        """Start Vim with the plugin, edit ``filename`` and return the time
+        in milliseconds taken to source each file of the plugin."""
+        fd, log = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call(['vim', '-Nu', 'NONE', '-i', 'NONE', '-es',
+                  '--startuptime', log,
+                  '--cmd', 'set rtp^=' + REPO_DIR,
+                  '--cmd', 'filetype on',
+                  '--cmd', 'runtime plugin/ipython-cell.vim',
+                  '-c', 'edit ' + filename, '-c', 'qa!'])
+            with open(log) as f:
+                sourced = re.findall(
+                    r"([\d.]+): sourcing .*?"
+                    r"((?:plugin|autoload)[/\\]ipython[-_]cell\.vim)$",
+                    f.read(), re.MULTILINE)
+        finally:
+            os.remove(log)
+        return {path.replace('\\', '/'): float(ms) for ms, path in sourced}
+
+    def test_startup_time(self):
+        sourced = self.get_sourced_files('test.txt')
+        self.assertLess(sourced['plugin/ipython-cell.vim'], self.BUDGET)
+
+    def test_autoload_on_python_buffer(self):
+        self.assertNotIn('autoload/ipython_cell.vim',
+                         self.get_sourced_files('test.txt'))
+        self.assertIn('autoload/ipython_cell.vim',
+                      self.get_sourced_files('test.py'))
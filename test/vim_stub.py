@@ -0,0 +1,121 @@
+"""Stub of the ``vim`` module and default options shared by the tests and
+benchmarks.
+
+``OPTIONS`` holds the defaults of the options set in
+``plugin/ipython-cell.vim``, as returned by ``ipython_cell#options()``. A new
+option only needs to be added to the plugin and here.
+"""
+
+
+OPTIONS = {
+    'delimit_cells_by': 'tags',
+    'tag': ['# %%', '#%%', '# <codecell>', '##'],
+    'insert_tag': '# %% ',
+    'regex': 0,
+    'valid_marks': 'abcdefghijklmnopqrstuvqxyzABCDEFGHIJKLMNOPQRSTUVWXYZ',
+    'run_command': '%run {options} "{filepath}"',
+    'cell_command': '%paste -q',
+    'prefer_external_copy': 0,
+    'highlight_cells': 1,
+    'highlight_cells_ft': ['python'],
+    'send_cell_headers': 0,
+    'send_ctrl_c': 1,
+    'send_ctrl_u': 0,
+    'update_file_variable': 0,
+    'shell_prev_cmd': '!!',
+    'slime_python_ipython': 0,
+    'transport': 'slime',
+    'kernel_connection_file': '',
+    'send_async': 0,
+    'tmpfile_command': '%run -i "{filepath}"',
+    'stale_signs': 0,
+    'trace_file': '',
+    'validate': 0,
+    'checkpoint_dir': '',
+    'output_lines': 10000,
+    'tmux_target': '',
+    'tmux_socket': '',
+    'sessions': {},
+    'runtime_history': 0,
+    'runtime_history_file': '',
+    'runtime_regression': 2.0,
+    'has_clipboard': 1,
+    'has_timers': 1,
+}
+
+
+class Buffer(object):
+    """A simple buffer-like object for testing."""
+    def __init__(self, contents=None, marks=None):
+        if contents is None:
+            contents = []
+        if marks is None:
+            marks = {}
+        self.contents = contents
+        self.marks = marks
+
+    def __iter__(self):
+        for element in self.contents:
+            yield element
+
+    def __getitem__(self, index):
+        return self.contents[index]
+
+    def mark(self, mark):
+        return self.marks.get(mark, None)
+
+
+class FakeBuffer(Buffer):
+    """``Buffer`` with the parts of the Vim buffer API used when executing
+    cells. Each ``mark`` call is counted as a round trip to Vim."""
+    number = 1
+    name = '/tmp/bench.py'
+
+    def __init__(self, contents=None, marks=None):
+        super(FakeBuffer, self).__init__(contents, marks)
+        self.vars = {}
+        self.vim = None
+
+    def __len__(self):
+        return len(self.contents)
+
+    def __setitem__(self, key, value):
+        self.contents[key] = value
+
+    def mark(self, mark):
+        self.vim.round_trips += 1
+        return super(FakeBuffer, self).mark(mark)
+
+
+class FakeVim(object):
+    """Stub of the ``vim`` module that counts round trips to Vim."""
+    error = Exception
+
+    def __init__(self, buffer, cursor_row=1):
+        self.current = _Current(buffer, cursor_row)
+        self.round_trips = 0
+
+    def eval(self, expression):
+        self.round_trips += 1
+        if expression == 'ipython_cell#options()':
+            return dict(OPTIONS)
+        elif expression.startswith('ipython_cell#buffer_changes('):
+            return [expression[len('ipython_cell#buffer_changes('):-1], '1',
+                    []]
+        elif expression.startswith('ipython_cell#mark_rows('):
+            return [str(row) for row, _ in self.current.buffer.marks.values()]
+        return '0'
+
+    def command(self, command):
+        self.round_trips += 1
+
+
+class _Current(object):
+    def __init__(self, buffer, cursor_row):
+        self.buffer = buffer
+        self.window = _Window(cursor_row)
+
+
+class _Window(object):
+    def __init__(self, cursor_row):
+        self.cursor = (cursor_row, 0)